@@ -43,8 +43,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'menu.middleware.StaticFilesMiddleware',
+    'menu.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'menu.middleware.CartMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -65,6 +68,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'menu.context_processors.cart',
             ],
         },
     },
@@ -76,13 +80,225 @@ WSGI_APPLICATION = 'food_portal.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE picks the profile:
+#   'sqlite'   single-node deployments; WAL journal, busy timeout and
+#              IMMEDIATE transactions so concurrent workers queue for the
+#              write lock instead of failing with "database is locked".
+#   'postgres' multi-worker deployments; persistent connections with
+#              health checks, or a psycopg connection pool with DB_POOL=1.
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgres':
+    DB_POOL = os.environ.get('DB_POOL') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'food_portal'),
+            'USER': os.environ.get('POSTGRES_USER', 'food_portal'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # The pool owns connections, so Django must not also keep them open
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN', 2)),
+                    'max_size': int(os.environ.get('DB_POOL_MAX', 10)),
+                    'timeout': 10,
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Seconds to wait for the write lock before giving up
+                'timeout': 20,
+                # Take the write lock when a transaction starts, avoiding
+                # deadlocks when two readers both try to upgrade to writers
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA temp_store=MEMORY;'
+                    'PRAGMA cache_size=-20000;'
+                    'PRAGMA mmap_size=134217728;'
+                ),
+            },
+        }
     }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# MENU_CACHE_BACKEND selects where rendered menu fragments live: 'file'
+# (the default, shared by all workers on the box) or 'locmem' (per process,
+# so each renders its own). Either way fragments are keyed by the menu
+# version kept in the database, so every process sees a menu change.
+
+MENU_CACHE_BACKEND = os.environ.get('MENU_CACHE_BACKEND', 'file')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'menu': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'menu',
+        # Room for every card and fragment, so they aren't culled at random
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    } if MENU_CACHE_BACKEND == 'file' else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'menu',
+    },
+    # Used by CacheCartStorage. Point this at a shared cache (file, Redis,
+    # memcached) when running more than one worker process.
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'carts',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Rate limit buckets; as with carts, share it between worker processes
+    'ratelimit': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratelimit',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
 }
 
+MENU_CACHE_ALIAS = 'menu'
+MENU_CACHE_ENABLED = True
+MENU_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Cart storage
+# Where carts live between requests. The signed-cookie and cache backends
+# keep add/remove-from-cart off the database entirely; the session backend
+# stores the cart in the database-backed session.
+#   'menu.cart_storage.SignedCookieCartStorage'
+#   'menu.cart_storage.CacheCartStorage'
+#   'menu.cart_storage.SessionCartStorage'
+
+CART_STORAGE = os.environ.get('CART_STORAGE', 'menu.cart_storage.SignedCookieCartStorage')
+CART_CACHE_ALIAS = 'carts'
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 2
+
+
+# Rate limits
+# Token buckets per session, user and client IP: each scope allows
+# `capacity` requests, refilled evenly over `period` seconds. The IP
+# bucket is RATE_LIMIT_IP_MULTIPLIER times bigger because students on the
+# campus network share addresses; RATE_LIMIT_IP_MULTIPLIERS overrides that
+# per scope. Checkout gets 5 x 60 = 300 a minute per address, about what
+# the campus NAT sends at the lunch rush, while each session is still held
+# to 5. RATE_LIMIT_SESSION_SCOPES need a session the server issued (the
+# checkout page starts one), so a client can't get a fresh bucket by
+# changing a cookie of its own.
+
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_CACHE_ALIAS = 'ratelimit'
+RATE_LIMIT_IP_MULTIPLIER = 20
+RATE_LIMIT_IP_MULTIPLIERS = {
+    'checkout': 60,
+}
+RATE_LIMIT_SESSION_SCOPES = {'checkout'}
+RATE_LIMITS = {
+    # scope: (capacity, period)
+    'cart': (60, 60),        # add, remove and batch cart updates
+    'cart_read': (120, 60),  # cart contents and count
+    'checkout': (5, 60),     # confirm_order; each one sends an STK push
+    'search': (120, 60),     # menu search, sent as students type
+    'sync': (60, 60),        # menu delta sync, on page load and reconnect
+}
+
+
+# Offline menu
+# The service worker (/sw.js) keeps the menu page and images for when the
+# connection drops, and the page catches up through the delta sync
+# endpoint. Rows saved up to MENU_SYNC_OVERLAP seconds before a client's
+# watermark are sent again, so saves that commit late aren't missed.
+
+MENU_SYNC_OVERLAP = 5
+
+
+# Outlets
+# The serving point a student picked is kept in this cookie; without one,
+# each order goes to the least busy outlet that has everything in it.
+
+OUTLET_COOKIE_NAME = 'outlet'
+OUTLET_COOKIE_AGE = 60 * 60 * 24 * 90
+
+
+# Pickup slots
+# Orders can only book slots starting at least this many minutes from now.
+# Create the slots themselves with `manage.py create_slots`.
+
+PICKUP_SLOT_LEAD_MINUTES = 10
+
+
+# Stock alerts
+# Sell-through velocity is measured over the last STOCK_VELOCITY_WINDOW
+# seconds; an open alert is refreshed, or a resolved one reopened, at most
+# once per STOCK_ALERT_COOLDOWN seconds.
+
+STOCK_VELOCITY_WINDOW = 60 * 60
+STOCK_ALERT_COOLDOWN = 5 * 60
+
+
+# Kitchen feed
+# Order changes are recorded in the menu_orderevent table by whichever
+# process made them (web or run_tasks). Each web process with a kitchen
+# screen connected reads new rows every ORDER_FEED_POLL_INTERVAL seconds
+# and streams them; run_tasks deletes rows older than ORDER_EVENT_KEEP.
+
+ORDER_FEED_POLL_INTERVAL = 1
+ORDER_EVENT_KEEP = 60 * 60
+
+
+# Task queue
+# STK pushes, stock alerts and sales rollups run after the order commits,
+# as rows in the menu_task table picked up by `manage.py run_tasks`
+# (TASK_WORKERS threads per process; run more processes for more). Failed
+# attempts are retried after TASK_RETRY_DELAY seconds, doubling up to
+# TASK_RETRY_MAX_DELAY; a task running past TASK_TIMEOUT is taken over by
+# another worker. TASKS_EAGER=1 makes the first attempt in the web process
+# once the request's transaction commits, for trying things out without a
+# worker; it puts the STK push back in the checkout request. Either way a
+# task's effects reach the kitchen screens through the order events table
+# (see Kitchen feed above), never through anything held in one process.
+
+TASKS_EAGER = os.environ.get('TASKS_EAGER', '0') == '1'
+TASK_WORKERS = int(os.environ.get('TASK_WORKERS', '4'))
+TASK_POLL_INTERVAL = 0.5
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_DELAY = 5
+TASK_RETRY_MAX_DELAY = 10 * 60
+TASK_TIMEOUT = 5 * 60
+TASK_KEEP_DONE = 24 * 60 * 60  # Done tasks are deleted after this; dead ones are kept
+TASK_METRICS_WINDOW = 5 * 60
+
+
+# Order archive
+# `manage.py archive_orders` moves old orders here as gzipped JSONL files,
+# partitioned by month. Keep this directory backed up with the database.
+
+ORDER_ARCHIVE_DIR = os.environ.get('ORDER_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+
+
+# Instrumentation
+# This fraction of requests is timed (SQL, templates, M-Pesa) and gets a
+# Server-Timing header; the totals are served at /metrics/ to staff, or
+# to scrapers sending "Authorization: Bearer $METRICS_TOKEN".
+
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '0.1'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -122,12 +338,38 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# `collectstatic` minifies CSS and JS, fingerprints every file and stores
+# gzip copies (and brotli ones, with `pip install brotli`) in STATIC_ROOT.
+# With STATIC_SERVE on, StaticFilesMiddleware serves them from there:
+# fingerprinted names are cached for a year, anything else for
+# STATIC_MAX_AGE seconds. Off by default while DEBUG is on, so runserver
+# keeps serving the uncollected files.
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'menu.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
+STATIC_SERVE = os.environ.get('STATIC_SERVE', '0' if DEBUG else '1') == '1'
+STATIC_MAX_AGE = 60 * 5
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Menu images
+# Uploads are stored once per distinct content and resized to these widths
+# (WebP and JPEG) for the menu's srcset. Run backfill_menu_images after
+# changing them.
+
+MENU_IMAGE_WIDTHS = [320, 640, 960]
+MENU_IMAGE_QUALITY = 80
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MPESA_CONSUMER_KEY = '1sxeo2YxMKU5aDg0BIZkygd2qPRLmwkhQVGWfFmIwfWpPxnK'
@@ -135,3 +377,12 @@ MPESA_CONSUMER_SECRET = 'Gzg7CpSEEmMMT5EwJFoDYc7EsizsTivYZKCd2Fz2KFCNg0kmU8uR3sn
 MPESA_SHORTCODE = '174379'  # Test Shortcode
 MPESA_PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'
 MPESA_CALLBACK_URL = 'https://yourdomain.com/api/payment-callback/'  # Update as needed
+# Callbacks aren't signed: the STK push gives Safaricom MPESA_CALLBACK_URL
+# with this token added, and callbacks without it are refused (all of them
+# while it is unset). MPESA_CALLBACK_IPS, if set, also limits them to
+# Safaricom's published addresses (as seen in REMOTE_ADDR).
+MPESA_CALLBACK_TOKEN = os.environ.get('MPESA_CALLBACK_TOKEN', '')
+MPESA_CALLBACK_IPS = [ip for ip in os.environ.get('MPESA_CALLBACK_IPS', '').split(',') if ip]
+MPESA_BASE_URL = 'https://sandbox.safaricom.co.ke'
+MPESA_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+MPESA_WORKERS = 4  # Connections kept open to Daraja per process
@@ -1,24 +1,132 @@
 from django.contrib import admin
 
 # Register your models here.
-from django.contrib import admin
-from .models import MenuItem, Announcement, Order, StockAlert
+from django.contrib import admin, messages
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from .bulk import apply_menu_updates, rows_from_csv, write_csv
+from .kitchen import advance_orders
+from .models import (
+    MenuItem, Announcement, HeldPayment, Order, Outlet, OutletStock, PickupSlot, StockAlert, Task,
+)
+from .payments import apply_held_payments
+from .search import index as search_index
+from .stock import cancel_order, cancel_orders
+from .tasks import requeue
+
+class OutletStockInline(admin.TabularInline):
+    model = OutletStock
+    extra = 0
+
 
 class MenuItemAdmin(admin.ModelAdmin):
-    list_display = ('name', 'price', 'available_units', 'category')
-    list_filter = ('category',)
+    list_display = ('name', 'price', 'available_units', 'low_stock_threshold', 'category', 'station', 'tags')
+    list_filter = ('category', 'station')
+    # Answered from the in-memory index (menu/search.py), not LIKE scans
     search_fields = ('name',)
+    actions = ['export_stock_csv']
+    # Items given outlet stock are sold from it; available_units becomes its total
+    inlines = [OutletStockInline]
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.filter(id__in=search_index.matching_ids(search_term)), False
+
+    @admin.action(description='Export selected items as a stock CSV')
+    def export_stock_csv(self, request, queryset):
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="menu-stock.csv"'
+        write_csv(queryset.order_by('id'), response)
+        return response
+
+    def get_urls(self):
+        return [
+            path('import-csv/', self.admin_site.admin_view(self.import_csv),
+                 name='menu_menuitem_import_csv'),
+        ] + super().get_urls()
+
+    def import_csv(self, request):
+        # Prices and stock for the whole menu in one upload; see menu/bulk.py
+        if not self.has_change_permission(request):
+            return redirect('admin:index')
+        report = None
+        if request.method == 'POST' and request.FILES.get('csv_file'):
+            try:
+                rows = rows_from_csv(request.FILES['csv_file'])
+            except (UnicodeDecodeError, ValueError):
+                self.message_user(request, 'Could not read that file as CSV.', messages.ERROR)
+            else:
+                report = apply_menu_updates(rows, dry_run=bool(request.POST.get('dry_run')))
+                if not report.ok:
+                    self.message_user(request, 'Nothing was saved; fix the rows below.', messages.ERROR)
+                elif report.applied:
+                    self.message_user(request, f'Updated {report.updated} items.')
+                    return redirect('admin:menu_menuitem_changelist')
+                else:
+                    self.message_user(request, f'{report.updated} items would change.')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import prices and stock',
+            'report': report,
+        }
+        return TemplateResponse(request, 'admin/menu/menuitem/import_csv.html', context)
 
 
 
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('id', 'customer_name', 'created_at', 'total_amount')
+    list_display = ('id', 'customer_name', 'created_at', 'total_amount', 'status', 'payment_status', 'outlet', 'mpesa_receipt')
+    list_filter = ('status', 'payment_status', 'outlet')
+    list_select_related = ('outlet',)
+    search_fields = ('checkout_request_id', 'mpesa_receipt', 'phone')
+    actions = ['mark_preparing', 'mark_ready', 'mark_collected']
+
+    ordering = ('-created_at', '-id')
+    # Skip the extra unfiltered COUNT(*) on every changelist page
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # Totals are summed in the database for the whole page at once
+        return super().get_queryset(request).with_totals()
 
     def total_amount(self, obj):
-        # Calculate the total amount for the order by summing up the price of all order items
-        return sum(item.item_price * item.quantity for item in obj.items.all())
+        return obj.total_amount()
 
     total_amount.short_description = 'Total Amount'  # Optional: Set column header
+    total_amount.admin_order_field = 'items_total'
+
+    def _advance(self, request, queryset, status):
+        ids = list(queryset.values_list('id', flat=True))
+        moved = advance_orders(ids, status)
+        labels = dict(Order.STATUS_CHOICES)
+        self.message_user(request, f'{len(moved)} order(s) marked {labels[status].lower()}.')
+        if len(moved) < len(ids):
+            self.message_user(
+                request, f'{len(ids) - len(moved)} order(s) were not '
+                f'{labels[Order.PREVIOUS_STATUS[status]].lower()} and were left alone.',
+                messages.WARNING)
+
+    @admin.action(description='Start preparing selected paid orders')
+    def mark_preparing(self, request, queryset):
+        self._advance(request, queryset, Order.STATUS_PREPARING)
+
+    @admin.action(description='Mark selected orders ready')
+    def mark_ready(self, request, queryset):
+        self._advance(request, queryset, Order.STATUS_READY)
+
+    @admin.action(description='Mark selected orders collected')
+    def mark_collected(self, request, queryset):
+        self._advance(request, queryset, Order.STATUS_COLLECTED)
+
+    # Deleting gives back the orders' stock and pickup slot places
+    def delete_model(self, request, obj):
+        cancel_order(obj)
+
+    def delete_queryset(self, request, queryset):
+        cancel_orders(list(queryset.values_list('id', flat=True)))
  
 class CustomAdminSite(admin.AdminSite):
     class Media:
@@ -29,8 +137,62 @@ class CustomAdminSite(admin.AdminSite):
 admin.site = CustomAdminSite()
    
 
+class PickupSlotAdmin(admin.ModelAdmin):
+    list_display = ('start', 'end', 'capacity', 'reserved')
+    date_hierarchy = 'start'
+    # The counter is maintained by place_order and the release functions
+    readonly_fields = ('reserved',)
+
+
+class OutletAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'is_active')
+    prepopulated_fields = {'slug': ('name',)}
+
+
+class StockAlertAdmin(admin.ModelAdmin):
+    list_display = ('menu_item', 'level', 'available_units', 'velocity', 'empty_at', 'is_resolved', 'updated_at')
+    list_filter = ('is_resolved', 'level')
+    list_select_related = ('menu_item',)
+    ordering = ('is_resolved', '-updated_at')
+
+
+class HeldPaymentAdmin(admin.ModelAdmin):
+    list_display = ('checkout_request_id', 'reason', 'order', 'result_code', 'amount', 'receipt', 'created_at')
+    list_filter = ('reason',)
+    search_fields = ('checkout_request_id', 'receipt', 'phone')
+    ordering = ('-created_at',)
+    actions = ['apply_again']
+
+    @admin.action(description='Apply selected results to their orders again')
+    def apply_again(self, request, queryset):
+        ids = list(queryset.filter(reason=HeldPayment.REASON_UNMATCHED)
+                   .values_list('checkout_request_id', flat=True))
+        report = apply_held_payments(ids)
+        self.message_user(request, f'{report.paid} paid, {report.failed} failed, '
+                                   f'{report.duplicates} already settled.')
+        if report.mismatched:
+            self.message_user(request, f'{len(report.mismatched)} did not match the order amount.',
+                              messages.WARNING)
+
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'run_at', 'finished_at', 'worker')
+    list_filter = ('status', 'name')
+    ordering = ('-id',)
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'locked_until', 'worker', 'last_error')
+    actions = ['retry']
+
+    @admin.action(description='Retry selected dead tasks')
+    def retry(self, request, queryset):
+        self.message_user(request, f'{requeue(queryset)} task(s) queued again.')
+
+
 admin.site.register(MenuItem, MenuItemAdmin)
 admin.site.register(Announcement)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(StockAlert)
+admin.site.register(HeldPayment, HeldPaymentAdmin)
+admin.site.register(Outlet, OutletAdmin)
+admin.site.register(PickupSlot, PickupSlotAdmin)
+admin.site.register(StockAlert, StockAlertAdmin)
+admin.site.register(Task, TaskAdmin)
 
@@ -0,0 +1,168 @@
+import csv
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractHour, TruncDate
+from django.utils import timezone
+
+from .models import HourlySales, Order, OrderItem, SalesRollup
+from .tasks import task
+
+BATCH_SIZE = 500
+
+
+def _collect(rows):
+    """
+    Sum ``(created_at, order_id, item_name, quantity, price)`` rows into
+    per-(date, item) and per-(date, hour) buckets of (orders, units, revenue).
+    """
+    daily = defaultdict(lambda: [set(), 0, Decimal('0')])
+    hourly = defaultdict(lambda: [set(), 0, Decimal('0')])
+    for created_at, order_id, item_name, quantity, price in rows:
+        local = timezone.localtime(created_at)
+        for bucket in (daily[(local.date(), item_name)], hourly[(local.date(), local.hour)]):
+            bucket[0].add(order_id)
+            bucket[1] += quantity
+            bucket[2] += price * quantity
+
+    def totals(buckets):
+        return {key: (len(orders), units, revenue) for key, (orders, units, revenue) in buckets.items()}
+    return totals(daily), totals(hourly)
+
+
+def _apply(model, key_fields, totals, sign):
+    for key, (orders, units, revenue) in totals.items():
+        bucket = model.objects.filter(**dict(zip(key_fields, key)))
+        changes = {
+            'orders': F('orders') + sign * orders,
+            'units': F('units') + sign * units,
+            'revenue': F('revenue') + sign * revenue,
+        }
+        if bucket.update(**changes) or sign < 0:
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**dict(zip(key_fields, key)),
+                                     orders=orders, units=units, revenue=revenue)
+        except IntegrityError:
+            # Another order created the bucket first
+            bucket.update(**changes)
+
+
+def _apply_all(rows, sign):
+    daily, hourly = _collect(rows)
+    with transaction.atomic():
+        _apply(SalesRollup, ('date', 'item_name'), daily, sign)
+        _apply(HourlySales, ('date', 'hour'), hourly, sign)
+
+
+@task
+def record_sale(order_id):
+    """Add a placed order to the rollups, unless it is in them already or has failed since."""
+    with transaction.atomic():
+        if not (Order.objects.filter(id=order_id, in_sales_rollups=False)
+                .exclude(payment_status=Order.PAYMENT_FAILED).update(in_sales_rollups=True)):
+            return
+        _apply_all(OrderItem.objects.filter(order_id=order_id).values_list(
+            'order__created_at', 'order_id', 'item_name', 'quantity', 'item_price'), 1)
+
+
+def remove_sales(order_ids):
+    """Take orders that failed or were cancelled back out of the rollups."""
+    with transaction.atomic():
+        counted = list(Order.objects.select_for_update().filter(
+            id__in=order_ids, in_sales_rollups=True).values_list('id', flat=True))
+        if not counted:
+            return
+        Order.objects.filter(id__in=counted).update(in_sales_rollups=False)
+        rows = OrderItem.objects.filter(order_id__in=counted).values_list(
+            'order__created_at', 'order_id', 'item_name', 'quantity', 'item_price')
+        _apply_all(rows, -1)
+
+
+def _rebuild_table(model, rollups, buckets):
+    rollups.delete()
+    written, batch = 0, []
+    for row in buckets.iterator(chunk_size=BATCH_SIZE):
+        batch.append(model(**row))
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            written += len(batch)
+            batch = []
+    model.objects.bulk_create(batch)
+    return written + len(batch)
+
+
+def rebuild(start=None, end=None):
+    """
+    Recompute the rollups for local dates ``start``..``end`` (inclusive;
+    everything when omitted) from the orders themselves. Returns the
+    number of daily rollup rows written.
+    """
+    tz = timezone.get_current_timezone()
+    items = OrderItem.objects.exclude(order__payment_status=Order.PAYMENT_FAILED).annotate(
+        date=TruncDate('order__created_at', tzinfo=tz),
+        hour=ExtractHour('order__created_at', tzinfo=tz),
+    )
+    dates = {}
+    if start:
+        dates['date__gte'] = start
+    if end:
+        dates['date__lte'] = end
+    items = items.filter(**dates)
+    sums = {
+        'orders': Count('order_id', distinct=True),
+        'units': Sum('quantity'),
+        'revenue': Sum(F('item_price') * F('quantity')),
+    }
+
+    orders = Order.objects.annotate(date=TruncDate('created_at', tzinfo=tz)).filter(**dates)
+
+    with transaction.atomic():
+        # Rebuilt from every order that hasn't failed, so record_sale and
+        # remove_sales carry on from here
+        orders.exclude(payment_status=Order.PAYMENT_FAILED).update(in_sales_rollups=True)
+        orders.filter(payment_status=Order.PAYMENT_FAILED).update(in_sales_rollups=False)
+        written = _rebuild_table(
+            SalesRollup, SalesRollup.objects.filter(**dates),
+            items.values('date', 'item_name').annotate(**sums).order_by())
+        _rebuild_table(
+            HourlySales, HourlySales.objects.filter(**dates),
+            items.values('date', 'hour').annotate(**sums).order_by())
+    return written
+
+
+def sales_report(start, end):
+    """Revenue and units by item, day and hour for ``start``..``end``."""
+    sums = {'orders': Sum('orders'), 'units': Sum('units'), 'revenue': Sum('revenue')}
+    daily = SalesRollup.objects.filter(date__range=(start, end))
+    hourly = HourlySales.objects.filter(date__range=(start, end))
+    days = list(hourly.values('date').annotate(**sums).order_by('date'))
+    return {
+        'totals': {
+            'orders': sum(day['orders'] for day in days),
+            'units': sum(day['units'] for day in days),
+            'revenue': sum((day['revenue'] for day in days), Decimal('0')),
+        },
+        'items': list(daily.values('item_name').annotate(**sums).order_by('-revenue', 'item_name')),
+        'days': days,
+        'hours': list(hourly.values('hour').annotate(**sums).order_by('hour')),
+    }
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def iter_csv(start, end):
+    """Yield the daily rollups for ``start``..``end`` as CSV lines."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['date', 'item', 'orders', 'units', 'revenue'])
+    rows = SalesRollup.objects.filter(date__range=(start, end)).order_by(
+        'date', 'item_name').values_list('date', 'item_name', 'orders', 'units', 'revenue')
+    for row in rows.iterator(chunk_size=2000):
+        yield writer.writerow(row)
+
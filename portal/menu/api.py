@@ -0,0 +1,31 @@
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .bulk import FIELDS, apply_menu_updates
+from .models import MenuItem
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAdminUser])
+def menu_stock(request):
+    """
+    GET lists every item's id, name, price and available_units.
+
+    POST takes a list of rows in the same shape (or ``{"items": [...]}``)
+    and applies them all at once; see ``menu.bulk.apply_menu_updates``.
+    Add ``?dry_run=1`` to validate without saving.
+    """
+    if request.method == 'GET':
+        items = MenuItem.objects.order_by('id').values('id', 'name', *FIELDS)
+        return Response([{**item, 'price': str(item['price'])} for item in items])
+
+    rows = request.data.get('items') if isinstance(request.data, dict) else request.data
+    if not isinstance(rows, list):
+        return Response({'success': False, 'error': 'Expected a list of rows.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    report = apply_menu_updates(rows, dry_run=request.query_params.get('dry_run') in ('1', 'true'))
+    return Response(report.as_dict(),
+                    status=status.HTTP_200_OK if report.ok else status.HTTP_400_BAD_REQUEST)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MenuConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'menu'
+
+    def ready(self):
+        # Connect the signal handlers
+        from . import analytics, feed, images, menu_cache, outlets, search, stock_monitor  # noqa: F401
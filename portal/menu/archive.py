@@ -0,0 +1,216 @@
+import datetime
+import gzip
+import json
+import os
+import uuid
+from array import array
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchiveBlock, Order, OrderArchive, OrderItem
+
+# Orders per gzip member; a lookup decompresses at most this many.
+BLOCK_SIZE = 1000
+
+ORDER_FIELDS = ['id', 'customer_name', 'user_id', 'phone', 'created_at', 'amount',
+                'payment_status', 'checkout_request_id', 'mpesa_receipt', 'paid_at',
+                'pickup_slot_id', 'outlet_id', 'status', 'preparing_at', 'ready_at', 'collected_at']
+ITEM_FIELDS = ['menu_item_id', 'item_name', 'item_price', 'quantity']
+
+
+def _archivable(cutoff, prefix=''):
+    """
+    Orders created before ``cutoff`` that are finished: collected, cancelled
+    or failed. Pending and active orders still hold stock and slot places,
+    and may yet get a payment callback, so they stay.
+    """
+    return Q(**{f'{prefix}created_at__lt': cutoff}) & (
+        Q(**{f'{prefix}status__in': Order.FINISHED_STATUSES})
+        | Q(**{f'{prefix}payment_status': Order.PAYMENT_FAILED}))
+
+
+def _records(cutoff, chunk_size):
+    """
+    Yield the orders to archive (see _archivable) as dicts with their items,
+    in id order. Orders and items are two streamed queries merged on the
+    order id, so nothing is held in memory beyond one chunk of each.
+    """
+    orders = Order.objects.filter(_archivable(cutoff)).order_by('id').values(*ORDER_FIELDS)
+    items = OrderItem.objects.filter(_archivable(cutoff, 'order__')).order_by(
+        'order_id', 'id').values_list('order_id', *ITEM_FIELDS)
+    items = items.iterator(chunk_size=chunk_size)
+    item = next(items, None)
+    for order in orders.iterator(chunk_size=chunk_size):
+        order['items'] = []
+        while item is not None and item[0] <= order['id']:
+            if item[0] == order['id']:
+                order['items'].append(dict(zip(ITEM_FIELDS, item[1:])))
+            item = next(items, None)
+        yield order
+
+
+def _line(record):
+    return (json.dumps(record, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n').encode()
+
+
+class _PartitionWriter:
+    """Writes one month's orders as a series of gzip members."""
+
+    def __init__(self, root, month):
+        self.month = month
+        self.path = os.path.join(
+            f'{month:%Y}', f'orders-{month:%Y-%m}-{uuid.uuid4().hex[:8]}.jsonl.gz')
+        self.full_path = os.path.join(root, self.path)
+        os.makedirs(os.path.dirname(self.full_path), exist_ok=True)
+        self.file = open(self.full_path + '.tmp', 'wb')
+        self.blocks = []
+        self.lines = []
+        self.count = 0
+
+    def add(self, record):
+        if not self.lines:
+            self.first_id = record['id']
+        self.lines.append(_line(record))
+        self.last_id = record['id']
+        self.count += 1
+        if len(self.lines) >= BLOCK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.lines:
+            data = gzip.compress(b''.join(self.lines), compresslevel=6)
+            self.blocks.append(ArchiveBlock(
+                first_order_id=self.first_id, last_order_id=self.last_id,
+                offset=self.file.tell(), length=len(data)))
+            self.file.write(data)
+            self.lines = []
+
+    def close(self):
+        self._flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.full_path + '.tmp', self.full_path)
+
+    def register(self):
+        archive = OrderArchive.objects.create(
+            month=self.month, path=self.path, orders=self.count,
+            first_order_id=self.blocks[0].first_order_id,
+            last_order_id=self.blocks[-1].last_order_id)
+        for block in self.blocks:
+            block.archive = archive
+        ArchiveBlock.objects.bulk_create(self.blocks)
+
+
+@dataclass
+class ArchiveReport:
+    orders: int = 0
+    deleted: int = 0
+    files: list = field(default_factory=list)
+
+
+def archive_orders(cutoff, chunk_size=2000, batch_size=5000, delete=True):
+    """
+    Move finished orders created before ``cutoff`` into gzipped JSONL
+    files, one or more per month, under ORDER_ARCHIVE_DIR.
+
+    Orders are streamed with ``iterator(chunk_size=...)`` so memory stays
+    flat however many there are (bar the ids written, 8 bytes each). Each
+    file is complete and registered in OrderArchive before any of its
+    orders are deleted, which then happens ``batch_size`` orders per
+    transaction. Only orders written to a file are deleted: one that
+    became finished while this ran is left for the next run.
+    """
+    root = settings.ORDER_ARCHIVE_DIR
+    report = ArchiveReport()
+    writers = {}
+    written = array('q')
+
+    try:
+        for record in _records(cutoff, chunk_size):
+            month = timezone.localtime(record['created_at']).date().replace(day=1)
+            if month not in writers:
+                writers[month] = _PartitionWriter(root, month)
+            writers[month].add(record)
+            written.append(record['id'])
+            report.orders += 1
+    except BaseException:
+        for writer in writers.values():
+            writer.file.close()
+            os.remove(writer.full_path + '.tmp')
+        raise
+
+    for writer in writers.values():
+        writer.close()
+    with transaction.atomic():
+        for writer in writers.values():
+            writer.register()
+    report.files = sorted(writer.path for writer in writers.values())
+
+    if delete:
+        for start in range(0, len(written), batch_size):
+            ids = written[start:start + batch_size].tolist()
+            with transaction.atomic():
+                # Items first, so deleting the orders has nothing left to cascade to
+                OrderItem.objects.filter(order_id__in=ids).delete()
+                report.deleted += Order.objects.filter(id__in=ids).delete()[0]
+    return report
+
+
+@dataclass
+class ArchivedOrder:
+    """An order read back from the archive, shaped like Order for templates."""
+    id: int
+    customer_name: str
+    created_at: datetime.datetime
+    payment_status: str
+    status: str = ''
+    phone: str = ''
+    mpesa_receipt: str = ''
+    items: list = field(default_factory=list)
+    archive: str = ''
+
+    def item_names(self):
+        return ', '.join(item['item_name'] for item in self.items)
+
+    def get_status_display(self):
+        return dict(Order.STATUS_CHOICES).get(self.status, self.status)
+
+    def total_amount(self):
+        return sum((Decimal(item['item_price']) * item['quantity'] for item in self.items),
+                   Decimal('0'))
+
+
+def find_archived_order(order_id):
+    """Look an order up in the archive files; ``None`` if it isn't there."""
+    prefix = f'{{"id":{int(order_id)},'.encode()
+    blocks = ArchiveBlock.objects.filter(
+        first_order_id__lte=order_id, last_order_id__gte=order_id,
+    ).select_related('archive')
+    for block in blocks:
+        with open(os.path.join(settings.ORDER_ARCHIVE_DIR, block.archive.path), 'rb') as f:
+            f.seek(block.offset)
+            data = gzip.decompress(f.read(block.length))
+        for line in data.splitlines():
+            if line.startswith(prefix):
+                record = json.loads(line)
+                return ArchivedOrder(
+                    id=record['id'],
+                    customer_name=record['customer_name'],
+                    created_at=parse_datetime(record['created_at']),
+                    payment_status=record['payment_status'],
+                    # Archived before the status workflow existed
+                    status=record.get('status', ''),
+                    phone=record['phone'],
+                    mpesa_receipt=record['mpesa_receipt'],
+                    items=record['items'],
+                    archive=block.archive.path,
+                )
+    return None
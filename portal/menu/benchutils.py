@@ -0,0 +1,140 @@
+import datetime
+import os
+import statistics
+import tempfile
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .menu_cache import bump_version
+from .models import MenuItem, Order, OrderItem, PickupSlot
+
+
+@contextmanager
+def benchmark_database(on_disk=True):
+    """
+    Run a benchmark against a throwaway copy of the schema, never the real
+    database. SQLite copies are put in a temporary file by default so that
+    writes cost what they would in production.
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    tmpdir = None
+    if on_disk and connection.vendor == 'sqlite':
+        tmpdir = tempfile.mkdtemp(prefix='food-bench-')
+        test_settings['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        if tmpdir:
+            os.rmdir(tmpdir)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(len(sorted_values) * pct / 100.0)))
+    return sorted_values[index]
+
+
+def summarize(timings_ms):
+    timings = sorted(timings_ms)
+    return {
+        'count': len(timings),
+        'p50': statistics.median(timings) if timings else 0.0,
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'max': timings[-1] if timings else 0.0,
+    }
+
+
+def make_menu(count=40):
+    """Menu items with more stock than any benchmark will sell."""
+    items = MenuItem.objects.bulk_create([
+        MenuItem(name=f'Dish {i}', price=Decimal(40 + 5 * (i % 12)),
+                 category='beverage' if i % 4 == 0 else 'food',
+                 available_units=10 ** 6, low_stock_threshold=0)
+        for i in range(count)
+    ])
+    bump_version()
+    return items
+
+
+def make_slots(count=8, capacity=10 ** 6):
+    """Upcoming 15 minute pickup slots, starting an hour from now."""
+    start = timezone.now().replace(second=0, microsecond=0) + datetime.timedelta(hours=1)
+    return PickupSlot.objects.bulk_create([
+        PickupSlot(start=start + datetime.timedelta(minutes=15 * i),
+                   end=start + datetime.timedelta(minutes=15 * (i + 1)), capacity=capacity)
+        for i in range(count)
+    ])
+
+
+def make_orders(count, start, end, items_per_order=2, batch_size=10000):
+    """
+    Insert ``count`` paid, collected orders spread evenly over ``start``..``end``
+    straight into the tables, skipping place_order and its signals, so
+    archive and report benchmarks can build histories of a million orders
+    in seconds. Returns the ids of the first and last order written.
+    """
+    ops = connection.ops
+    qn = ops.quote_name
+    order_sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        qn(Order._meta.db_table),
+        ', '.join(qn(c) for c in ('id', 'customer_name', 'created_at', 'phone', 'amount',
+                                  'payment_status', 'mpesa_receipt', 'paid_at', 'status',
+                                  'collected_at', 'in_sales_rollups')),
+        ', '.join(['%s'] * 11))
+    item_sql = 'INSERT INTO {} ({}) VALUES (%s, %s, %s, %s)'.format(
+        qn(OrderItem._meta.db_table),
+        ', '.join(qn(c) for c in ('order_id', 'item_name', 'item_price', 'quantity')))
+    price = ops.adapt_decimalfield_value(Decimal('50.00'), 8, 2)
+    amount = ops.adapt_decimalfield_value(Decimal('100.00') * items_per_order, 10, 2)
+
+    first_id = (Order.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    step = (end - start) / max(count, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for batch_start in range(0, count, batch_size):
+            orders, items = [], []
+            for n in range(batch_start, min(count, batch_start + batch_size)):
+                order_id = first_id + n
+                created = ops.adapt_datetimefield_value(start + step * n)
+                orders.append((order_id, f'Student {n}', created, '254700000000', amount,
+                               Order.PAYMENT_PAID, f'R{order_id:09d}', created,
+                               Order.STATUS_COLLECTED, created, False))
+                items.extend((order_id, f'Dish {k}', price, 2) for k in range(items_per_order))
+            cursor.executemany(order_sql, orders)
+            cursor.executemany(item_sql, items)
+        for sql in ops.sequence_reset_sql(no_style(), [Order, OrderItem]):
+            cursor.execute(sql)
+    return first_id, first_id + count - 1
+
+
+def find_regressions(baseline, results, threshold=0.25, slack_ms=1.0):
+    """
+    Compare per-endpoint ``results`` with a saved ``baseline`` (both as
+    written by bench_suite) and describe each endpoint whose p95 grew by
+    more than ``threshold`` (a fraction; ``slack_ms`` on top keeps
+    sub-millisecond noise out) or that now runs more queries.
+    """
+    problems = []
+    for name, stats in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        limit = old['p95'] * (1 + threshold) + slack_ms
+        if stats['p95'] > limit:
+            problems.append(f"{name}: p95 {stats['p95']:.2f}ms is over {limit:.2f}ms "
+                            f"(baseline {old['p95']:.2f}ms)")
+        if stats['queries'] > old['queries']:
+            problems.append(f"{name}: {stats['queries']} queries per request "
+                            f"(baseline {old['queries']})")
+    return problems
@@ -0,0 +1,134 @@
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from .models import MenuItem
+from .outlets import with_outlet_units
+
+
+@dataclass(frozen=True)
+class CartLine:
+    item_id: int
+    name: str
+    price: Decimal
+    quantity: int
+    available_units: int
+
+    @property
+    def subtotal(self):
+        return self.price * self.quantity
+
+    @property
+    def available(self):
+        return self.available_units > 0
+
+    @property
+    def in_stock(self):
+        return self.quantity <= self.available_units
+
+
+@dataclass(frozen=True)
+class CartSnapshot:
+    lines: list = field(default_factory=list)
+    missing: list = field(default_factory=list)
+
+    @property
+    def total(self):
+        return sum((line.subtotal for line in self.lines), Decimal('0'))
+
+    @property
+    def count(self):
+        return sum(line.quantity for line in self.lines)
+
+    @property
+    def all_in_stock(self):
+        return all(line.in_stock for line in self.lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+def _parse_cart(cart):
+    # Session JSON turns the item ids into strings, so normalise them back.
+    quantities = {}
+    for item_id, quantity in cart.items():
+        try:
+            quantities[int(item_id)] = int(quantity)
+        except (TypeError, ValueError):
+            continue
+    return quantities
+
+
+def price_cart(cart, outlet=None):
+    """
+    Resolve a ``{item_id: quantity}`` cart with a single query. With an
+    ``outlet``, stock is what that outlet can sell.
+    """
+    quantities = _parse_cart(cart)
+    if not quantities:
+        return CartSnapshot()
+
+    items = MenuItem.objects.filter(id__in=quantities).only(
+        'id', 'name', 'price', 'available_units'
+    )
+    if outlet is not None:
+        items = with_outlet_units(items, outlet)
+    items = items.in_bulk()
+
+    lines = []
+    missing = []
+    # Keep the order in which items were added to the cart.
+    for item_id, quantity in quantities.items():
+        item = items.get(item_id)
+        if item is None:
+            missing.append(item_id)
+            continue
+        lines.append(CartLine(
+            item_id=item.id,
+            name=item.name,
+            price=item.price,
+            quantity=quantity,
+            available_units=item.outlet_units if outlet is not None else item.available_units,
+        ))
+    return CartSnapshot(lines=lines, missing=missing)
+
+
+class CartError(Exception):
+    pass
+
+
+def add_item(cart, item, quantity, available_units=None):
+    """
+    Add ``quantity`` of ``item`` to a session cart dict, checking stock:
+    ``available_units`` if given (e.g. one outlet's), else the item's.
+    """
+    if available_units is None:
+        available_units = item.available_units
+    if quantity < 1:
+        raise CartError('Invalid quantity')
+    if available_units <= 0:
+        raise CartError('Item not available')
+    if quantity > available_units:
+        raise CartError(f'Only {available_units} units available')
+
+    key = str(item.id)
+    if cart.get(key, 0) + quantity > available_units:
+        raise CartError('Not Available')
+    cart[key] = cart.get(key, 0) + quantity
+
+
+def cart_payload(cart, outlet=None):
+    """The JSON body shared by the cart endpoints and the embedded page state."""
+    snapshot = price_cart(cart, outlet)
+    return {
+        'success': True,
+        'items': [{
+            'id': line.item_id,
+            'name': line.name,
+            'price': float(line.price),
+            'quantity': line.quantity,
+            'available': line.available,
+            'subtotal': float(line.subtotal)
+        } for line in snapshot.lines],
+        'total': float(snapshot.total),
+        'cart_count': sum(cart.values())
+    }
@@ -0,0 +1,114 @@
+import json
+import secrets
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+SESSION_KEY = 'cart'
+
+
+class BaseCartStorage:
+    """
+    Where a visitor's ``{item_id: quantity}`` cart is kept between requests.
+
+    Views call load() and save(); CartMiddleware calls update_response() so
+    backends that keep state client-side can set their cookie.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._cart = None
+        self.modified = False
+
+    def load(self):
+        if self._cart is None:
+            self._cart = self._load()
+        return self._cart
+
+    def save(self, cart):
+        self._cart = cart
+        self.modified = True
+        self._save(cart)
+
+    def clear(self):
+        self.save({})
+
+    def update_response(self, response):
+        pass
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _save(self, cart):
+        pass
+
+
+class SessionCartStorage(BaseCartStorage):
+    """The cart lives in the Django session (a database write per change)."""
+
+    def _load(self):
+        return self.request.session.get(SESSION_KEY, {})
+
+    def _save(self, cart):
+        self.request.session[SESSION_KEY] = cart
+
+
+class SignedCookieCartStorage(BaseCartStorage):
+    """The cart lives in a signed cookie, so changes never touch the server."""
+
+    salt = 'menu.cart'
+
+    def _load(self):
+        try:
+            value = self.request.get_signed_cookie(settings.CART_COOKIE_NAME, salt=self.salt)
+            cart = json.loads(value)
+        except (KeyError, signing.BadSignature, ValueError):
+            return {}
+        return cart if isinstance(cart, dict) else {}
+
+    def update_response(self, response):
+        if not self.modified:
+            return
+        if self._cart:
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME, json.dumps(self._cart, separators=(',', ':')),
+                salt=self.salt, max_age=settings.CART_COOKIE_AGE,
+                httponly=True, samesite='Lax')
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+
+
+class CacheCartStorage(BaseCartStorage):
+    """The cart lives in a cache keyed by a random id kept in a cookie."""
+
+    def __init__(self, request):
+        super().__init__(request)
+        self.cache = caches[settings.CART_CACHE_ALIAS]
+        self.cart_id = request.COOKIES.get(settings.CART_COOKIE_NAME)
+        self.new_id = False
+
+    def _key(self):
+        return f'cart:{self.cart_id}'
+
+    def _load(self):
+        if not self.cart_id:
+            return {}
+        return self.cache.get(self._key(), {})
+
+    def _save(self, cart):
+        if not self.cart_id:
+            self.cart_id = secrets.token_urlsafe(24)
+            self.new_id = True
+        self.cache.set(self._key(), cart, timeout=settings.CART_COOKIE_AGE)
+
+    def update_response(self, response):
+        if self.new_id:
+            response.set_cookie(
+                settings.CART_COOKIE_NAME, self.cart_id, max_age=settings.CART_COOKIE_AGE,
+                httponly=True, samesite='Lax')
+
+
+def get_cart_storage(request):
+    return import_string(settings.CART_STORAGE)(request)
@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import json
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import OrderEvent
+from .signals import order_placed, orders_updated
+
+logger = logging.getLogger(__name__)
+
+# Events waiting for a screen that has stopped reading are dropped oldest
+# first once this many pile up.
+MAX_PENDING_EVENTS = 100
+
+
+class Subscription:
+    def __init__(self, feed, maxsize):
+        self.feed = feed
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, message):
+        # Always runs on self.loop.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.feed.unsubscribe(self)
+
+
+class OrderFeed:
+    """
+    Publisher that fans order events out to a process's kitchen screens.
+
+    Each connected screen holds a Subscription with its own queue; a single
+    publish() reaches all of them. publish() may be called from any thread.
+
+    Events are recorded as OrderEvent rows by whichever process made the
+    change, often a task worker. With ``relay``, while any screen is
+    connected one task per feed reads the rows added since the first one
+    connected, every ORDER_FEED_POLL_INTERVAL seconds, and publishes them;
+    so screens see every process's events for one query a second, however
+    many of them there are.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_EVENTS, relay=False):
+        self.max_pending = max_pending
+        self.relay = relay
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._relay_task = None
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if self.relay and (self._relay_task is None or self._relay_task.done()):
+                self._relay_task = subscription.loop.create_task(self._run_relay(timezone.now()))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event, data):
+        message = format_event(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+            except RuntimeError:
+                # The subscriber's event loop has shut down.
+                self.unsubscribe(subscription)
+
+    def relay_events(self, after_id=None, since=None):
+        """
+        Publish the events recorded after the one with ``after_id`` (or, to
+        start, at or after ``since``). Returns the id to carry on from.
+        """
+        events = OrderEvent.objects.order_by('id')
+        if after_id is None:
+            events = events.filter(created_at__gte=since)
+        else:
+            events = events.filter(id__gt=after_id)
+        for event_id, event, data in events.values_list('id', 'event', 'data'):
+            self.publish(event, data)
+            after_id = event_id
+        return after_id
+
+    async def _run_relay(self, since):
+        after_id = None
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._relay_task = None
+                    return
+            try:
+                after_id = await sync_to_async(self.relay_events)(after_id, since)
+            except DatabaseError:
+                # e.g. the database stayed locked; the rows are still there next time
+                logger.exception('Could not read order events')
+            await asyncio.sleep(settings.ORDER_FEED_POLL_INTERVAL)
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+feed = OrderFeed(relay=True)
+
+
+def order_event_data(order, items):
+    return {
+        'id': order.id,
+        'customer_name': order.customer_name,
+        'created_at': order.created_at.isoformat(),
+        'payment_status': order.payment_status,
+        'status': order.status,
+        'outlet': order.outlet_id,
+        'items': [{'name': item.item_name, 'quantity': item.quantity} for item in items],
+        'total': str(sum(item.item_price * item.quantity for item in items)),
+        'pickup': (timezone.localtime(order.pickup_slot.start).strftime('%H:%M')
+                   if order.pickup_slot_id else ''),
+    }
+
+
+def prune_events(older_than=None):
+    """Delete events recorded more than ORDER_EVENT_KEEP seconds ago."""
+    older_than = older_than or timezone.now() - datetime.timedelta(seconds=settings.ORDER_EVENT_KEEP)
+    latest = OrderEvent.objects.order_by('-id').values_list('id', flat=True).first()
+    # The newest row is kept so that ids, which relays carry on from, are never reused
+    deleted, _ = OrderEvent.objects.filter(created_at__lt=older_than).exclude(id=latest).delete()
+    return deleted
+
+
+# Recorded rather than published here: the change may have been made by a
+# task worker, which has no screens of its own. These run inside the
+# change's transaction; SQLite runs one write transaction at a time, so
+# rows commit in id order and a relay never skips one.
+@receiver(order_placed)
+def _record_order_placed(sender, order, items, **kwargs):
+    OrderEvent.objects.create(event='order.created', data=order_event_data(order, items))
+
+
+@receiver(orders_updated)
+def _record_orders_updated(sender, order_ids, changes, **kwargs):
+    OrderEvent.objects.bulk_create([
+        OrderEvent(event='order.updated', data={'id': order_id, **changes})
+        for order_id in order_ids
+    ])
@@ -0,0 +1,128 @@
+import hashlib
+import io
+import os
+
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from .models import MenuItem
+
+VARIANT_DIR = 'menu_images/variants'
+
+# Variant extension -> Pillow format. WebP goes last so that its largest
+# width existing means the whole set has been written.
+FORMATS = {
+    'jpg': 'JPEG',
+    'webp': 'WEBP',
+}
+
+
+def content_hash(file):
+    """sha256 of an uploaded or stored file, read in chunks."""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(64 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def canonical_name(digest, filename):
+    """Storage name shared by every upload with the same content."""
+    ext = os.path.splitext(filename)[1].lower() or '.jpg'
+    return f'{MenuItem.image.field.upload_to}{digest}{ext}'
+
+
+def variant_name(digest, width, ext):
+    return f'{VARIANT_DIR}/{digest}-{width}.{ext}'
+
+
+def variants_exist(digest):
+    return default_storage.exists(
+        variant_name(digest, settings.MENU_IMAGE_WIDTHS[-1], 'webp'))
+
+
+def generate_variants(source_name, digest, force=False):
+    """
+    Write resized WebP and JPEG copies of a stored image for every width in
+    MENU_IMAGE_WIDTHS. Images are never upscaled, so small originals give
+    variants no wider than themselves. Returns the number of files written.
+    """
+    if not force and variants_exist(digest):
+        return 0
+
+    with default_storage.open(source_name, 'rb') as f:
+        image = Image.open(f)
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    written = 0
+    for ext, format in FORMATS.items():
+        for width in settings.MENU_IMAGE_WIDTHS:
+            resized = image.copy()
+            resized.thumbnail((width, width * 4), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, format=format, quality=settings.MENU_IMAGE_QUALITY,
+                         optimize=True)
+            name = variant_name(digest, width, ext)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+            written += 1
+    return written
+
+
+def image_sources(item):
+    """
+    Template context for a menu item's picture: a ``srcset`` per format and
+    the fallback ``src``. Items whose variants are not known fall back to
+    the original upload.
+    """
+    if not item.image:
+        return None
+    if not item.image_hash:
+        return {'src': item.image.url}
+
+    srcsets = {
+        ext: ', '.join(
+            f'{default_storage.url(variant_name(item.image_hash, width, ext))} {width}w'
+            for width in settings.MENU_IMAGE_WIDTHS
+        )
+        for ext in FORMATS
+    }
+    srcsets['src'] = default_storage.url(
+        variant_name(item.image_hash, settings.MENU_IMAGE_WIDTHS[0], 'jpg'))
+    return srcsets
+
+
+@receiver(pre_save, sender=MenuItem)
+def _dedupe_upload(sender, instance, raw=False, **kwargs):
+    image = instance.image
+    if raw:
+        return
+    if not image:
+        instance.image_hash = ''
+        return
+    if image._committed:
+        return
+
+    # A new upload: store it under its content hash, or point at the copy
+    # that is already there instead of saving it again.
+    digest = content_hash(image.file)
+    name = canonical_name(digest, image.name)
+    instance.image_hash = digest
+    if default_storage.exists(name):
+        image.name = name
+        image._committed = True
+    else:
+        image.name = os.path.basename(name)
+
+
+@receiver(post_save, sender=MenuItem)
+def _generate_upload_variants(sender, instance, raw=False, **kwargs):
+    if not raw and instance.image and instance.image_hash:
+        generate_variants(instance.image.name, instance.image_hash)
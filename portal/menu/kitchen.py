@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+from .signals import orders_updated
+
+# Keep each IN (...) lookup well below SQLite's bound-parameter limit.
+BATCH_SIZE = 900
+
+
+def advance_orders(order_ids, status):
+    """
+    Move ``order_ids`` on to ``status`` and stamp its timestamp field.
+    Orders that aren't in the status before it (already moved, or skipped
+    ahead) are left alone. Returns the ids that were moved.
+    """
+    previous = Order.PREVIOUS_STATUS[status]
+    changes = {'status': status}
+    if status in Order.STATUS_TIMESTAMPS:
+        changes[Order.STATUS_TIMESTAMPS[status]] = timezone.now()
+
+    order_ids = list(order_ids)
+    moved = []
+    with transaction.atomic():
+        for start in range(0, len(order_ids), BATCH_SIZE):
+            batch = Order.objects.select_for_update().filter(
+                id__in=order_ids[start:start + BATCH_SIZE], status=previous)
+            ids = list(batch.values_list('id', flat=True))
+            if ids:
+                Order.objects.filter(id__in=ids).update(**changes)
+                moved.extend(ids)
+        if moved:
+            orders_updated.send(sender=Order, order_ids=moved, changes={'status': status})
+    return moved
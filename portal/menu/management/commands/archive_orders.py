@@ -0,0 +1,43 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from menu.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = (
+        'Move finished orders older than a cutoff out of the database into gzipped JSONL files, '
+        'one set per month, under ORDER_ARCHIVE_DIR.'
+    )
+
+    def add_arguments(self, parser):
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument('--before', type=datetime.date.fromisoformat,
+                            help='Archive orders created before this local date (YYYY-MM-DD).')
+        cutoff.add_argument('--older-than-days', type=int,
+                            help='Archive orders created more than this many days ago.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Orders fetched per query while streaming.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Orders deleted per transaction.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Write the archive files but leave the orders in the database.')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            cutoff = timezone.make_aware(
+                datetime.datetime.combine(options['before'], datetime.time.min))
+        else:
+            if options['older_than_days'] < 1:
+                raise CommandError('--older-than-days must be at least 1.')
+            cutoff = timezone.now() - datetime.timedelta(days=options['older_than_days'])
+
+        report = archive_orders(cutoff, chunk_size=options['chunk_size'],
+                                batch_size=options['batch_size'], delete=not options['keep'])
+        for path in report.files:
+            self.stdout.write(f'  {path}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {report.orders} orders into {len(report.files)} files; '
+            f'deleted {report.deleted} from the database.'))
@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from menu.images import canonical_name, content_hash, generate_variants
+from menu.menu_cache import bump_version
+from menu.models import MenuItem
+
+
+def _hash_file(name):
+    try:
+        with default_storage.open(name, 'rb') as f:
+            return name, content_hash(f)
+    except OSError:
+        return name, None
+
+
+def _generate(name, digest, force):
+    return generate_variants(name, digest, force=force)
+
+
+class Command(BaseCommand):
+    help = (
+        'Store existing menu images once per distinct content and generate their '
+        'resized variants, using a pool of worker processes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants that already exist.')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete original files no menu item uses any more.')
+
+    def handle(self, *args, **options):
+        items = list(MenuItem.objects.exclude(image='').exclude(image=None)
+                     .only('id', 'image', 'image_hash'))
+        names = {item.image.name for item in items}
+
+        # Workers only touch storage; django.setup() is needed where the
+        # platform spawns them instead of forking.
+        with ProcessPoolExecutor(max_workers=options['workers'],
+                                 initializer=django.setup) as pool:
+            hashes = dict(pool.map(_hash_file, names))
+
+            canonical = {}
+            for name in sorted(names):
+                digest = hashes[name]
+                if digest is None:
+                    self.stderr.write(f'Missing image file: {name}')
+                elif digest not in canonical:
+                    canonical[digest] = self._store_canonical(name, digest)
+
+            written = sum(pool.map(
+                _generate, canonical.values(), canonical.keys(),
+                [options['force']] * len(canonical)))
+
+        changed = []
+        for item in items:
+            digest = hashes[item.image.name]
+            if digest and (item.image.name, item.image_hash) != (canonical[digest], digest):
+                item.image.name = canonical[digest]
+                item.image_hash = digest
+                changed.append(item)
+        MenuItem.objects.bulk_update(changed, ['image', 'image_hash'])
+        if changed:
+            bump_version()
+
+        pruned = 0
+        if options['prune']:
+            in_use = set(canonical.values())
+            for name in names - in_use:
+                if hashes[name] and default_storage.exists(name):
+                    default_storage.delete(name)
+                    pruned += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(names)} files, {len(canonical)} distinct images, {len(changed)} items '
+            f'updated, {written} variants written, {pruned} duplicates deleted.'))
+
+    def _store_canonical(self, name, digest):
+        target = canonical_name(digest, name)
+        if name != target and not default_storage.exists(target):
+            with default_storage.open(name, 'rb') as f:
+                target = default_storage.save(target, f)
+        return target
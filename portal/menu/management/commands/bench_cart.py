@@ -0,0 +1,54 @@
+import json
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from menu.benchutils import benchmark_database, summarize
+from menu.models import MenuItem
+
+BACKENDS = {
+    'session': 'menu.cart_storage.SessionCartStorage',
+    'signed-cookie': 'menu.cart_storage.SignedCookieCartStorage',
+    'cache': 'menu.cart_storage.CacheCartStorage',
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare add/remove-from-cart throughput across the cart storage backends.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mutations', type=int, default=500)
+        parser.add_argument('--backend', choices=list(BACKENDS), action='append',
+                            help='Benchmark only these backends (repeatable).')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            items = [
+                MenuItem.objects.create(name=f'Dish {i}', price=Decimal('50'), category='food',
+                                        available_units=10 ** 6)
+                for i in range(10)
+            ]
+            for name in options['backend'] or BACKENDS:
+                with override_settings(CART_STORAGE=BACKENDS[name], RATE_LIMIT_ENABLED=False):
+                    self.run(name, items, options['mutations'])
+
+    def run(self, name, items, n):
+        client = Client()
+        add_url, remove_url = reverse('add_to_cart'), reverse('remove_from_cart')
+        timings = []
+        start = time.perf_counter()
+        for i in range(n):
+            item = items[i % len(items)]
+            # Alternate adds and removes so the cart stays small
+            url, body = ((add_url, {'item_id': str(item.id), 'quantity': 1}) if i % 4 < 3
+                         else (remove_url, {'item_id': str(item.id)}))
+            t0 = time.perf_counter()
+            client.post(url, json.dumps(body), content_type='application/json')
+            timings.append((time.perf_counter() - t0) * 1000)
+        elapsed = time.perf_counter() - start
+        stats = summarize(timings)
+        self.stdout.write(
+            f"{name}: {n / elapsed:.0f} mutations/s p50={stats['p50']:.2f}ms p95={stats['p95']:.2f}ms")
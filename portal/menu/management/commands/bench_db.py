@@ -0,0 +1,94 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+
+from menu.benchutils import benchmark_database, summarize
+from menu.cart import price_cart
+from menu.models import MenuItem
+from menu.stock import place_order
+
+# SQLite options for the profile settings.py shipped with before, to
+# compare against whatever DATABASES currently configures.
+LEGACY_SQLITE_OPTIONS = {}
+
+
+class Command(BaseCommand):
+    help = (
+        'Load the ordering path from several threads against a throwaway copy of the '
+        'configured database and report throughput and lock errors.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--orders', type=int, default=200, help='Orders per worker.')
+        parser.add_argument('--compare-legacy', action='store_true',
+                            help='SQLite only: also run with the old default options.')
+
+    def handle(self, *args, **options):
+        profiles = [('configured', connection.settings_dict.get('OPTIONS', {}))]
+        if options['compare_legacy']:
+            if connection.vendor != 'sqlite':
+                raise CommandError('--compare-legacy only applies to SQLite.')
+            profiles.insert(0, ('legacy', LEGACY_SQLITE_OPTIONS))
+
+        original = connection.settings_dict.get('OPTIONS', {})
+        try:
+            for name, db_options in profiles:
+                connection.settings_dict['OPTIONS'] = db_options
+                connection.close()
+                self.run(name, options['workers'], options['orders'])
+        finally:
+            connection.settings_dict['OPTIONS'] = original
+
+    def run(self, name, workers, orders):
+        with benchmark_database():
+            items = [
+                MenuItem.objects.create(name=f'Dish {i}', price=Decimal('50'), category='food',
+                                        available_units=10 ** 6)
+                for i in range(5)
+            ]
+            cart = {str(item.id): 1 for item in items[:3]}
+            timings, errors = [], []
+            lock = threading.Lock()
+
+            def worker():
+                local_timings, local_errors = [], 0
+                try:
+                    for _ in range(orders):
+                        t0 = time.perf_counter()
+                        try:
+                            place_order(price_cart(cart), 'Load test')
+                        except OperationalError:
+                            local_errors += 1
+                            continue
+                        local_timings.append((time.perf_counter() - t0) * 1000)
+                finally:
+                    connections.close_all()
+                with lock:
+                    timings.extend(local_timings)
+                    errors.append(local_errors)
+
+            threads = [threading.Thread(target=worker) for _ in range(workers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            journal = self.journal_mode()
+            stats = summarize(timings)
+            self.stdout.write(
+                f"{name} ({connection.vendor}{', journal=' + journal if journal else ''}): "
+                f"{len(timings) / elapsed:.0f} orders/s, {sum(errors)} lock errors, "
+                f"p50={stats['p50']:.2f}ms p95={stats['p95']:.2f}ms")
+
+    def journal_mode(self):
+        if connection.vendor != 'sqlite':
+            return ''
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            return cursor.fetchone()[0]
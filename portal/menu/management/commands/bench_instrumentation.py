@@ -0,0 +1,39 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from menu.benchutils import benchmark_database, summarize
+from menu.models import MenuItem
+
+
+class Command(BaseCommand):
+    help = 'Measure the overhead of InstrumentationMiddleware at different sample rates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per rate and URL.')
+
+    def handle(self, *args, **options):
+        rates = (0.0, 0.1, 1.0)
+        with benchmark_database():
+            for i in range(10):
+                MenuItem.objects.create(name=f'Dish {i}', price=Decimal('50'), category='food',
+                                        available_units=100)
+            client = Client()
+            for url in (reverse('menu'), reverse('get_cart')):
+                client.get(url)
+                timings = {rate: [] for rate in rates}
+                # Interleave the rates so drift in machine speed hits them all alike
+                for _ in range(options['requests']):
+                    for rate in rates:
+                        with override_settings(INSTRUMENTATION_SAMPLE_RATE=rate,
+                                               RATE_LIMIT_ENABLED=False):
+                            start = time.perf_counter()
+                            client.get(url)
+                            timings[rate].append((time.perf_counter() - start) * 1000)
+                base = summarize(timings[0.0])['p50']
+                for rate in rates:
+                    p50 = summarize(timings[rate])['p50']
+                    self.stdout.write(f'{url} rate={rate}: p50={p50:.3f}ms ({(p50 / base - 1) * 100:+.1f}%)')
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from menu.menu_cache import bump_version
+
+
+class Command(BaseCommand):
+    help = 'Measure menu page requests per second with and without the fragment cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        n = options['requests']
+        client = Client()
+        url = reverse('menu')
+
+        for label, enabled in [('uncached', False), ('cached', True)]:
+            with override_settings(MENU_CACHE_ENABLED=enabled):
+                bump_version()
+                client.get(url)  # warm up templates and, if enabled, the cache
+                start = time.perf_counter()
+                for _ in range(n):
+                    client.get(url)
+                elapsed = time.perf_counter() - start
+            self.stdout.write(f'{label}: {n / elapsed:.0f} req/s ({elapsed * 1000 / n:.2f} ms/request)')
@@ -0,0 +1,75 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from menu.benchutils import benchmark_database, summarize
+from menu.menu_cache import bump_version
+from menu.models import MenuItem
+from menu.search import index
+
+DISHES = ['pilau', 'chapati', 'ugali', 'githeri', 'mukimo', 'biryani', 'samosa', 'mandazi',
+          'sukuma', 'matoke', 'omena', 'nyama', 'chips', 'rice', 'beans', 'ndengu']
+EXTRAS = ['chicken', 'beef', 'fish', 'vegetable', 'masala', 'coconut', 'special', 'fried']
+TAGS = ['vegetarian', 'vegan', 'halal', 'spicy', 'gluten-free', 'special', 'breakfast']
+STATIONS = ['Grill', 'Stew pots', 'Juice bar', 'Bakery', 'Fryer']
+# What students type: prefixes of a word, typos and several words
+QUERIES = ['p', 'pi', 'pil', 'pilau', 'chik', 'chiken', 'biryni', 'beef pil', 'veg', 'vegan rice',
+           'coconut b', 'spicy', 'mandazi', 'samosa beef', 'zzz']
+
+
+class Command(BaseCommand):
+    help = 'Measure search-as-you-type queries on the in-memory index against LIKE scans.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--rounds', type=int, default=200)
+
+    def handle(self, *args, **options):
+        rng = random.Random(1)
+        with benchmark_database():
+            MenuItem.objects.bulk_create([
+                MenuItem(name=f'{rng.choice(EXTRAS).title()} {rng.choice(DISHES).title()} {i}',
+                         price=Decimal(40 + 5 * (i % 12)), category='beverage' if i % 5 == 0 else 'food',
+                         available_units=10, station=rng.choice(STATIONS),
+                         tags=', '.join(rng.sample(TAGS, 2)))
+                for i in range(options['items'])
+            ])
+            bump_version()
+            start = time.perf_counter()
+            index.rebuild()
+            self.stdout.write(f'rebuild: {(time.perf_counter() - start) * 1000:.1f}ms '
+                              f'for {options["items"]} items, {len(index.words)} words')
+
+            timings = {'index': [], 'like': []}
+            for _ in range(options['rounds']):
+                for query in QUERIES:
+                    start = time.perf_counter()
+                    index.search(query)
+                    timings['index'].append((time.perf_counter() - start) * 1000)
+
+                    start = time.perf_counter()
+                    condition = Q()
+                    for word in query.split():
+                        condition &= Q(name__icontains=word) | Q(tags__icontains=word)
+                    list(MenuItem.objects.filter(condition).values_list('id', flat=True)[:20])
+                    timings['like'].append((time.perf_counter() - start) * 1000)
+            for label, values in timings.items():
+                stats = summarize(values)
+                self.stdout.write(f'{label}: p50={stats["p50"]:.3f}ms p99={stats["p99"]:.3f}ms')
+
+            client = Client()
+            url = reverse('menu_search')
+            endpoint = []
+            with override_settings(RATE_LIMIT_ENABLED=False):
+                for _ in range(options['rounds'] // 10 or 1):
+                    for query in QUERIES:
+                        start = time.perf_counter()
+                        client.get(url, {'q': query})
+                        endpoint.append((time.perf_counter() - start) * 1000)
+            stats = summarize(endpoint)
+            self.stdout.write(f'endpoint: p50={stats["p50"]:.3f}ms p99={stats["p99"]:.3f}ms')
@@ -0,0 +1,225 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from menu.benchutils import (
+    benchmark_database, find_regressions, make_menu, make_orders, make_slots, summarize,
+)
+from menu.mpesa_fake import FakeMpesaServer
+
+ENDPOINTS = ['menu_view', 'add_to_cart', 'get_cart', 'checkout_view', 'confirm_order', 'order_list']
+CART_SIZE = 3
+
+
+class Student:
+    """One simulated student: a browser session going through the ordering flow."""
+
+    def __init__(self, number, items, slot):
+        self.client = Client()
+        self.number = number
+        self.items = items
+        self.slot = slot
+        self.added = 0
+        self.timings = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = 0
+
+    def request(self, name, method, url, record=True, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            try:
+                response = getattr(self.client, method)(url, **kwargs)
+            except OperationalError:
+                self.errors += 1
+                return None
+            elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            self.errors += 1
+            return None
+        if record:
+            self.timings[name].append(elapsed)
+            self.queries[name].append(len(queries))
+        return response
+
+    def discard_first(self, name):
+        # The first request of each kind pays for cold caches and templates
+        for samples in (self.timings, self.queries):
+            if samples[name]:
+                samples[name].pop(0)
+
+    def menu_view(self):
+        self.request('menu_view', 'get', reverse('menu'))
+
+    def add_to_cart(self, record=True):
+        item = self.items[(self.number + self.added) % len(self.items)]
+        self.added += 1
+        self.request('add_to_cart', 'post', reverse('add_to_cart'), record=record,
+                     data=json.dumps({'item_id': str(item.id), 'quantity': 1}),
+                     content_type='application/json')
+
+    def get_cart(self):
+        self.request('get_cart', 'get', reverse('get_cart'))
+
+    def checkout_view(self):
+        self.request('checkout_view', 'get', reverse('checkout'))
+
+    def confirm_order(self):
+        self.request('confirm_order', 'post', reverse('confirm_order'), data={
+            'name': f'Student {self.number}', 'phone': '254700000000',
+            'pickup_slot': str(self.slot.id),
+        })
+
+    def order_list(self):
+        self.request('order_list', 'get', reverse('order_list'))
+
+    def order_flow(self):
+        self.menu_view()
+        for _ in range(CART_SIZE):
+            self.add_to_cart()
+        self.get_cart()
+        self.checkout_view()
+        self.confirm_order()
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the ordering endpoints against synthetic data in a throwaway database, '
+        'with M-Pesa stubbed, and compare latency percentiles and query counts with a '
+        'saved baseline. --students adds a concurrent load of simulated students.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint.')
+        parser.add_argument('--items', type=int, default=40, help='Menu items to generate.')
+        parser.add_argument('--orders', type=int, default=20000,
+                            help='Past orders to generate for the order list.')
+        parser.add_argument('--students', type=int, default=0,
+                            help='Also run this many students ordering at once.')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Orders each concurrent student places.')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'bench-baseline.json'),
+                            help='JSON file the results are saved to and checked against.')
+        parser.add_argument('--save', action='store_true', help='Save the results as the baseline.')
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if an endpoint regressed against the baseline.')
+        parser.add_argument('--threshold', type=float, default=25,
+                            help='p95 slowdown, in percent, that --check tolerates.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['check']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except FileNotFoundError:
+                raise CommandError(f"No baseline at {options['baseline']}; run with --save first.")
+
+        server = FakeMpesaServer().start()
+        try:
+            # STK pushes go to the local fake, inside the request, so they are timed too.
+            # Every simulated student shares one IP, so the rate limits would only get in the way.
+            with benchmark_database(), override_settings(
+                    MPESA_BASE_URL=server.url, TASKS_EAGER=True, RATE_LIMIT_ENABLED=False):
+                items = make_menu(options['items'])
+                slot, = make_slots(1)
+                now = timezone.now()
+                make_orders(options['orders'], now - datetime.timedelta(days=30), now)
+                staff = User.objects.create_user('bench-staff', is_staff=True)
+
+                results = {'endpoints': self.run_endpoints(items, slot, staff, options['requests'])}
+                if options['students']:
+                    results['load'] = self.run_load(items, slot, options['students'], options['rounds'])
+        finally:
+            server.stop()
+
+        if options['save']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Saved baseline to {options['baseline']}")
+        if baseline is not None:
+            problems = find_regressions(baseline['endpoints'], results['endpoints'],
+                                        threshold=options['threshold'] / 100)
+            if problems:
+                raise CommandError('Regressions against the baseline:\n  ' + '\n  '.join(problems))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
+
+    def report(self, stats):
+        return (f"p50={stats['p50']:.2f}ms p95={stats['p95']:.2f}ms p99={stats['p99']:.2f}ms "
+                f"queries={stats['queries']}")
+
+    def collect(self, students):
+        endpoints = {}
+        for name in ENDPOINTS:
+            timings = [t for student in students for t in student.timings[name]]
+            if timings:
+                endpoints[name] = dict(summarize(timings), queries=max(
+                    q for student in students for q in student.queries[name]))
+        return endpoints
+
+    def run_endpoints(self, items, slot, staff, n):
+        student = Student(0, items, slot)
+        staff_member = Student(1, items, slot)
+        staff_member.client.force_login(staff)
+        steps = {
+            'menu_view': student.menu_view,
+            'add_to_cart': student.add_to_cart,
+            'get_cart': student.get_cart,
+            'checkout_view': student.checkout_view,
+            'confirm_order': student.confirm_order,
+            'order_list': staff_member.order_list,
+        }
+        for name, step in steps.items():
+            for _ in range(n + 1):
+                if name == 'confirm_order':
+                    # Every order empties the cart, so refill it untimed
+                    for _ in range(CART_SIZE):
+                        student.add_to_cart(record=False)
+                step()
+            student.discard_first(name)
+            staff_member.discard_first(name)
+
+        if student.errors or staff_member.errors:
+            raise CommandError(f'{student.errors + staff_member.errors} requests failed.')
+        endpoints = self.collect([student, staff_member])
+        for name, stats in endpoints.items():
+            self.stdout.write(f'{name:>14}: {self.report(stats)}')
+        return endpoints
+
+    def run_load(self, items, slot, students, rounds):
+        crowd = [Student(n, items, slot) for n in range(students)]
+
+        def worker(student):
+            try:
+                for _ in range(rounds):
+                    student.order_flow()
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(student,)) for student in crowd]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        endpoints = self.collect(crowd)
+        orders = endpoints.get('confirm_order', {}).get('count', 0)
+        errors = sum(student.errors for student in crowd)
+        self.stdout.write(f'{students} students: {orders / elapsed:.1f} orders/s, {errors} errors')
+        for name, stats in endpoints.items():
+            self.stdout.write(f'{name:>14}: {self.report(stats)}')
+        return {'students': students, 'orders_per_second': orders / elapsed, 'errors': errors,
+                'endpoints': endpoints}
@@ -0,0 +1,50 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from menu.models import PickupSlot
+
+
+def _time(value):
+    try:
+        return datetime.time.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Invalid time: {value!r} (expected HH:MM)')
+
+
+class Command(BaseCommand):
+    help = 'Create pickup slots of a fixed length and capacity between opening and closing time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=datetime.date.fromisoformat,
+                            help='First day (YYYY-MM-DD); defaults to today.')
+        parser.add_argument('--days', type=int, default=1)
+        parser.add_argument('--open', default='07:00')
+        parser.add_argument('--close', default='20:00')
+        parser.add_argument('--minutes', type=int, default=15, help='Slot length.')
+        parser.add_argument('--capacity', type=int, default=20, help='Orders per slot.')
+
+    def handle(self, *args, **options):
+        opening, closing = _time(options['open']), _time(options['close'])
+        if opening >= closing or options['minutes'] < 1:
+            raise CommandError('Nothing to create: check --open, --close and --minutes.')
+
+        first_day = options['date'] or timezone.localdate()
+        length = datetime.timedelta(minutes=options['minutes'])
+        slots = []
+        for offset in range(options['days']):
+            day = first_day + datetime.timedelta(days=offset)
+            start = timezone.make_aware(datetime.datetime.combine(day, opening))
+            close = timezone.make_aware(datetime.datetime.combine(day, closing))
+            while start + length <= close:
+                slots.append(PickupSlot(start=start, end=start + length,
+                                        capacity=options['capacity']))
+                start += length
+
+        # Slots that already exist keep their capacity and bookings
+        before = PickupSlot.objects.count()
+        PickupSlot.objects.bulk_create(slots, ignore_conflicts=True)
+        created = PickupSlot.objects.count() - before
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} pickup slots ({len(slots) - created} already existed).'))
@@ -0,0 +1,69 @@
+import statistics
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+
+from menu.mpesa import STK_PUSH_PATH, TOKEN_PATH, MpesaClient
+from menu.mpesa_fake import FakeMpesaServer
+
+
+def legacy_push(base_url, phone, amount):
+    # What initiate_mpesa_payment used to do: a fresh token and connection
+    # for every single push.
+    token = requests.get(base_url + TOKEN_PATH, auth=('key', 'secret')).json()['access_token']
+    return requests.post(base_url + STK_PUSH_PATH, json={'PhoneNumber': phone, 'Amount': amount},
+                         headers={'Authorization': f'Bearer {token}'}).json()
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake M-Pesa (Daraja) server, or benchmark the client against it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds to delay every response.')
+        parser.add_argument('--response-code', default='0')
+        parser.add_argument('--bench', type=int, default=0, metavar='N',
+                            help='Time N STK pushes with and without token caching, then exit.')
+
+    def handle(self, *args, **options):
+        server = FakeMpesaServer(
+            host=options['host'],
+            port=0 if options['bench'] else options['port'],
+            latency=options['latency'],
+            response_code=options['response_code'],
+        )
+        if options['bench']:
+            with server:
+                self.benchmark(server, options['bench'])
+            return
+
+        self.stdout.write(f'Fake M-Pesa listening on {server.url} (set MPESA_BASE_URL to use it)')
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.httpd.server_close()
+
+    def benchmark(self, server, n):
+        client = MpesaClient(server.url, 'key', 'secret', '174379', 'passkey',
+                             'http://localhost/callback', timeout=10)
+        runs = {
+            'legacy (token per push)': lambda: legacy_push(server.url, '254700000000', 1),
+            'cached token + pooled session': lambda: client.stk_push('254700000000', 1),
+        }
+        for label, push in runs.items():
+            server.token_requests = 0
+            timings = []
+            for _ in range(n):
+                start = time.perf_counter()
+                push()
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f'{label}: p50={statistics.median(timings):.2f}ms p95={p95:.2f}ms '
+                f'token requests={server.token_requests}')
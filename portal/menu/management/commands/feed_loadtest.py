@@ -0,0 +1,53 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from menu.feed import OrderFeed
+
+
+class Command(BaseCommand):
+    help = 'Fan events out to many simulated kitchen screens and report delivery latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=500)
+        parser.add_argument('--events', type=int, default=50)
+        parser.add_argument('--interval', type=float, default=0.01,
+                            help='Seconds between published events.')
+
+    def handle(self, *args, **options):
+        latencies = asyncio.run(self.run(options['subscribers'], options['events'], options['interval']))
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f"{options['subscribers']} subscribers x {options['events']} events: "
+            f"delivered={len(latencies)} p50={statistics.median(latencies):.2f}ms "
+            f"p99={p99:.2f}ms max={latencies[-1]:.2f}ms")
+
+    async def run(self, subscribers, events, interval):
+        feed = OrderFeed(max_pending=events)
+        latencies = []
+
+        async def screen(subscription):
+            with subscription:
+                for _ in range(events):
+                    message = await subscription.get()
+                    sent = json.loads(message.split('data: ', 1)[1])['sent']
+                    latencies.append((time.perf_counter() - sent) * 1000)
+
+        screens = [asyncio.create_task(screen(feed.subscribe())) for _ in range(subscribers)]
+
+        # Publish from another thread, as synchronous views do under ASGI.
+        def publish():
+            for seq in range(events):
+                feed.publish('order.created', {'id': seq, 'sent': time.perf_counter()})
+                time.sleep(interval)
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        await asyncio.gather(*screens)
+        publisher.join()
+        return latencies
@@ -0,0 +1,19 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from menu.analytics import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Recompute the sales rollups from the orders table, for all dates or a range.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=datetime.date.fromisoformat,
+                            help='First local date to rebuild (YYYY-MM-DD).')
+        parser.add_argument('--end', type=datetime.date.fromisoformat,
+                            help='Last local date to rebuild (YYYY-MM-DD).')
+
+    def handle(self, *args, **options):
+        written = rebuild(options['start'], options['end'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} sales rollup rows.'))
@@ -0,0 +1,52 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from menu.payments import BATCH_SIZE, PaymentResult, apply_payment_results
+
+
+def read_results(path, fmt):
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield PaymentResult.from_row(row)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield PaymentResult.from_callback(json.loads(line))
+
+
+class Command(BaseCommand):
+    help = (
+        'Settle pending orders from saved STK callbacks (one JSON body per line) '
+        'or a statement CSV with CheckoutRequestID, ResultCode and Amount columns.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['jsonl', 'csv'],
+                            help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        try:
+            report = apply_payment_results(read_results(path, fmt), batch_size=options['batch_size'])
+        except OSError as e:
+            raise CommandError(e)
+        except (KeyError, ValueError) as e:
+            raise CommandError(f'Malformed record in {path}: {e!r}')
+
+        self.stdout.write(
+            f'paid={report.paid} failed={report.failed} '
+            f'duplicates={report.duplicates} unmatched={len(report.unmatched)} '
+            f'mismatched={len(report.mismatched)}')
+        for checkout_request_id in report.unmatched[:20]:
+            self.stdout.write(f'  unmatched: {checkout_request_id}')
+        for checkout_request_id in report.mismatched[:20]:
+            self.stdout.write(f'  amount differs: {checkout_request_id}')
+        if report.unmatched or report.mismatched:
+            self.stdout.write('These are kept as held payments in the admin.')
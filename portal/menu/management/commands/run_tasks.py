@@ -0,0 +1,93 @@
+import logging
+import signal
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+
+from menu import tasks
+from menu.feed import prune_events
+
+logger = logging.getLogger(__name__)
+
+# How often to delete old finished tasks and order events, in seconds
+PRUNE_INTERVAL = 60 * 60
+
+
+def run_in_thread(task_row):
+    # Each pool thread has its own database connection
+    close_old_connections()
+    try:
+        return tasks.run(task_row)
+    except Exception:
+        # Left running; claimed again once its lock runs out
+        logger.exception('Could not run task %s', task_row.id)
+        return 'error'
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background tasks (STK pushes, stock alerts, sales rollups) on a '
+        'thread pool. Start more than one to use more processes; each task runs once.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.TASK_WORKERS)
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once nothing is due, instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        threads = max(options['threads'], 1)
+        worker = tasks.new_worker_id()
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            # Finish what is running, claim nothing new
+            stopping.set()
+
+        self.stdout.write(f'Worker {worker} running tasks on {threads} threads')
+        handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            counts = self.work(worker, threads, stopping, options['burst'])
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write(' '.join(f'{status}={count}' for status, count in sorted(counts.items()))
+                          or 'No tasks run')
+
+    def work(self, worker, threads, stopping, burst):
+        counts = Counter()
+        running = set()
+        next_prune = 0
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='task') as pool:
+            while not stopping.is_set():
+                claimed = []
+                try:
+                    if time.monotonic() >= next_prune:
+                        tasks.prune()
+                        prune_events()
+                        next_prune = time.monotonic() + PRUNE_INTERVAL
+                    if len(running) < threads:
+                        claimed = tasks.claim(threads - len(running), worker)
+                except DatabaseError:
+                    # e.g. the database stayed locked past its timeout; try again
+                    logger.exception('Could not claim tasks')
+                    close_old_connections()
+                running.update(pool.submit(run_in_thread, task_row) for task_row in claimed)
+
+                if burst and not running:
+                    break
+                if running:
+                    done, running = wait(running, timeout=settings.TASK_POLL_INTERVAL,
+                                         return_when=FIRST_COMPLETED)
+                    counts.update(future.result() for future in done)
+                elif not claimed:
+                    stopping.wait(settings.TASK_POLL_INTERVAL)
+            counts.update(future.result() for future in running)
+        return counts
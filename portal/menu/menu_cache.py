@@ -0,0 +1,159 @@
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .images import image_sources
+from .models import Announcement, MenuItem, MenuVersion, Outlet
+from .outlets import in_stock_ids
+
+VERSION_ROW = 1
+
+DEFAULT_IMAGES = {
+    'food': 'images/default-food.jpg',
+    'beverage': 'images/default-beverage.jpg',
+}
+
+# Card widths from style.css: one column on phones, two or more columns on
+# tablets, and ~290px columns inside the 1200px desktop container.
+IMAGE_SIZES = '(max-width: 480px) 100vw, (max-width: 768px) 50vw, 300px'
+
+ANNOUNCEMENTS_SHOWN = 5
+
+
+def get_cache():
+    return caches[settings.MENU_CACHE_ALIAS]
+
+
+def _fresh_version():
+    # A new database starts the counter from the clock, never from a value
+    # whose fragments may still be in the cache
+    return time.time_ns()
+
+
+def get_version():
+    version = MenuVersion.objects.filter(id=VERSION_ROW).values_list('version', flat=True).first()
+    if version is None:
+        row, _ = MenuVersion.objects.get_or_create(id=VERSION_ROW, defaults={'version': _fresh_version()})
+        version = row.version
+    return version
+
+
+def bump_version():
+    """
+    Move the menu on to its next version and return it. One UPDATE of the
+    version row, so concurrent bumps from any process never share a value;
+    inside a transaction the bump commits, or rolls back, with it.
+    """
+    with transaction.atomic():
+        # With no row yet, the one get_version creates is already new
+        MenuVersion.objects.filter(id=VERSION_ROW).update(version=F('version') + 1)
+        return get_version()
+
+
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+@receiver(post_save, sender=Announcement)
+@receiver(post_delete, sender=Announcement)
+@receiver(post_save, sender=Outlet)
+@receiver(post_delete, sender=Outlet)
+def _invalidate_menu(sender, **kwargs):
+    bump_version()
+
+
+def shown_announcements():
+    return Announcement.objects.filter(is_active=True).order_by('-created_at')[:ANNOUNCEMENTS_SHOWN]
+
+
+def _render_announcements():
+    return render_to_string('partials/announcements.html', {'announcements': shown_announcements()})
+
+
+def _render_category(category):
+    # Every item is rendered, whatever its stock; availability is applied
+    # per request so stock changes never force a re-render.
+    default_image = DEFAULT_IMAGES.get(category, DEFAULT_IMAGES['food'])
+    return [
+        (item.id, render_to_string('partials/menu_item.html', {
+            'item': item,
+            'image': image_sources(item),
+            'image_sizes': IMAGE_SIZES,
+            'default_image': default_image,
+        }))
+        for item in MenuItem.objects.filter(category=category)
+    ]
+
+
+def _outlet_choices():
+    return list(Outlet.objects.filter(is_active=True).values_list('slug', 'name'))
+
+
+FRAGMENTS = {
+    'announcements': _render_announcements,
+    'outlets': _outlet_choices,
+    'food': partial(_render_category, 'food'),
+    'beverage': partial(_render_category, 'beverage'),
+}
+
+
+def _get_fragments():
+    if not settings.MENU_CACHE_ENABLED:
+        return {name: render() for name, render in FRAGMENTS.items()}
+
+    cache = get_cache()
+    version = get_version()
+    keys = {name: f'menu:{version}:{name}' for name in FRAGMENTS}
+    cached = cache.get_many(keys.values())
+
+    fragments, missing = {}, {}
+    for name, render in FRAGMENTS.items():
+        if keys[name] in cached:
+            fragments[name] = cached[keys[name]]
+        else:
+            fragments[name] = missing[keys[name]] = render()
+    if missing:
+        cache.set_many(missing, timeout=settings.MENU_CACHE_TIMEOUT)
+    return fragments
+
+
+def item_cards(item_ids):
+    """``{item_id: card html}`` for ``item_ids``, from the cached fragments."""
+    item_ids = set(item_ids)
+    fragments = _get_fragments()
+    return {
+        item_id: html
+        for category in DEFAULT_IMAGES
+        for item_id, html in fragments[category] if item_id in item_ids
+    }
+
+
+def render_menu(outlet=None):
+    """
+    Return the menu page fragments: announcements plus one list of item
+    cards per category, limited to items currently in stock (at
+    ``outlet``, if given).
+
+    Rendered fragments are cached under the current menu version, which is
+    bumped whenever a MenuItem, Announcement or Outlet is saved or deleted. Stock
+    levels are overlaid from a single id-only query on every call.
+    """
+    fragments = _get_fragments()
+    in_stock = in_stock_ids(outlet)
+
+    context = {
+        'announcements_html': mark_safe(fragments['announcements']),
+        # (slug, name) of the outlets students can pick from
+        'outlets': fragments['outlets'],
+    }
+    for category in DEFAULT_IMAGES:
+        context[f'{category}_cards'] = [
+            mark_safe(html) for item_id, html in fragments[category] if item_id in in_stock
+        ]
+    return context
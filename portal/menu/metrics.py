@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds, in seconds, of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_current = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Where one sampled request spent its time: SQL (via a connection
+    execute_wrapper), rendering the view's TemplateResponse and M-Pesa
+    calls.
+    """
+    __slots__ = ('start', 'queries', 'sql', 'template', 'mpesa')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.template = 0.0
+        self.mpesa = 0.0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql += time.perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, total):
+        return (f'sql;dur={self.sql * 1000:.1f};desc="{self.queries} queries", '
+                f'tpl;dur={self.template * 1000:.1f}, mpesa;dur={self.mpesa * 1000:.1f}, '
+                f'total;dur={total * 1000:.1f}')
+
+
+def start_request():
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def end_request():
+    _current.set(None)
+
+
+class Registry:
+    """
+    Thread-safe counters and histograms, rendered in Prometheus text
+    format. They are per process; Prometheus sums them across workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.views = defaultdict(lambda: {
+                'requests': 0, 'seconds': 0.0, 'queries': 0, 'sql': 0.0,
+                'template': 0.0, 'mpesa': 0.0, 'buckets': [0] * len(BUCKETS),
+            })
+            self.mpesa = defaultdict(lambda: [0, 0.0])
+
+    def observe_request(self, view, timings, total):
+        with self._lock:
+            stats = self.views[view]
+            stats['requests'] += 1
+            stats['seconds'] += total
+            stats['queries'] += timings.queries
+            stats['sql'] += timings.sql
+            stats['template'] += timings.template
+            stats['mpesa'] += timings.mpesa
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def observe_mpesa(self, outcome, seconds):
+        with self._lock:
+            calls = self.mpesa[outcome]
+            calls[0] += 1
+            calls[1] += seconds
+
+    def render(self, sample_rate):
+        with self._lock:
+            views = {view: dict(stats, buckets=list(stats['buckets']))
+                     for view, stats in self.views.items()}
+            mpesa = {outcome: list(calls) for outcome, calls in self.mpesa.items()}
+
+        lines = [
+            '# HELP portal_sample_rate Fraction of requests that are instrumented.',
+            '# TYPE portal_sample_rate gauge',
+            f'portal_sample_rate {sample_rate}',
+        ]
+
+        def counter(name, help_text, key):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view, stats in sorted(views.items()):
+                lines.append(f'{name}{{view="{view}"}} {stats[key]}')
+
+        counter('portal_requests_total', 'Sampled requests, by view.', 'requests')
+        counter('portal_sql_queries_total', 'SQL queries run by sampled requests.', 'queries')
+        counter('portal_sql_seconds_total', 'Time spent in SQL by sampled requests.', 'sql')
+        counter('portal_template_seconds_total', 'Time spent rendering templates.', 'template')
+        counter('portal_mpesa_seconds_total', 'Time spent calling M-Pesa inside requests.', 'mpesa')
+
+        lines.append('# HELP portal_request_seconds Duration of sampled requests, by view.')
+        lines.append('# TYPE portal_request_seconds histogram')
+        for view, stats in sorted(views.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stats['buckets']):
+                cumulative += count
+                lines.append(f'portal_request_seconds_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'portal_request_seconds_bucket{{view="{view}",le="+Inf"}} {stats["requests"]}')
+            lines.append(f'portal_request_seconds_sum{{view="{view}"}} {stats["seconds"]}')
+            lines.append(f'portal_request_seconds_count{{view="{view}"}} {stats["requests"]}')
+
+        lines.append('# HELP portal_mpesa_requests_total STK push calls, sampled or not, by outcome.')
+        lines.append('# TYPE portal_mpesa_requests_total counter')
+        for outcome, (count, _) in sorted(mpesa.items()):
+            lines.append(f'portal_mpesa_requests_total{{outcome="{outcome}"}} {count}')
+        lines.append('# HELP portal_mpesa_request_seconds_total Time spent in STK push calls.')
+        lines.append('# TYPE portal_mpesa_request_seconds_total counter')
+        for outcome, (_, seconds) in sorted(mpesa.items()):
+            lines.append(f'portal_mpesa_request_seconds_total{{outcome="{outcome}"}} {seconds}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@contextmanager
+def time_mpesa():
+    """Time an outbound M-Pesa call, for the current request if there is one."""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe_mpesa(outcome, elapsed)
+        timings = _current.get()
+        if timings is not None:
+            timings.mpesa += elapsed
+
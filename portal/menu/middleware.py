@@ -0,0 +1,85 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+from . import metrics, staticfiles
+from .cart_storage import get_cart_storage
+
+
+class StaticFilesMiddleware(MiddlewareMixin):
+    """
+    Answer requests under STATIC_URL from collectstatic's output before
+    any other middleware runs; see menu.staticfiles.serve. Only installed
+    when settings.STATIC_SERVE is on.
+    """
+
+    def __init__(self, get_response):
+        if not settings.STATIC_SERVE or not settings.STATIC_URL.startswith('/'):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        if request.method in ('GET', 'HEAD') and request.path_info.startswith(settings.STATIC_URL):
+            return staticfiles.serve(request, request.path_info[len(settings.STATIC_URL):])
+
+
+class CartMiddleware(MiddlewareMixin):
+    """Attach the configured cart storage to each request as ``request.cart``."""
+
+    def process_request(self, request):
+        request.cart = get_cart_storage(request)
+
+    def process_response(self, request, response):
+        cart = getattr(request, 'cart', None)
+        if cart is not None:
+            cart.update_response(response)
+        return response
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    Time SQL, template rendering and M-Pesa calls for a sample of requests
+    (settings.INSTRUMENTATION_SAMPLE_RATE), add them to the /metrics/
+    aggregates and send them back as a Server-Timing header. Rendering is
+    timed for views that return a TemplateResponse, which Django renders
+    right after process_template_response.
+    """
+
+    def process_request(self, request):
+        rate = settings.INSTRUMENTATION_SAMPLE_RATE
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return
+        timings = metrics.start_request()
+        wrapper = connection.execute_wrapper(timings.execute_wrapper)
+        wrapper.__enter__()
+        request._instrumentation = (timings, wrapper)
+
+    def process_template_response(self, request, response):
+        instrumentation = getattr(request, '_instrumentation', None)
+        if instrumentation is not None:
+            timings = instrumentation[0]
+            start = time.perf_counter()
+
+            def rendered(response):
+                timings.template += time.perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        instrumentation = getattr(request, '_instrumentation', None)
+        if instrumentation is None:
+            return response
+        timings, wrapper = instrumentation
+        del request._instrumentation
+        wrapper.__exit__(None, None, None)
+        metrics.end_request()
+
+        total = time.perf_counter() - timings.start
+        match = request.resolver_match
+        metrics.registry.observe_request(match.view_name if match else 'unresolved', timings, total)
+        response['Server-Timing'] = timings.server_timing(total)
+        return response
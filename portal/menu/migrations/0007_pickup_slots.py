@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0006_menuitem_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PickupSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(unique=True)),
+                ('end', models.DateTimeField()),
+                ('capacity', models.PositiveIntegerField()),
+                ('reserved', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['start'],
+                'constraints': [models.CheckConstraint(condition=models.Q(('reserved__lte', models.F('capacity'))), name='pickupslot_reserved_lte_capacity')],
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='pickup_slot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='menu.pickupslot'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0007_pickup_slots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menuitem',
+            name='low_stock_threshold',
+            field=models.PositiveIntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='available_units',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='empty_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='level',
+            field=models.CharField(choices=[('low', 'Running low'), ('out', 'Sold out')], default='low', max_length=5),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='resolved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='velocity',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='stockalert',
+            name='menu_item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_alerts', to='menu.menuitem'),
+        ),
+        migrations.AddIndex(
+            model_name='stockalert',
+            index=models.Index(fields=['menu_item', 'is_resolved'], name='stockalert_item_resolved_idx'),
+        ),
+    ]
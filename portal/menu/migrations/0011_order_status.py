@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def status_from_payment(apps, schema_editor):
+    # Paid orders still in the table haven't been served (serving deletes them)
+    Order = apps.get_model('menu', 'Order')
+    Order.objects.filter(payment_status='paid').update(status='paid')
+    Order.objects.filter(payment_status='failed').update(status='cancelled')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0010_order_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='collected_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='preparing_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='ready_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('pending_payment', 'Pending payment'), ('paid', 'Paid'), ('preparing', 'Preparing'), ('ready', 'Ready'), ('collected', 'Collected'), ('cancelled', 'Cancelled')], default='pending_payment', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ),
+        migrations.RunPython(status_from_payment, migrations.RunPython.noop),
+    ]
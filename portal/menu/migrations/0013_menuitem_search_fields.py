@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0012_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menuitem',
+            name='description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='menuitem',
+            name='station',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='menuitem',
+            name='tags',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
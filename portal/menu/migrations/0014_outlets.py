@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0013_menuitem_search_fields'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Outlet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('slug', models.SlugField(unique=True)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OutletStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('available_units', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'outlet stock',
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='outlet',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='menu.outlet'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['outlet', 'status', 'created_at'], name='order_outlet_status_idx'),
+        ),
+        migrations.AddField(
+            model_name='outletstock',
+            name='menu_item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outlet_stock', to='menu.menuitem'),
+        ),
+        migrations.AddField(
+            model_name='outletstock',
+            name='outlet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock', to='menu.outlet'),
+        ),
+        migrations.AddConstraint(
+            model_name='outletstock',
+            constraint=models.UniqueConstraint(fields=('menu_item', 'outlet'), name='outletstock_item_outlet_uniq'),
+        ),
+    ]
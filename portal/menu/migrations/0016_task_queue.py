@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:10
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def mark_counted(apps, schema_editor):
+    # Orders placed so far were added to the rollups as they were placed
+    Order = apps.get_model('menu', 'Order')
+    Order.objects.exclude(payment_status='failed').update(in_sales_rollups=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0015_sync_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='in_sales_rollups',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_counted, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('args', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('kwargs', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('dead', 'Dead')], default='queued', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menu', '0016_task_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeldPayment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_request_id', models.CharField(max_length=100)),
+                ('reason', models.CharField(choices=[('unmatched', 'No matching order'), ('amount', 'Amount does not match the order')], max_length=10)),
+                ('result_code', models.IntegerField()),
+                ('result_desc', models.CharField(blank=True, max_length=255)),
+                ('receipt', models.CharField(blank=True, max_length=30)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('phone', models.CharField(blank=True, max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='held_payments', to='menu.order')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('checkout_request_id', 'reason'), name='heldpayment_request_reason_uniq')],
+            },
+        ),
+    ]
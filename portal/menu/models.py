@@ -1,7 +1,12 @@
+import datetime
+from decimal import Decimal
+
 from django.db import models
 
 # Create your models here.
 from django.db import models
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 
 class MenuItem(models.Model):
@@ -14,38 +19,221 @@ class MenuItem(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     available_units = models.PositiveIntegerField(default=0)
     category = models.CharField(max_length=10, choices=CATEGORY_CHOICES)
+    description = models.TextField(blank=True)
+    # Serving point in the mess hall, e.g. "Grill" or "Juice bar"
+    station = models.CharField(max_length=50, blank=True)
+    # Comma-separated, e.g. "vegetarian, spicy, special"; searchable and
+    # offered as filters on /search/
+    tags = models.CharField(max_length=200, blank=True)
     image = models.ImageField(upload_to='menu_images/', blank=True, null=True)
+    # sha256 of the image; names the resized variants (see menu/images.py)
+    image_hash = models.CharField(max_length=64, blank=True, editable=False, db_index=True)
+    # Raise a StockAlert once available_units drops to this level
+    low_stock_threshold = models.PositiveIntegerField(default=5)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    # Indexed for the menu delta sync, which asks what changed since a time
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     def __str__(self):
         return f"{self.name} - {self.price} (Units: {self.available_units})"
 
+    @property
+    def tag_list(self):
+        return list(dict.fromkeys(tag.strip().lower() for tag in self.tags.split(',') if tag.strip()))
+
+class MenuVersion(models.Model):
+    # One row, bumped on every menu change; cached menu fragments are keyed
+    # by it (menu/menu_cache.py). Kept here so each bump is atomic and
+    # commits with the change.
+    version = models.BigIntegerField()
+
+
 class Announcement(models.Model):
     title = models.CharField(max_length=200)
     message = models.TextField()
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     is_active = models.BooleanField(default=True)
     
     def __str__(self):
         return self.title
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
+
+
+class PickupSlotQuerySet(models.QuerySet):
+    def upcoming(self):
+        # Slots still far enough ahead for the kitchen to prepare an order
+        lead = datetime.timedelta(minutes=settings.PICKUP_SLOT_LEAD_MINUTES)
+        return self.filter(start__gte=timezone.now() + lead)
+
+    def open(self):
+        return self.upcoming().filter(reserved__lt=F('capacity'))
+
+
+class PickupSlot(models.Model):
+    start = models.DateTimeField(unique=True)
+    end = models.DateTimeField()
+    capacity = models.PositiveIntegerField()
+    # Orders holding this slot; kept in step by menu.stock so availability
+    # is read from this row instead of counting orders.
+    reserved = models.PositiveIntegerField(default=0)
+
+    objects = PickupSlotQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['start']
+        constraints = [
+            models.CheckConstraint(condition=models.Q(reserved__lte=F('capacity')),
+                                   name='pickupslot_reserved_lte_capacity'),
+        ]
+
+    def __str__(self):
+        start = timezone.localtime(self.start)
+        return f"{start:%a %d %b %H:%M}-{timezone.localtime(self.end):%H:%M}"
+
+    @property
+    def remaining(self):
+        return max(self.capacity - self.reserved, 0)
+
+
+class Outlet(models.Model):
+    # A serving point with its own kitchen, stock and order queue
+    name = models.CharField(max_length=100, unique=True)
+    slug = models.SlugField(unique=True)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class OutletStock(models.Model):
+    # Units of an item held at one outlet. For items with any of these rows,
+    # MenuItem.available_units is their sum, kept up by menu.outlets; items
+    # without them are sold from MenuItem.available_units directly.
+    outlet = models.ForeignKey(Outlet, related_name='stock', on_delete=models.CASCADE)
+    menu_item = models.ForeignKey(MenuItem, related_name='outlet_stock', on_delete=models.CASCADE)
+    available_units = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'outlet stock'
+        constraints = [
+            models.UniqueConstraint(fields=['menu_item', 'outlet'], name='outletstock_item_outlet_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.menu_item.name} at {self.outlet.name}"
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        # Total each order in the database instead of iterating its items.
+        return self.annotate(items_total=Coalesce(
+            Sum(F('items__item_price') * F('items__quantity')),
+            Value(Decimal('0')),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        ))
+
+    def active(self):
+        # The kitchen queue, oldest first; served by order_status_created_idx
+        return self.filter(status__in=Order.ACTIVE_STATUSES).order_by('created_at', 'id')
+
 
 class Order(models.Model):
+    PAYMENT_PENDING = 'pending'
+    PAYMENT_PAID = 'paid'
+    PAYMENT_FAILED = 'failed'
+    PAYMENT_STATUS_CHOICES = [
+        (PAYMENT_PENDING, 'Pending'),
+        (PAYMENT_PAID, 'Paid'),
+        (PAYMENT_FAILED, 'Failed'),
+    ]
+
+    STATUS_PENDING_PAYMENT = 'pending_payment'
+    STATUS_PAID = 'paid'
+    STATUS_PREPARING = 'preparing'
+    STATUS_READY = 'ready'
+    STATUS_COLLECTED = 'collected'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_PENDING_PAYMENT, 'Pending payment'),
+        (STATUS_PAID, 'Paid'),
+        (STATUS_PREPARING, 'Preparing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_COLLECTED, 'Collected'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    # The status each one can be reached from, and the field stamped when it is
+    PREVIOUS_STATUS = {
+        STATUS_PAID: STATUS_PENDING_PAYMENT,
+        STATUS_PREPARING: STATUS_PAID,
+        STATUS_READY: STATUS_PREPARING,
+        STATUS_COLLECTED: STATUS_READY,
+        STATUS_CANCELLED: STATUS_PENDING_PAYMENT,
+    }
+    STATUS_TIMESTAMPS = {
+        STATUS_PAID: 'paid_at',
+        STATUS_PREPARING: 'preparing_at',
+        STATUS_READY: 'ready_at',
+        STATUS_COLLECTED: 'collected_at',
+    }
+    # Orders the kitchen still has to deal with
+    ACTIVE_STATUSES = [STATUS_PAID, STATUS_PREPARING, STATUS_READY]
+    # Nothing more can happen to these; only they are archived
+    FINISHED_STATUSES = [STATUS_COLLECTED, STATUS_CANCELLED]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     customer_name = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    phone = models.CharField(max_length=15, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    payment_status = models.CharField(max_length=10, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_PENDING)
+    checkout_request_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    mpesa_receipt = models.CharField(max_length=30, blank=True)
+    paid_at = models.DateTimeField(null=True, blank=True)
+    pickup_slot = models.ForeignKey(PickupSlot, related_name='orders', on_delete=models.PROTECT, null=True, blank=True)
+    # The outlet whose stock the order was taken from and whose kitchen makes it
+    outlet = models.ForeignKey(Outlet, related_name='orders', on_delete=models.PROTECT, null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING_PAYMENT)
+    preparing_at = models.DateTimeField(null=True, blank=True)
+    ready_at = models.DateTimeField(null=True, blank=True)
+    collected_at = models.DateTimeField(null=True, blank=True)
+    # Sent with the checkout form so a resubmitted form can't place a second order
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Whether the sales rollups include this order; they are updated by a
+    # background task, so adding and taking it out again must each happen once
+    in_sales_rollups = models.BooleanField(default=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination walks orders newest first by (created_at, id)
+            models.Index(fields=['-created_at', '-id'], name='order_created_id_idx'),
+            # The kitchen queue only reads the few orders in an active status
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+            # ...and one outlet's kitchen only the ones sent to it
+            models.Index(fields=['outlet', 'status', 'created_at'], name='order_outlet_status_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.id} by {self.customer_name}"
     def total_amount(self):
+        if getattr(self, 'items_total', None) is not None:
+            return self.items_total
         return sum(item.item_price * item.quantity for item in self.items.all())
     def item_names(self):
         return ', '.join(item.item_name for item in self.items.all())
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
+    menu_item = models.ForeignKey(MenuItem, related_name='order_items', on_delete=models.SET_NULL, null=True, blank=True)
     item_name = models.CharField(max_length=100)
     item_price = models.DecimalField(max_digits=8, decimal_places=2)
     quantity = models.PositiveIntegerField()
@@ -53,13 +241,176 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.item_name}"
 
+class HeldPayment(models.Model):
+    """
+    An M-Pesa payment result that couldn't be applied to an order: none
+    had its CheckoutRequestID yet, or the amount paid doesn't match the
+    order. Kept until it is applied or dealt with by hand.
+    """
+    REASON_UNMATCHED = 'unmatched'
+    REASON_AMOUNT = 'amount'
+    REASON_CHOICES = [
+        (REASON_UNMATCHED, 'No matching order'),
+        (REASON_AMOUNT, 'Amount does not match the order'),
+    ]
+
+    checkout_request_id = models.CharField(max_length=100)
+    reason = models.CharField(max_length=10, choices=REASON_CHOICES)
+    order = models.ForeignKey(Order, related_name='held_payments', on_delete=models.SET_NULL,
+                              null=True, blank=True)
+    result_code = models.IntegerField()
+    result_desc = models.CharField(max_length=255, blank=True)
+    receipt = models.CharField(max_length=30, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    phone = models.CharField(max_length=20, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Safaricom retries callbacks; each result is held once
+            models.UniqueConstraint(fields=['checkout_request_id', 'reason'],
+                                    name='heldpayment_request_reason_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} ({self.get_reason_display()})"
+
+
+class OrderEvent(models.Model):
+    """
+    A new or changed order for the kitchen screens. Written by whichever
+    process made the change (a web request or a task worker); each web
+    process relays new rows to its own streams (menu.feed).
+    """
+    event = models.CharField(max_length=50)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
 class StockAlert(models.Model):
-    menu_item = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
+    LEVEL_LOW = 'low'
+    LEVEL_OUT = 'out'
+    LEVEL_CHOICES = [
+        (LEVEL_LOW, 'Running low'),
+        (LEVEL_OUT, 'Sold out'),
+    ]
+
+    menu_item = models.ForeignKey(MenuItem, related_name='stock_alerts', on_delete=models.CASCADE)
     message = models.TextField()
     is_resolved = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    
+    level = models.CharField(max_length=5, choices=LEVEL_CHOICES, default=LEVEL_LOW)
+    available_units = models.PositiveIntegerField(default=0)
+    # Units sold per hour over settings.STOCK_VELOCITY_WINDOW
+    velocity = models.FloatField(default=0)
+    empty_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['menu_item', 'is_resolved'], name='stockalert_item_resolved_idx'),
+        ]
+
     def __str__(self):
         return f"Stock Alert for {self.menu_item.name}"
     
-    
\ No newline at end of file
+    
+class SalesRollup(models.Model):
+    # Sales per item per local day, maintained by menu.analytics. Reports
+    # read only the rollups; rebuild them with `manage.py rebuild_sales_rollups`.
+    date = models.DateField()
+    item_name = models.CharField(max_length=100)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'item_name'], name='salesrollup_day_item_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.item_name}"
+
+class HourlySales(models.Model):
+    # All items together per local hour, for the peak hours report
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'hourly sales'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'hour'], name='hourlysales_day_hour_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.hour:02d}:00"
+
+class OrderArchive(models.Model):
+    # One gzipped JSONL file of orders moved out of the database by
+    # `manage.py archive_orders`; path is relative to ORDER_ARCHIVE_DIR.
+    month = models.DateField()
+    path = models.CharField(max_length=255, unique=True)
+    orders = models.PositiveIntegerField()
+    first_order_id = models.BigIntegerField()
+    last_order_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.path
+
+class ArchiveBlock(models.Model):
+    # Each file is a series of independently compressed gzip members, so a
+    # single order can be read back by decompressing only its block.
+    archive = models.ForeignKey(OrderArchive, related_name='blocks', on_delete=models.CASCADE)
+    first_order_id = models.BigIntegerField()
+    last_order_id = models.BigIntegerField()
+    offset = models.BigIntegerField()
+    length = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['first_order_id', 'last_order_id'], name='archiveblock_order_ids_idx'),
+        ]
+
+class Task(models.Model):
+    # A call to a function registered with menu.tasks.task, run later by
+    # `manage.py run_tasks`. Tasks that keep failing end up STATUS_DEAD.
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_DEAD, 'Dead'),
+    ]
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    kwargs = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Not before this; pushed back after each failed attempt
+    run_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # A running task still running after this is taken to have lost its worker
+    locked_until = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
@@ -0,0 +1,217 @@
+import base64
+import datetime
+import logging
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.crypto import constant_time_compare
+from django.dispatch import receiver
+
+from .metrics import time_mpesa
+from .payments import charge_for, record_checkout
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATH = '/oauth/v1/generate?grant_type=client_credentials'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+
+# Refresh the token this many seconds before Safaricom says it expires.
+TOKEN_EXPIRY_MARGIN = 60
+
+# Tries at an STK push that didn't reach Safaricom before the order is failed
+STK_PUSH_ATTEMPTS = 3
+
+
+class MpesaError(Exception):
+    pass
+
+
+class MpesaUnavailable(MpesaError):
+    """The STK push was never sent, so sending it again can't charge twice."""
+
+
+class MpesaClient:
+    """
+    Daraja API client that reuses its OAuth token and HTTP connections.
+
+    One instance is shared by the whole process; it is safe to use from
+    several threads.
+    """
+
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode,
+                 passkey, callback_url, timeout=10, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            base_url=settings.MPESA_BASE_URL,
+            consumer_key=settings.MPESA_CONSUMER_KEY,
+            consumer_secret=settings.MPESA_CONSUMER_SECRET,
+            shortcode=settings.MPESA_SHORTCODE,
+            passkey=settings.MPESA_PASSKEY,
+            callback_url=callback_url(),
+            timeout=settings.MPESA_TIMEOUT,
+            pool_size=settings.MPESA_WORKERS,
+        )
+
+    def _request(self, method, path, **kwargs):
+        try:
+            response = self.session.request(
+                method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.ConnectTimeout as e:
+            raise MpesaUnavailable(f'M-Pesa did not answer: {e}') from e
+        except requests.RequestException as e:
+            raise MpesaError(f'M-Pesa request failed: {e}') from e
+        return response
+
+    def get_token(self, force=False):
+        with self._token_lock:
+            if force or not self._token or time.monotonic() >= self._token_expires_at:
+                response = self._request(
+                    'GET', TOKEN_PATH, auth=(self.consumer_key, self.consumer_secret))
+                if response.status_code != 200:
+                    raise MpesaError(f'Token request failed with {response.status_code}')
+                data = response.json()
+                self._token = data['access_token']
+                expires_in = int(data.get('expires_in', 3599))
+                self._token_expires_at = (
+                    time.monotonic() + max(expires_in - TOKEN_EXPIRY_MARGIN, 0))
+            return self._token
+
+    def stk_push(self, phone, amount, reference='Order Payment'):
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            (self.shortcode + self.passkey + timestamp).encode()).decode()
+
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": "254708374149",
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone,
+            "CallBackURL": self.callback_url,
+            "AccountReference": reference,
+            "TransactionDesc": "Food order payment"
+        }
+
+        response = self._post_stk(payload, self._token_for_push())
+        if response.status_code == 401:
+            # The token was revoked early; fetch a fresh one and retry once.
+            response = self._post_stk(payload, self._token_for_push(force=True))
+        try:
+            return response.json()
+        except ValueError as e:
+            raise MpesaError(f'Invalid STK push response ({response.status_code})') from e
+
+    def _token_for_push(self, force=False):
+        try:
+            return self.get_token(force=force)
+        except MpesaUnavailable:
+            raise
+        except MpesaError as e:
+            # No token, no push
+            raise MpesaUnavailable(str(e)) from e
+
+    def _post_stk(self, payload, token):
+        return self._request('POST', STK_PUSH_PATH, json=payload, headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        })
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def callback_url():
+    """MPESA_CALLBACK_URL carrying the token that callback_allowed checks."""
+    url = settings.MPESA_CALLBACK_URL
+    if settings.MPESA_CALLBACK_TOKEN:
+        url += ('&' if '?' in url else '?') + urlencode({'token': settings.MPESA_CALLBACK_TOKEN})
+    return url
+
+
+def callback_allowed(request):
+    """
+    Whether a callback came from Safaricom: it carries our token and, if
+    MPESA_CALLBACK_IPS is set, comes from one of those addresses. Without
+    a token configured every callback is refused.
+    """
+    token = settings.MPESA_CALLBACK_TOKEN
+    if not token or not constant_time_compare(request.GET.get('token', ''), token):
+        return False
+    return not settings.MPESA_CALLBACK_IPS or request.META.get('REMOTE_ADDR') in settings.MPESA_CALLBACK_IPS
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MpesaClient.from_settings()
+        return _client
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    global _client
+    if setting.startswith('MPESA_'):
+        _client = None
+
+
+def initiate_mpesa_payment(phone, amount, reference='Order Payment'):
+    with time_mpesa():
+        return get_client().stk_push(phone, amount, reference=reference)
+
+
+def _payment_not_sent(order_id, phone, amount):
+    # Out of attempts: fail the order and put its stock back
+    record_checkout(order_id, {})
+
+
+@task(max_attempts=STK_PUSH_ATTEMPTS, retry_for=(MpesaUnavailable,), on_dead=_payment_not_sent)
+def request_payment(order_id, phone, amount):
+    """
+    Send the STK push for an order, failing it if M-Pesa refuses. Pushes
+    that never reached Safaricom are tried again (STK_PUSH_ATTEMPTS in all).
+    """
+    try:
+        response = initiate_mpesa_payment(phone, amount, reference=f'Order {order_id}')
+    except MpesaUnavailable:
+        raise
+    except MpesaError:
+        logger.exception('STK push for order %s failed', order_id)
+        response = {}
+
+    record_checkout(order_id, response)
+    return response
+
+
+def submit_payment(order, phone):
+    """Queue the STK push for ``order``; it is sent once the current transaction commits."""
+    request_payment.delay(order.id, phone, charge_for(order.amount))
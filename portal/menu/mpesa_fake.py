@@ -0,0 +1,115 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .mpesa import STK_PUSH_PATH, TOKEN_PATH
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up mid-response; that is expected here.
+        pass
+
+
+class FakeMpesaServer:
+    """
+    Local stand-in for the Daraja sandbox, for tests and benchmarks.
+
+    ``latency`` delays every response, ``response_code`` is returned from
+    STK pushes and ``expires_in`` controls how long issued tokens live.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, response_code='0',
+                 expires_in=3599):
+        self.latency = latency
+        self.response_code = response_code
+        self.expires_in = expires_in
+        self.token_requests = 0
+        self.stk_requests = []
+        self.tokens = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.httpd = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def issue_token(self):
+        with self._lock:
+            self.token_requests += 1
+            token = f'fake-token-{next(self._ids)}'
+            self.tokens.add(token)
+        return {'access_token': token, 'expires_in': str(self.expires_in)}
+
+    def stk_push(self, payload, token):
+        if token not in self.tokens:
+            return 401, {'errorMessage': 'Invalid Access Token'}
+        with self._lock:
+            self.stk_requests.append(payload)
+            request_id = next(self._ids)
+        return 200, {
+            'MerchantRequestID': f'fake-merchant-{request_id}',
+            'CheckoutRequestID': f'ws_CO_fake_{request_id}',
+            'ResponseCode': self.response_code,
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, body):
+                if server.latency:
+                    time.sleep(server.latency)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == TOKEN_PATH:
+                    self._reply(200, server.issue_token())
+                else:
+                    self._reply(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if self.path != STK_PUSH_PATH:
+                    self._reply(404, {'errorMessage': 'Not found'})
+                    return
+                token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+                self._reply(*server.stk_push(payload, token))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import MenuItem, Order, Outlet, OutletStock
+from .signals import stock_changed
+
+
+def get_outlet(request):
+    """The active outlet the student picked (settings.OUTLET_COOKIE_NAME), if any."""
+    if not hasattr(request, '_outlet'):
+        slug = request.COOKIES.get(settings.OUTLET_COOKIE_NAME)
+        request._outlet = Outlet.objects.filter(slug=slug, is_active=True).first() if slug else None
+    return request._outlet
+
+
+def with_outlet_units(queryset, outlet):
+    """
+    Annotate MenuItems with ``outlet_units``, what ``outlet`` can sell:
+    its own row for items stocked per outlet (none means none), the shared
+    available_units for the rest.
+    """
+    own = OutletStock.objects.filter(menu_item=OuterRef('pk'), outlet=outlet).values('available_units')
+    return queryset.annotate(outlet_units=Case(
+        When(Exists(OutletStock.objects.filter(menu_item=OuterRef('pk'))),
+             then=Coalesce(Subquery(own), 0)),
+        default=F('available_units'),
+        output_field=models.PositiveIntegerField(),
+    ))
+
+
+def in_stock_ids(outlet=None):
+    """Ids of the items that can be ordered, at ``outlet`` or at all."""
+    if outlet is None:
+        items = MenuItem.objects.filter(available_units__gt=0)
+    else:
+        items = with_outlet_units(MenuItem.objects.all(), outlet).filter(outlet_units__gt=0)
+    return set(items.values_list('id', flat=True))
+
+
+def sold_out_ids(outlet=None):
+    """Ids of the items that can't be ordered right now, at ``outlet`` or at all."""
+    if outlet is None:
+        items = MenuItem.objects.filter(available_units=0)
+    else:
+        items = with_outlet_units(MenuItem.objects.all(), outlet).filter(outlet_units=0)
+    return set(items.values_list('id', flat=True))
+
+
+def refresh_totals(item_ids):
+    """
+    Set available_units of those of ``item_ids`` that are stocked per
+    outlet to the total held at active outlets. Called once their outlet
+    rows have changed, outside the transaction that changed them, so
+    orders at different outlets never wait on the same MenuItem row.
+    """
+    rows = OutletStock.objects.filter(menu_item=OuterRef('pk'))
+    total = (rows.filter(outlet__is_active=True).values('menu_item')
+             .annotate(total=Sum('available_units')).values('total'))
+    MenuItem.objects.filter(Exists(rows), id__in=list(item_ids)).update(
+        available_units=Coalesce(Subquery(total), 0))
+
+
+def outlet_rows(item_ids):
+    """``{item_id: {outlet_id: units}}`` for the items among ``item_ids`` stocked per outlet."""
+    rows = {}
+    for item_id, outlet_id, units in (OutletStock.objects.filter(menu_item_id__in=item_ids)
+                                      .values_list('menu_item_id', 'outlet_id', 'available_units')):
+        rows.setdefault(item_id, {})[outlet_id] = units
+    return rows
+
+
+def choose_outlet(quantities, rows):
+    """
+    The active outlet with the shortest kitchen queue among those that
+    hold enough of every per-outlet item in ``quantities`` (``rows`` as
+    returned by outlet_rows), or None if there isn't one.
+    """
+    outlets = Outlet.objects.filter(is_active=True).annotate(
+        queue=Count('orders', filter=Q(orders__status__in=Order.ACTIVE_STATUSES)))
+    candidates = [
+        outlet for outlet in outlets
+        if all(rows[item_id].get(outlet.id, 0) >= quantities[item_id] for item_id in rows)
+    ]
+    return min(candidates, key=lambda outlet: (outlet.queue, outlet.id), default=None)
+
+
+def refresh_on_commit(item_ids):
+    """Refresh the totals of ``item_ids`` and send ``stock_changed`` once the transaction commits."""
+    item_ids = list(item_ids)
+
+    def refresh():
+        refresh_totals(item_ids)
+        stock_changed.send(sender=MenuItem, item_ids=item_ids, decreased=False)
+
+    if item_ids:
+        transaction.on_commit(refresh)
+
+
+@receiver(post_save, sender=OutletStock)
+@receiver(post_delete, sender=OutletStock)
+def _outlet_stock_changed(sender, instance, **kwargs):
+    # Edits from the admin; orders update the rows in bulk and refresh
+    # the totals themselves (menu.stock).
+    refresh_on_commit([instance.menu_item_id])
+
+
+@receiver(post_save, sender=Outlet)
+def _outlet_changed(sender, instance, **kwargs):
+    # Opening or closing an outlet adds or removes its stock from the totals
+    refresh_on_commit(instance.stock.values_list('menu_item_id', flat=True))
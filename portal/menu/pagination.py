@@ -0,0 +1,60 @@
+import base64
+from dataclasses import dataclass
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+@dataclass(frozen=True)
+class KeysetPage:
+    object_list: list
+    next_cursor: str = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(obj):
+    raw = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if created_at is None:
+        return None
+    return created_at, pk
+
+
+def keyset_page(queryset, cursor=None, page_size=50):
+    """
+    Return the page of ``queryset`` after ``cursor``, newest first.
+
+    Pages are found by seeking on (created_at, id), so every page costs the
+    same however deep it is, unlike OFFSET pagination.
+    """
+    queryset = queryset.order_by('-created_at', '-pk')
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        created_at, pk = position
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    objects = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(objects) > page_size:
+        objects = objects[:page_size]
+        next_cursor = encode_cursor(objects[-1])
+    return KeysetPage(objects, next_cursor)
@@ -0,0 +1,220 @@
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import HeldPayment, Order
+from .signals import orders_updated
+from .stock import release_reservations
+
+# Keep each IN (...) lookup well below SQLite's bound-parameter limit.
+BATCH_SIZE = 900
+
+
+@dataclass(frozen=True)
+class PaymentResult:
+    checkout_request_id: str
+    result_code: int
+    result_desc: str = ''
+    receipt: str = ''
+    amount: Decimal = None
+    phone: str = ''
+
+    @property
+    def paid(self):
+        return self.result_code == 0
+
+    def hold(self, reason, order=None):
+        return HeldPayment(
+            checkout_request_id=self.checkout_request_id, reason=reason, order=order,
+            result_code=self.result_code, result_desc=self.result_desc[:255],
+            receipt=self.receipt, amount=self.amount, phone=self.phone[:20])
+
+    @classmethod
+    def from_held(cls, held):
+        return cls(checkout_request_id=held.checkout_request_id, result_code=held.result_code,
+                   result_desc=held.result_desc, receipt=held.receipt, amount=held.amount,
+                   phone=held.phone)
+
+    @classmethod
+    def from_callback(cls, payload):
+        """
+        Build a result from the JSON body of an STK push callback. A
+        successful one without an Amount raises ValueError.
+        """
+        callback = payload['Body']['stkCallback']
+        metadata = {
+            item['Name']: item.get('Value')
+            for item in callback.get('CallbackMetadata', {}).get('Item', [])
+        }
+        if int(callback['ResultCode']) == 0 and metadata.get('Amount') in (None, ''):
+            raise ValueError(f'Payment callback for {callback["CheckoutRequestID"]} has no Amount')
+        return cls.from_row({
+            'CheckoutRequestID': callback['CheckoutRequestID'],
+            'ResultCode': callback['ResultCode'],
+            'ResultDesc': callback.get('ResultDesc', ''),
+            'MpesaReceiptNumber': metadata.get('MpesaReceiptNumber'),
+            'Amount': metadata.get('Amount'),
+            'PhoneNumber': metadata.get('PhoneNumber'),
+        })
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a result from a flat record, e.g. a statement CSV row."""
+        try:
+            amount = Decimal(str(row['Amount'])) if row.get('Amount') not in (None, '') else None
+        except InvalidOperation:
+            amount = None
+        return cls(
+            checkout_request_id=str(row['CheckoutRequestID']).strip(),
+            result_code=int(row['ResultCode']),
+            result_desc=row.get('ResultDesc') or '',
+            receipt=row.get('MpesaReceiptNumber') or '',
+            amount=amount,
+            phone=str(row.get('PhoneNumber') or ''),
+        )
+
+
+@dataclass
+class ReconcileReport:
+    paid: int = 0
+    failed: int = 0
+    duplicates: int = 0
+    unmatched: list = field(default_factory=list)
+    mismatched: list = field(default_factory=list)
+
+    def merge(self, other):
+        self.paid += other.paid
+        self.failed += other.failed
+        self.duplicates += other.duplicates
+        self.unmatched.extend(other.unmatched)
+        self.mismatched.extend(other.mismatched)
+
+
+def charge_for(amount):
+    """Whole shillings the STK push asks for an order of ``amount``."""
+    return int(amount)
+
+
+def _notify(order_ids, **changes):
+    orders_updated.send(sender=Order, order_ids=order_ids, changes=changes)
+
+
+def _apply_batch(results):
+    report = ReconcileReport()
+    now = timezone.now()
+
+    with transaction.atomic():
+        orders = {
+            order.checkout_request_id: order
+            for order in Order.objects.select_for_update().filter(
+                checkout_request_id__in=results
+            ).only('id', 'checkout_request_id', 'payment_status', 'status', 'amount')
+        }
+
+        paid, failed, held = [], [], []
+        for checkout_request_id, result in results.items():
+            order = orders.get(checkout_request_id)
+            if order is None:
+                # Possibly sent before record_checkout stored the id; it
+                # applies the held result then (see apply_held_payments)
+                report.unmatched.append(checkout_request_id)
+                held.append(result.hold(HeldPayment.REASON_UNMATCHED))
+            elif order.payment_status != Order.PAYMENT_PENDING:
+                # Safaricom retries callbacks; anything already settled is a repeat.
+                report.duplicates += 1
+            elif result.paid and (result.amount is None or result.amount != charge_for(order.amount)):
+                # Left pending for staff to sort out, never marked paid
+                report.mismatched.append(checkout_request_id)
+                held.append(result.hold(HeldPayment.REASON_AMOUNT, order))
+            elif result.paid:
+                order.payment_status = Order.PAYMENT_PAID
+                order.status = Order.STATUS_PAID
+                order.mpesa_receipt = result.receipt
+                order.paid_at = now
+                paid.append(order)
+            else:
+                order.payment_status = Order.PAYMENT_FAILED
+                order.status = Order.STATUS_CANCELLED
+                failed.append(order)
+
+        if held:
+            HeldPayment.objects.bulk_create(held, ignore_conflicts=True)
+        if paid:
+            Order.objects.bulk_update(paid, ['payment_status', 'status', 'mpesa_receipt', 'paid_at'])
+            _notify([order.id for order in paid],
+                    payment_status=Order.PAYMENT_PAID, status=Order.STATUS_PAID)
+        if failed:
+            Order.objects.bulk_update(failed, ['payment_status', 'status'])
+            release_reservations([order.id for order in failed])
+            _notify([order.id for order in failed],
+                    payment_status=Order.PAYMENT_FAILED, status=Order.STATUS_CANCELLED)
+
+    report.paid = len(paid)
+    report.failed = len(failed)
+    return report
+
+
+def apply_payment_results(results, batch_size=BATCH_SIZE):
+    """
+    Settle pending orders from an iterable of ``PaymentResult``.
+
+    Results are matched on CheckoutRequestID a batch at a time, so the
+    number of queries grows with the number of batches, not orders. Orders
+    that are no longer pending are counted as duplicates and left alone.
+
+    Results that match no order, and payments whose amount differs from
+    what the order was charged, are kept as HeldPayments instead.
+    """
+    report = ReconcileReport()
+    batch = {}
+    for result in results:
+        if result.checkout_request_id in batch:
+            report.duplicates += 1
+            continue
+        batch[result.checkout_request_id] = result
+        if len(batch) >= batch_size:
+            report.merge(_apply_batch(batch))
+            batch = {}
+    if batch:
+        report.merge(_apply_batch(batch))
+    return report
+
+
+def apply_held_payments(checkout_request_ids=None):
+    """
+    Apply held results that had no matching order (those for
+    ``checkout_request_ids``, or all of them) now that their order may
+    have its CheckoutRequestID. Returns the report for the ones applied.
+    """
+    held = HeldPayment.objects.filter(reason=HeldPayment.REASON_UNMATCHED)
+    if checkout_request_ids is not None:
+        held = held.filter(checkout_request_id__in=checkout_request_ids)
+    results = {row.checkout_request_id: PaymentResult.from_held(row) for row in held}
+    if not results:
+        return ReconcileReport()
+    report = apply_payment_results(results.values())
+    HeldPayment.objects.filter(reason=HeldPayment.REASON_UNMATCHED, checkout_request_id__in=[
+        checkout_request_id for checkout_request_id in results
+        if checkout_request_id not in report.unmatched
+    ]).delete()
+    report.unmatched = []
+    return report
+
+
+def record_checkout(order_id, response):
+    """Store the outcome of an STK push request against its order."""
+    if response.get('ResponseCode') == '0':
+        checkout_request_id = response.get('CheckoutRequestID')
+        Order.objects.filter(id=order_id).update(checkout_request_id=checkout_request_id)
+        # The callback can beat us here
+        apply_held_payments([checkout_request_id])
+        return True
+
+    with transaction.atomic():
+        if Order.objects.filter(id=order_id, payment_status=Order.PAYMENT_PENDING).update(
+                payment_status=Order.PAYMENT_FAILED, status=Order.STATUS_CANCELLED):
+            release_reservations([order_id])
+            _notify([order_id], payment_status=Order.PAYMENT_FAILED, status=Order.STATUS_CANCELLED)
+    return False
@@ -0,0 +1,130 @@
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+
+# Session value that gets a visitor's session saved (an empty one never is)
+SESSION_MARKER = 'rate_limited'
+
+
+def _session_key(request):
+    session = getattr(request, 'session', None)
+    return session.session_key if session is not None else None
+
+
+def start_session(request):
+    """Issue a session to a visitor without one, for the session scopes."""
+    if not _session_key(request):
+        request.session[SESSION_MARKER] = True
+
+
+def _identities(request, scope):
+    """The session, user and client IP a request is counted against."""
+    identities = []
+    session_key = _session_key(request)
+    if session_key:
+        identities.append(('session', session_key))
+    elif (scope not in settings.RATE_LIMIT_SESSION_SCOPES
+          and request.COOKIES.get(settings.CSRF_COOKIE_NAME)):
+        # Carts don't need a session; the CSRF cookie still tells browsers apart
+        identities.append(('browser', request.COOKIES[settings.CSRF_COOKIE_NAME][:64]))
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        identities.append(('user', user.pk))
+    ip = request.META.get('REMOTE_ADDR')
+    if ip:
+        identities.append(('ip', ip))
+    return identities
+
+
+def take_token(request, scope, now=None):
+    """
+    Spend one token from each of the request's buckets for ``scope``.
+
+    Buckets hold ``capacity`` tokens and refill at ``capacity / period``
+    tokens a second (settings.RATE_LIMITS). The IP bucket is
+    RATE_LIMIT_IP_MULTIPLIER times bigger (or as RATE_LIMIT_IP_MULTIPLIERS
+    sets for ``scope``), since a campus network puts many students behind
+    one address. Returns 0 if the request may go ahead, otherwise the
+    seconds until it could.
+
+    Without a session, browsers are told apart by their CSRF cookie. That
+    is chosen by the client, so RATE_LIMIT_SESSION_SCOPES are only counted
+    per session (see rate_limit), user and IP.
+
+    Buckets are read and written without a lock, so under contention a
+    few extra requests can slip through; they are a brake, not a quota.
+    """
+    capacity, period = settings.RATE_LIMITS[scope]
+    cache = caches[settings.RATE_LIMIT_CACHE_ALIAS]
+    now = time.time() if now is None else now
+
+    ip_multiplier = settings.RATE_LIMIT_IP_MULTIPLIERS.get(scope, settings.RATE_LIMIT_IP_MULTIPLIER)
+    buckets = {}
+    for kind, value in _identities(request, scope):
+        size = capacity * (ip_multiplier if kind == 'ip' else 1)
+        buckets[f'rl:{scope}:{kind}:{value}'] = (size, size / period)
+    stored = cache.get_many(list(buckets))
+
+    updated, wait = {}, 0.0
+    for key, (size, rate) in buckets.items():
+        tokens, last = stored.get(key, (size, now))
+        tokens = min(size, tokens + (now - last) * rate)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+        updated[key] = (tokens, now)
+    if not wait:
+        updated = {key: (tokens - 1, now) for key, (tokens, now) in updated.items()}
+    cache.set_many(updated, timeout=period * 2)
+    return wait
+
+
+def _wants_json(request):
+    return ('application/json' in request.headers.get('Accept', '')
+            or request.headers.get('X-Requested-With') == 'XMLHttpRequest')
+
+
+def rate_limit(scope, redirect_to=None):
+    """
+    Answer 429 with Retry-After once the caller has used up ``scope``'s
+    budget. For views behind an HTML form, ``redirect_to`` (a URL name)
+    sends browsers back there with a message instead; requests asking
+    for JSON still get the 429.
+
+    Requests to RATE_LIMIT_SESSION_SCOPES without a session are refused
+    with 403 (or sent back to ``redirect_to``, whose view should call
+    start_session), since a new session each time would dodge the limit.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if settings.RATE_LIMIT_ENABLED:
+                if scope in settings.RATE_LIMIT_SESSION_SCOPES and not _session_key(request):
+                    if redirect_to and not _wants_json(request):
+                        messages.error(request, 'Your session has expired, please try again.')
+                        return redirect(redirect_to)
+                    return JsonResponse({
+                        'success': False,
+                        'error': 'Your session has expired, please reload the page.',
+                    }, status=403)
+                wait = take_token(request, scope)
+                if wait and redirect_to and not _wants_json(request):
+                    messages.error(request, f'Too many attempts, please try again in '
+                                            f'{math.ceil(wait)} seconds.')
+                    return redirect(redirect_to)
+                if wait:
+                    response = JsonResponse({
+                        'success': False,
+                        'error': 'Too many requests, please slow down.',
+                    }, status=429)
+                    response['Retry-After'] = str(math.ceil(wait))
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapped
+    return decorator
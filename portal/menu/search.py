@@ -0,0 +1,250 @@
+import heapq
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from functools import partial
+from itertools import chain
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .menu_cache import get_version
+from .models import MenuItem
+
+# How much a match in each field counts towards an item's score
+FIELD_WEIGHTS = {'name': 4, 'tags': 2, 'station': 1, 'category': 1, 'description': 1}
+# Exact words beat completions of a prefix, which beat words one typo away
+EXACT, PREFIX, TYPO = 3, 2, 1
+# Shorter words get too many false hits from a single typo
+TYPO_MIN_LENGTH = 4
+
+_word = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode()
+    return _word.findall(text.lower())
+
+
+def _deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+class SearchIndex:
+    """
+    An inverted index of the menu, held in memory by each process.
+
+    Words map to the items they occur in and their best field weight.
+    The vocabulary is also kept sorted, for prefix matching, and every
+    word is filed under each of its one-letter deletions. A query word is
+    then one typo away from any word sharing one of those keys
+    (a symmetric delete lookup), with no edit-distance scan of the
+    vocabulary.
+
+    Item saves and deletes are applied once they commit. Other changes,
+    like bulk updates or a save in another worker, bump the menu version
+    (menu/menu_cache.py, kept in the database so every worker sees it),
+    and the next search rebuilds from the database.
+    """
+
+    # What a search result shows of each item
+    FIELDS = ('id', 'name', 'price', 'category', 'station', 'tags')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.version = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.documents = {}
+            self.postings = defaultdict(dict)
+            self.words = []
+            self.typos = defaultdict(set)
+            self._doc_words = {}
+
+    def rebuild(self):
+        with self._lock:
+            # Read the version first; a change during the load just means
+            # one more rebuild later.
+            version = get_version()
+            self.clear()
+            for item in MenuItem.objects.order_by('id'):
+                self.add(item)
+            self.version = version
+
+    def ensure_current(self):
+        if self.version != get_version():
+            self.rebuild()
+
+    def add(self, item):
+        document = {
+            'id': item.id,
+            'name': item.name,
+            'price': str(item.price),
+            'category': item.category,
+            'station': item.station,
+            'tags': item.tag_list,
+            'sort_name': item.name.lower(),
+        }
+        fields = {
+            'name': item.name,
+            'tags': ' '.join(item.tag_list),
+            'station': item.station,
+            'category': item.get_category_display(),
+            'description': item.description,
+        }
+        weights = {}
+        for field, text in fields.items():
+            for word in tokenize(text):
+                weights[word] = max(weights.get(word, 0), FIELD_WEIGHTS[field])
+
+        with self._lock:
+            self.remove(item.id)
+            self.documents[item.id] = document
+            self._doc_words[item.id] = list(weights)
+            for word, weight in weights.items():
+                if word not in self.postings:
+                    insort(self.words, word)
+                    for key in _deletions(word) | {word}:
+                        self.typos[key].add(word)
+                self.postings[word][item.id] = weight
+
+    def remove(self, item_id):
+        with self._lock:
+            self.documents.pop(item_id, None)
+            for word in self._doc_words.pop(item_id, ()):
+                posting = self.postings[word]
+                posting.pop(item_id, None)
+                if posting:
+                    continue
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+                for key in _deletions(word) | {word}:
+                    self.typos[key].discard(word)
+                    if not self.typos[key]:
+                        del self.typos[key]
+
+    def _match(self, term):
+        """Item id -> score for one query word: its best exact, prefix or typo match."""
+        scores = {}
+
+        def score(words, quality):
+            for word in words:
+                for item_id, weight in self.postings[word].items():
+                    if quality * weight > scores.get(item_id, 0):
+                        scores[item_id] = quality * weight
+
+        # The last word of a search-as-you-type query is usually unfinished
+        completions = []
+        position = bisect_left(self.words, term)
+        while position < len(self.words) and self.words[position].startswith(term):
+            completions.append(self.words[position])
+            position += 1
+        score(completions[:1] if completions and completions[0] == term else (), EXACT)
+        score(completions, PREFIX)
+        if len(term) >= TYPO_MIN_LENGTH:
+            near = set()
+            for key in _deletions(term) | {term}:
+                near |= self.typos.get(key, set())
+            score(near, TYPO)
+        return scores
+
+    def _filter(self, item_ids, exclude, category, station, tags):
+        hits = []
+        for item_id in item_ids:
+            if item_id in exclude:
+                continue
+            document = self.documents[item_id]
+            if category and document['category'] != category:
+                continue
+            if station and document['station'].lower() != station:
+                continue
+            if tags and not tags.issubset(document['tags']):
+                continue
+            hits.append(document)
+        return hits
+
+    def search(self, query, category=None, station=None, tags=(), limit=20, exclude=()):
+        """
+        Items matching every word of ``query`` (or every item, if it has
+        none) and the facet filters, less the ids in ``exclude``. Returns
+        the ids of all matches, the best ``limit`` documents, and
+        category, station and tag counts across all matches.
+        """
+        terms = tokenize(query)
+        station = station.lower() if station else None
+        tags = set(tags)
+        with self._lock:
+            if terms:
+                scores = None
+                for term in dict.fromkeys(terms):
+                    matches = self._match(term)
+                    if scores is None:
+                        scores = matches
+                    else:
+                        scores = {item_id: scores[item_id] + s
+                                  for item_id, s in matches.items() if item_id in scores}
+                    if not scores:
+                        break
+            else:
+                scores = dict.fromkeys(self.documents, 0)
+
+            if not (exclude or category or station or tags):
+                hits = [self.documents[item_id] for item_id in scores]
+            else:
+                hits = self._filter(scores, exclude, category, station, tags)
+
+            categories = Counter(document['category'] for document in hits)
+            stations = Counter(document['station'] for document in hits if document['station'])
+            tag_counts = Counter(chain.from_iterable(document['tags'] for document in hits))
+            # Only the page being returned needs ranking
+            results = heapq.nsmallest(limit, hits, key=lambda document: (
+                -scores[document['id']], document['sort_name'])) if limit else []
+        return {
+            'total': len(hits),
+            'ids': [document['id'] for document in hits],
+            'results': [{key: document[key] for key in self.FIELDS} for document in results],
+            'facets': {
+                'category': dict(categories.most_common()),
+                'station': dict(stations.most_common()),
+                'tags': dict(tag_counts.most_common()),
+            },
+        }
+
+    def matching_ids(self, query):
+        """Ids of every item matching ``query``, for the admin changelist."""
+        self.ensure_current()
+        return self.search(query, limit=0)['ids']
+
+
+index = SearchIndex()
+
+
+def _apply(change, version):
+    # Keep up incrementally only if nothing else changed the menu since
+    # the last sync: menu_cache's receivers bump the version on every save
+    # and delete (they are connected first, as this module imports it),
+    # so a gap of more than one, e.g. from a rolled back save, means a
+    # rebuild.
+    with index._lock:
+        if index.version is not None and version == index.version + 1:
+            change()
+            index.version = version
+        else:
+            index.version = None
+
+
+@receiver(post_save, sender=MenuItem)
+def _index_item(sender, instance, **kwargs):
+    version = get_version()
+    transaction.on_commit(partial(_apply, partial(index.add, instance), version))
+
+
+@receiver(post_delete, sender=MenuItem)
+def _unindex_item(sender, instance, **kwargs):
+    version = get_version()
+    transaction.on_commit(partial(_apply, partial(index.remove, instance.pk), version))
@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+# Sent inside the transaction that creates an order, so that what receivers
+# write commits, or rolls back, with it (menu.feed records an OrderEvent).
+# Arguments: order, items (its OrderItems)
+order_placed = Signal()
+
+# Sent inside the transaction that changes existing orders, as above.
+# Arguments: order_ids, changes (dict of the fields that were updated)
+orders_updated = Signal()
+
+# Sent once the available_units totals of items stocked per outlet have
+# been refreshed after an outlet or its stock was edited. Orders, releases
+# and bulk updates queue their stock checks directly (menu.stock_monitor).
+# Arguments: item_ids, decreased (True if the change can only have
+# lowered stock)
+stock_changed = Signal()
@@ -1,154 +1,259 @@
 document.addEventListener('DOMContentLoaded', function () {
     initCartFunctionality();
     initMenuItems();
-    initCheckoutForm();
+    initMenuSearch();
+    initOfflineMenu();
+});
+
+// Don't lose queued cart changes when leaving the page
+window.addEventListener('pagehide', flushCartOps);
+// Send what was queued while offline, and catch the menu up
+window.addEventListener('online', function () {
+    flushCartOps();
+    syncMenu();
 });
 
 // Cart Management Functions
-function updateCartCount() {
-    fetch('/get-cart-count/')
-        .then(handleResponse)
-        .then(data => {
-            const cartCount = document.getElementById('cart-count');
-            if (cartCount && data.cart_count !== undefined) {
-                cartCount.textContent = data.cart_count;
-            }
-        })
-        .catch(error => console.error('Error updating cart count:', error));
+// Cart changes are queued and sent to /cart/ together, one request per burst.
+// The queue is kept in localStorage until the server has answered, so
+// changes made offline (or on a page closed mid-request) go out in one
+// batch once there is a connection. Each batch has an id; the server
+// applies a resent batch only once, so a batch is kept and sent again
+// until the server says it applied it.
+const CART_FLUSH_DELAY = 250;
+const CART_QUEUE_KEY = 'cart-queue';
+// Waits before resending a refused batch (403, 429, 5xx), doubling up to the max
+const CART_RETRY_DELAY = 2000;
+const CART_RETRY_MAX_DELAY = 60000;
+let cartQueue = loadCartQueue();
+let cartFlushTimer = null;
+let cartRetryDelay = CART_RETRY_DELAY;
+let cartSending = false;
+let cartState = null;
+
+function loadCartQueue() {
+    try {
+        const queue = JSON.parse(localStorage.getItem(CART_QUEUE_KEY));
+        if (queue && Array.isArray(queue.ops)) return queue;
+    } catch (error) {
+        // Storage disabled or unreadable: queue in memory only
+    }
+    return { batch: null, ops: [] };
+}
+
+function saveCartQueue() {
+    try {
+        if (cartQueue.batch || cartQueue.ops.length) {
+            localStorage.setItem(CART_QUEUE_KEY, JSON.stringify(cartQueue));
+        } else {
+            localStorage.removeItem(CART_QUEUE_KEY);
+        }
+    } catch (error) {
+        // Storage full or disabled
+    }
+}
+
+function queuedQuantity() {
+    const batchOps = cartQueue.batch ? cartQueue.batch.ops : [];
+    return batchOps.concat(cartQueue.ops)
+        .reduce((total, op) => total + (op.remove ? 0 : op.quantity), 0);
+}
+
+function readEmbeddedCart() {
+    const element = document.getElementById('cart-data');
+    if (!element) return null;
+    try {
+        return JSON.parse(element.textContent);
+    } catch (error) {
+        return null;
+    }
+}
+
+function setCartCount(count) {
+    const cartCount = document.getElementById('cart-count');
+    if (cartCount && count !== undefined) {
+        cartCount.textContent = count;
+    }
+}
+
+function renderCart(data) {
+    cartState = data;
+    setCartCount(data.cart_count);
+
+    const cartItemsContainer = document.getElementById('cart-items');
+    const totalAmountElement = document.getElementById('total-amount');
+    const checkoutBtn = document.getElementById('checkout-btn');
+
+    if (!cartItemsContainer || !totalAmountElement || !checkoutBtn) return;
+
+    cartItemsContainer.innerHTML = '';
+
+    if (data.success && data.items.length > 0) {
+        let total = 0;
+
+        data.items.forEach(item => {
+            const itemElement = document.createElement('div');
+            itemElement.className = 'cart-item';
+            itemElement.innerHTML = `
+                <div class="cart-item-info">
+                    <h4>${escapeHtml(item.name)}</h4>
+                    <p>${item.quantity} × Ksh ${item.price.toFixed(2)}</p>
+                    ${item.available ? '' : '<p class="stock-warning">Out of stock</p>'}
+                </div>
+                <div class="cart-item-total">
+                    <p>Ksh ${item.subtotal.toFixed(2)}</p>
+                    <button class="remove-item" data-id="${item.id}">Remove</button>
+                </div>
+            `;
+            cartItemsContainer.appendChild(itemElement);
+            total += item.subtotal;
+        });
+
+        totalAmountElement.textContent = total.toFixed(2);
+        checkoutBtn.style.display = 'block';
+
+        document.querySelectorAll('.remove-item').forEach(btn => {
+            btn.addEventListener('click', () => removeFromCart(btn.dataset.id));
+        });
+    } else {
+        cartItemsContainer.innerHTML = '<p>Your cart is empty</p>';
+        totalAmountElement.textContent = '0.00';
+        checkoutBtn.style.display = 'none';
+    }
 }
 
 function loadCartItems() {
-    fetch('/get-cart/')
+    if (cartState) {
+        renderCart(cartState);
+    }
+    // Revalidate with the server; an unchanged cart answers 304 from its ETag.
+    fetch('/cart/', { cache: 'no-cache' })
         .then(handleResponse)
-        .then(data => {
-            const cartItemsContainer = document.getElementById('cart-items');
-            const totalAmountElement = document.getElementById('total-amount');
-            const checkoutBtn = document.getElementById('checkout-btn');
-
-            if (!cartItemsContainer || !totalAmountElement || !checkoutBtn) return;
-
-            cartItemsContainer.innerHTML = '';
-
-            if (data.success && data.items.length > 0) {
-                let total = 0;
-
-                data.items.forEach(item => {
-                    const itemElement = document.createElement('div');
-                    itemElement.className = 'cart-item';
-                    itemElement.innerHTML = `
-                        <div class="cart-item-info">
-                            <h4>${escapeHtml(item.name)}</h4>
-                            <p>${item.quantity} × Ksh ${item.price.toFixed(2)}</p>
-                            ${item.available ? '' : '<p class="stock-warning">Out of stock</p>'}
-                        </div>
-                        <div class="cart-item-total">
-                            <p>Ksh ${item.subtotal.toFixed(2)}</p>
-                            <button class="remove-item" data-id="${item.id}">Remove</button>
-                        </div>
-                    `;
-                    cartItemsContainer.appendChild(itemElement);
-                    total += item.subtotal;
-                });
-
-                totalAmountElement.textContent = total.toFixed(2);
-                checkoutBtn.style.display = 'block';
-
-                document.querySelectorAll('.remove-item').forEach(btn => {
-                    btn.addEventListener('click', () => removeFromCart(btn.dataset.id));
-                });
-            } else {
-                cartItemsContainer.innerHTML = '<p>Your cart is empty</p>';
-                totalAmountElement.textContent = '0.00';
-                checkoutBtn.style.display = 'none';
-            }
-        })
+        .then(renderCart)
         .catch(error => {
             console.error('Error loading cart:', error);
             showToast('Failed to load cart items');
         });
 }
 
-function addToCart(itemId, quantity = 1) {
-    fetch('/add-to-cart/', {
+function queueCartOp(op) {
+    cartQueue.ops.push(op);
+    saveCartQueue();
+    clearTimeout(cartFlushTimer);
+    cartFlushTimer = setTimeout(flushCartOps, CART_FLUSH_DELAY);
+}
+
+function newBatchId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+function flushCartOps() {
+    // One batch in flight at a time; what's queued meanwhile goes next
+    if (cartSending) return;
+    if (!cartQueue.batch) {
+        if (cartQueue.ops.length === 0) return;
+        cartQueue.batch = { id: newBatchId(), ops: cartQueue.ops };
+        cartQueue.ops = [];
+        saveCartQueue();
+    }
+    if (!navigator.onLine) {
+        showToast("You're offline. Your cart will update when you're back online.");
+        return;
+    }
+
+    const batch = cartQueue.batch;
+    cartSending = true;
+    fetch('/cart/', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
             'X-CSRFToken': getCookie('csrftoken'),
         },
-        body: JSON.stringify({ item_id: itemId, quantity: quantity })
+        body: JSON.stringify({ batch: batch.id, ops: batch.ops }),
+        keepalive: true
     })
-    .then(handleResponse)
-    .then(data => {
-        if (data.success) {
-            updateCartCount();
-            showToast('Item added to cart');
-
-            const cartSidebar = document.getElementById('cart-sidebar');
-            if (cartSidebar && cartSidebar.style.right === '0px') {
-                loadCartItems();
-            }
-        } else {
-            showToast(data.error || 'Error adding to cart');
+    .then(response => {
+        if (response.status === 403 || response.status === 429 || response.status >= 500) {
+            // Not applied: keep the batch and try again later
+            retryCartBatch(response);
+            return;
         }
+        // Applied, or refused for good (a malformed batch): done with it
+        cartQueue.batch = null;
+        cartRetryDelay = CART_RETRY_DELAY;
+        saveCartQueue();
+        return handleResponse(response)
+            .then(data => {
+                renderCart(data);
+                if (data.errors && data.errors.length > 0) {
+                    showToast(data.errors[0].error || 'Some items could not be updated');
+                }
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                showToast('Failed to update cart');
+            });
+    }, () => {
+        // No connection: keep the batch and resend it once back online
+        showToast("You're offline. Your cart will update when you're back online.");
     })
-    .catch(error => {
-        console.error('Error:', error);
-        showToast('Failed to add item to cart');
+    .finally(() => {
+        cartSending = false;
+        if (!cartQueue.batch && cartQueue.ops.length > 0) {
+            flushCartOps();
+        }
     });
 }
 
+function retryCartBatch(response) {
+    const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+    const delay = isNaN(retryAfter) ? cartRetryDelay : retryAfter * 1000;
+    cartRetryDelay = Math.min(cartRetryDelay * 2, CART_RETRY_MAX_DELAY);
+    clearTimeout(cartFlushTimer);
+    cartFlushTimer = setTimeout(flushCartOps, delay);
+    showToast("Your cart couldn't be updated yet; trying again shortly.");
+}
+
+function addToCart(itemId, quantity = 1) {
+    queueCartOp({ item_id: itemId, quantity: quantity });
+    setCartCount(((cartState && cartState.cart_count) || 0) + queuedQuantity());
+    showToast('Item added to cart');
+}
+
 function removeFromCart(itemId) {
-    fetch('/remove-from-cart/', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-            'X-CSRFToken': getCookie('csrftoken'),
-        },
-        body: JSON.stringify({ item_id: itemId })
-    })
-    .then(handleResponse)
-    .then(data => {
-        if (data.success) {
-            updateCartCount();
-            loadCartItems();
-            showToast('Item removed from cart');
-        } else {
-            showToast(data.error || 'Error removing item');
-        }
-    })
-    .catch(error => {
-        console.error('Error:', error);
-        showToast('Failed to remove item');
-    });
+    queueCartOp({ item_id: itemId, remove: true });
+    showToast('Item removed from cart');
 }
 
 // Menu Items Functionality
 function initMenuItems() {
-    document.querySelectorAll('.add-to-cart').forEach(button => {
-        button.addEventListener('click', function () {
-            const menuItem = this.closest('.menu-item');
-            if (!menuItem) return;
-
-            const itemId = menuItem.dataset.id;
-            const quantityControls = menuItem.querySelector('.quantity-controls');
-            const quantityDisplay = quantityControls?.querySelector('.quantity');
-            const confirmBtn = quantityControls?.querySelector('.confirm-add');
-
-            if (!itemId || !quantityControls || !quantityDisplay || !confirmBtn) return;
-
-            quantityControls.style.display = 'flex';
-            this.style.display = 'none';
-            quantityDisplay.textContent = '1'; // Start with 1 instead of 0
-
-            confirmBtn.onclick = () => {
-                const quantity = parseInt(quantityDisplay.textContent);
-                if (!isNaN(quantity) && quantity > 0) {
-                    addToCart(itemId, quantity);
-                }
-                quantityControls.style.display = 'none';
-                this.style.display = 'block';
-            };
-        });
+    // Delegated, so cards added by the menu sync work too
+    document.addEventListener('click', function (e) {
+        const button = e.target.closest('.add-to-cart');
+        if (!button) return;
+        const menuItem = button.closest('.menu-item');
+        if (!menuItem) return;
+
+        const itemId = menuItem.dataset.id;
+        const quantityControls = menuItem.querySelector('.quantity-controls');
+        const quantityDisplay = quantityControls?.querySelector('.quantity');
+        const confirmBtn = quantityControls?.querySelector('.confirm-add');
+
+        if (!itemId || !quantityControls || !quantityDisplay || !confirmBtn) return;
+
+        quantityControls.style.display = 'flex';
+        button.style.display = 'none';
+        quantityDisplay.textContent = '1'; // Start with 1 instead of 0
+
+        confirmBtn.onclick = () => {
+            const quantity = parseInt(quantityDisplay.textContent);
+            if (!isNaN(quantity) && quantity > 0) {
+                addToCart(itemId, quantity);
+            }
+            quantityControls.style.display = 'none';
+            button.style.display = 'block';
+        };
     });
 
     // Quantity controls
@@ -168,6 +273,167 @@ function initMenuItems() {
     });
 }
 
+// Menu Search
+// Queries /search/ as the student types and hides the cards it doesn't return.
+const SEARCH_DELAY = 150;
+
+function initMenuSearch() {
+    const input = document.getElementById('menu-search');
+    const tagsContainer = document.getElementById('search-tags');
+    const empty = document.getElementById('search-empty');
+    if (!input || !tagsContainer) return;
+
+    const selectedTags = new Set();
+    let timer = null;
+    let latest = 0;
+
+    function showCards(ids) {
+        document.querySelectorAll('.menu-sections .menu-item').forEach(card => {
+            card.style.display = !ids || ids.has(card.dataset.id) ? '' : 'none';
+        });
+        if (empty) empty.style.display = ids && ids.size === 0 ? 'block' : 'none';
+    }
+
+    function renderTags(tags) {
+        tagsContainer.innerHTML = '';
+        Object.keys(tags).forEach(tag => {
+            const chip = document.createElement('button');
+            chip.type = 'button';
+            chip.className = 'search-tag' + (selectedTags.has(tag) ? ' selected' : '');
+            chip.textContent = `${tag} (${tags[tag]})`;
+            chip.addEventListener('click', () => {
+                if (selectedTags.has(tag)) {
+                    selectedTags.delete(tag);
+                } else {
+                    selectedTags.add(tag);
+                }
+                runSearch();
+            });
+            tagsContainer.appendChild(chip);
+        });
+    }
+
+    function runSearch() {
+        const params = new URLSearchParams({ q: input.value.trim() });
+        selectedTags.forEach(tag => params.append('tag', tag));
+        const request = ++latest;
+
+        fetch(`${input.dataset.url}?${params}`)
+            .then(handleResponse)
+            .then(data => {
+                // Answers can arrive out of order; only show the newest
+                if (request !== latest) return;
+                const filtering = input.value.trim() || selectedTags.size;
+                showCards(filtering ? new Set(data.ids.map(String)) : null);
+                renderTags(data.facets.tags);
+            })
+            .catch(() => showCards(null));
+    }
+
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(runSearch, SEARCH_DELAY);
+    });
+    // Fetch the tag filters once the student reaches for search, not on every page view
+    input.addEventListener('focus', runSearch, { once: true });
+}
+
+// Offline Menu
+// The service worker may have shown a saved copy of this page; the delta
+// sync brings its cards and announcements up to date, and again whenever
+// the connection comes back.
+let menuSync = null;
+
+function initOfflineMenu() {
+    const element = document.getElementById('menu-sync');
+    if (!element) return;
+    menuSync = JSON.parse(element.textContent);
+
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register(menuSync.service_worker).catch(error => {
+            console.error('Service worker registration failed:', error);
+        });
+    }
+    syncMenu();
+}
+
+function fetchMenuChanges(params) {
+    return fetch(`${menuSync.url}?${new URLSearchParams(params)}`, { cache: 'no-store' })
+        .then(handleResponse);
+}
+
+function syncMenu() {
+    if (!menuSync || !navigator.onLine) return;
+    fetchMenuChanges({ since: menuSync.watermark })
+        .then(data => {
+            menuSync.watermark = data.watermark;
+            const missing = applyMenuChanges(data);
+            // Rows that didn't change but this copy of the page never had,
+            // e.g. an item back in stock
+            if (missing.items.length || missing.announcements.length) {
+                return fetchMenuChanges({
+                    since: data.watermark,
+                    items: missing.items.join(','),
+                    announcements: missing.announcements.join(','),
+                }).then(applyMenuChanges);
+            }
+        })
+        .catch(error => console.error('Menu sync failed:', error));
+}
+
+function htmlElement(html) {
+    const template = document.createElement('template');
+    template.innerHTML = html.trim();
+    return template.content.firstElementChild;
+}
+
+function applyMenuChanges(data) {
+    const missing = { items: [], announcements: [] };
+
+    const cards = new Map();
+    document.querySelectorAll('.menu-sections .menu-item').forEach(card => {
+        cards.set(card.dataset.id, card);
+    });
+    data.items.forEach(item => {
+        const card = htmlElement(item.html);
+        const grid = document.querySelector(`.${item.category}-section .menu-grid`);
+        const old = cards.get(String(item.id));
+        if (old && old.parentElement === grid) {
+            old.replaceWith(card);
+        } else if (grid) {
+            if (old) old.remove();
+            grid.appendChild(card);
+        }
+        cards.set(String(item.id), card);
+    });
+    const inStock = new Set(data.in_stock.map(String));
+    cards.forEach((card, id) => {
+        if (!inStock.has(id)) card.remove();
+    });
+    inStock.forEach(id => {
+        if (!cards.has(id)) missing.items.push(id);
+    });
+
+    const list = document.querySelector('.announcement-list');
+    if (list) {
+        const shown = new Map();
+        list.querySelectorAll('.announcement').forEach(element => {
+            shown.set(element.dataset.id, element);
+        });
+        data.announcements.forEach(announcement => {
+            shown.set(String(announcement.id), htmlElement(announcement.html));
+        });
+        const ids = data.announcement_ids.map(String);
+        ids.forEach(id => {
+            if (!shown.has(id)) missing.announcements.push(id);
+        });
+        list.replaceChildren(...ids.filter(id => shown.has(id)).map(id => shown.get(id)));
+        const empty = document.querySelector('.no-announcements');
+        if (empty) empty.hidden = ids.length > 0;
+    }
+    return missing;
+}
+
 // Checkout Functionality
 function getCartItems() {
     const items = [];
@@ -227,7 +493,13 @@ function initCartFunctionality() {
         });
     }
 
-    updateCartCount();
+    cartState = readEmbeddedCart();
+    if (cartState) {
+        renderCart(cartState);
+        setCartCount(cartState.cart_count + queuedQuantity());
+    }
+    // Left over from a previous page, e.g. one used offline
+    flushCartOps();
 }
 
 // Utility Functions
@@ -0,0 +1,280 @@
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponseNotFound, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.html', '.xml')
+# Below this the headers outweigh what compression saves
+COMPRESS_MIN_SIZE = 512
+# ManifestStaticFilesStorage names files <name>.<12 hex digits>.<ext>
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_css_space = re.compile(r'\s*([{};,>])\s*')
+_css_colon = re.compile(r':\s+')
+_js_space = re.compile(r'[ \t]*\n\s*')
+
+# Comments starting like this are kept: licenses (/*!) and source maps (//#, /*#)
+KEPT_COMMENTS = ('/*!', '/*#', '//#')
+# After one of these characters, or words, a / starts a regular expression
+# rather than dividing
+_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_AFTER_WORDS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                      'throw', 'case', 'do', 'else', 'yield', 'await'}
+_word = re.compile(r'[\w$]+$')
+
+
+def _quoted(text, i):
+    # End of the string literal opening at text[i]
+    quote, i = text[i], i + 1
+    while i < len(text) and text[i] != quote:
+        i += 2 if text[i] == '\\' else 1
+    return i + 1
+
+
+def _comment(text, i):
+    # End of the comment opening at text[i], or None if there isn't one
+    if text.startswith('/*', i):
+        end = text.find('*/', i + 2)
+        return len(text) if end < 0 else end + 2
+    if text.startswith('//', i):
+        end = text.find('\n', i)
+        return len(text) if end < 0 else end
+    return None
+
+
+def _css_pieces(text):
+    # (code, literal) pairs: strings and kept comments are literals,
+    # other comments become a space
+    code, i, start = [], 0, 0
+    while i < len(text):
+        char = text[i]
+        if char in '"\'':
+            end = _quoted(text, i)
+        elif text.startswith('/*', i):
+            end = _comment(text, i)
+        else:
+            i += 1
+            continue
+        code.append(text[start:i])
+        literal = text[i:end]
+        if literal.startswith('/*') and not literal.startswith(KEPT_COMMENTS):
+            code.append(' ')
+            literal = ''
+        if literal:
+            yield ''.join(code), literal
+            code = []
+        i = start = end
+    yield ''.join(code) + text[start:], ''
+
+
+def _js_pieces(text):
+    # As _css_pieces, for strings, template literals (the code in their
+    # ${...} is code again) and regular expressions
+    code, i, start = [], 0, 0
+    # One entry per ${ we are inside: the depth of { } opened since
+    templates = []
+    last = ''  # the code before, for telling regexes from division
+
+    def previous():
+        return (''.join(code) + text[start:i]).rstrip() or last
+
+    while i < len(text):
+        char = text[i]
+        if char == '{' and templates:
+            templates[-1] += 1
+        elif char == '}' and templates and templates[-1]:
+            templates[-1] -= 1
+        elif char in '"\'`' or (char == '}' and templates):
+            # A string, or (part of) a template literal up to its end or next ${
+            if char in '"\'':
+                end = _quoted(text, i)
+            else:
+                if char == '}':
+                    templates.pop()
+                end = i + 1
+                while end < len(text) and text[end] != '`' and not text.startswith('${', end):
+                    end += 2 if text[end] == '\\' else 1
+                if text.startswith('${', end):
+                    templates.append(0)
+                    end += 1
+                end += 1
+            before = previous()
+            yield ''.join(code) + text[start:i], text[i:end]
+            code, i, start, last = [], end, end, before + text[end - 1]
+            continue
+        elif char == '/':
+            end = _comment(text, i)
+            if end is not None:
+                code.append(text[start:i])
+                if text.startswith(KEPT_COMMENTS, i):
+                    before = previous()
+                    yield ''.join(code), text[i:end]
+                    code, last = [], before
+                else:
+                    code.append('\n' if '\n' in text[i:end] else ' ')
+                i = start = end
+                continue
+            before = previous()
+            word = _word.search(before)
+            if not before or before[-1] in _REGEX_AFTER or (word and word.group() in _REGEX_AFTER_WORDS):
+                end, in_class = i + 1, False
+                while end < len(text) and (in_class or text[end] != '/') and text[end] != '\n':
+                    if text[end] == '\\':
+                        end += 1
+                    elif text[end] in '[]':
+                        in_class = text[end] == '['
+                    end += 1
+                end += 1
+                while end < len(text) and text[end].isalpha():
+                    end += 1  # flags
+                yield ''.join(code) + text[start:i], text[i:end]
+                # Like a string: a / after it divides
+                code, i, start, last = [], end, end, '"'
+                continue
+        i += 1
+    yield ''.join(code) + text[start:], ''
+
+
+def minify_css(text):
+    # Comments, indentation, the space around braces, semicolons and
+    # commas, and after colons (never before: "a :hover" is a different
+    # selector). Strings and license (/*!) and source map (/*#) comments
+    # are left exactly as they are.
+    minified = []
+    for code, literal in _css_pieces(text):
+        code = _css_space.sub(r'\1', code)
+        code = _css_colon.sub(':', code)
+        minified.append(re.sub(r'\s+', ' ', code).replace(';}', '}') + literal)
+    return ''.join(minified).strip()
+
+
+def minify_js(text):
+    # Only what can't change behaviour: comments, indentation and blank
+    # lines. Line breaks stay, so semicolon insertion is unaffected, and
+    # strings, template literals and regular expressions are left exactly
+    # as they are.
+    minified = ''.join(_js_space.sub('\n', code) + literal for code, literal in _js_pieces(text))
+    return minified.strip() + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that minifies CSS and JS as collectstatic
+    writes them, then stores gzip (and, if the brotli package is
+    installed, brotli) copies of each fingerprinted file next to it for
+    StaticFilesMiddleware to send.
+
+    Files the manifest doesn't know, or every file until collectstatic
+    has written one (as in development and tests), get their plain names
+    from {% static %} instead of raising.
+    """
+
+    def _save(self, name, content):
+        base, ext = os.path.splitext(name)
+        if ext in MINIFIERS and not base.endswith('.min'):
+            try:
+                text = b''.join(content.chunks()).decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                content = ContentFile(MINIFIERS[ext](text).encode('utf-8'))
+        return super()._save(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if not dry_run:
+            for name in set(self.hashed_files.values()):
+                self.compress(name)
+
+    def compress(self, name):
+        if not name.endswith(COMPRESSIBLE):
+            return
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return
+        variants = {'.gz': lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = lambda: brotli.compress(data, quality=11)
+        for suffix, compress in variants.items():
+            # A fingerprinted name always has the same content
+            if os.path.exists(path + suffix):
+                continue
+            compressed = compress()
+            if len(compressed) < len(data) * 0.9:
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+def _accepts(request, encoding):
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        token, _, params = part.strip().partition(';')
+        if token.strip() == encoding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def serve(request, path):
+    """
+    Send ``path`` from STATIC_ROOT, precompressed if the client takes it.
+    The response is a FileResponse, which WSGI servers with a
+    wsgi.file_wrapper (gunicorn, uWSGI) send with sendfile().
+    """
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        return HttpResponseNotFound()
+    try:
+        stat = os.stat(fullpath)
+    except OSError:
+        return HttpResponseNotFound()
+    if not os.path.isfile(fullpath) or path.endswith(('.gz', '.br')):
+        return HttpResponseNotFound()
+
+    hashed = bool(HASHED_NAME.search(path))
+    # A fingerprinted file never changes, so there's no need to revalidate
+    if not hashed and not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type, _ = mimetypes.guess_type(fullpath)
+    filename, encoding = fullpath, None
+    if path.endswith(COMPRESSIBLE):
+        for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+            if _accepts(request, name) and os.path.isfile(fullpath + suffix):
+                filename, encoding = fullpath + suffix, name
+                break
+
+    response = FileResponse(open(filename, 'rb'), content_type=content_type or 'application/octet-stream')
+    response.headers.pop('Content-Disposition', None)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if path.endswith(COMPRESSIBLE):
+        response['Vary'] = 'Accept-Encoding'
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = IMMUTABLE if hashed else f'public, max-age={settings.STATIC_MAX_AGE}'
+    return response
@@ -0,0 +1,191 @@
+from functools import reduce
+import operator
+
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Sum, When
+
+from .analytics import record_sale, remove_sales
+from .models import MenuItem, Order, OrderItem, OutletStock, PickupSlot
+from .outlets import choose_outlet, outlet_rows, refresh_totals, with_outlet_units
+from .signals import order_placed
+from .stock_monitor import check_stock
+
+
+class OutOfStock(Exception):
+    def __init__(self, lines):
+        self.lines = lines
+        names = ', '.join(line.name for line in lines)
+        super().__init__(f'Not enough stock for: {names}')
+
+
+class SlotFull(Exception):
+    def __init__(self, slot_id):
+        self.slot_id = slot_id
+        super().__init__('That pickup time is fully booked, please choose another.')
+
+
+def _decrement(queryset, key, quantities):
+    # One conditional UPDATE for the whole cart: every line must still have
+    # enough units or fewer rows than expected are touched. ``key`` is the
+    # menu item id field of ``queryset``'s rows.
+    guard = reduce(operator.or_, (
+        Q(**{key: item_id, 'available_units__gte': quantity})
+        for item_id, quantity in quantities.items()
+    ))
+    return queryset.filter(guard).update(available_units=Case(
+        *(When(**{key: item_id, 'then': F('available_units') - quantity})
+          for item_id, quantity in quantities.items()),
+        default=F('available_units'),
+        output_field=models.PositiveIntegerField(),
+    ))
+
+
+def _reserve_slot(slot_id):
+    # Same idea as _decrement: the counter only moves while there is room.
+    return PickupSlot.objects.open().filter(id=slot_id).update(reserved=F('reserved') + 1)
+
+
+def place_order(snapshot, customer_name, user=None, phone='', pickup_slot=None,
+                idempotency_key=None, outlet=None, pay=False):
+    """
+    Reserve stock for every line of ``snapshot`` (and a place in the
+    ``pickup_slot`` id, if given) and record the order.
+
+    Items stocked per outlet are taken from ``outlet``'s rows; without an
+    outlet, the least busy one that holds enough of them is chosen (see
+    menu.outlets.choose_outlet). Other items come from the shared
+    MenuItem.available_units, as they do when there are no outlets.
+
+    An ``idempotency_key`` that another order already has raises
+    IntegrityError, after everything here has been rolled back.
+
+    Everything happens in one transaction, including queueing the order's
+    tasks (the sales rollup, a stock check and, with ``pay``, the STK push
+    to ``phone``), so no order is committed without them. If any line is
+    short nothing is written and ``OutOfStock`` is raised with the
+    offending lines. A full or past slot raises ``SlotFull``.
+    """
+    quantities = {line.item_id: line.quantity for line in snapshot.lines}
+    if not quantities:
+        raise ValueError('Cannot place an order for an empty cart')
+
+    rows = outlet_rows(quantities)
+    if outlet is None:
+        outlet = choose_outlet(quantities, rows)
+    local = {item_id: quantities[item_id] for item_id in rows}
+    shared = {item_id: quantity for item_id, quantity in quantities.items() if item_id not in rows}
+
+    with transaction.atomic():
+        if ((shared and _decrement(MenuItem.objects, 'id', shared) != len(shared))
+                or (local and (outlet is None or _decrement(
+                    OutletStock.objects.filter(outlet=outlet), 'menu_item_id', local) != len(local)))):
+            current = dict(with_outlet_units(MenuItem.objects.filter(id__in=quantities), outlet)
+                           .values_list('id', 'outlet_units'))
+            short = [line for line in snapshot.lines
+                     if current.get(line.item_id, 0) < line.quantity]
+            raise OutOfStock(short)
+        if pickup_slot is not None and not _reserve_slot(pickup_slot):
+            raise SlotFull(pickup_slot)
+
+        order = Order.objects.create(
+            customer_name=customer_name, user=user, phone=phone, amount=snapshot.total,
+            pickup_slot_id=pickup_slot, idempotency_key=idempotency_key, outlet=outlet)
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                menu_item_id=line.item_id,
+                item_name=line.name,
+                item_price=line.price,
+                quantity=line.quantity
+            )
+            for line in snapshot.lines
+        ])
+        order_placed.send(sender=Order, order=order, items=items)
+        if local:
+            # After commit, in its own statement: see refresh_totals
+            transaction.on_commit(lambda: refresh_totals(local))
+        record_sale.delay(order.id)
+        check_stock.delay(list(quantities), decreased=True)
+        if pay:
+            # mpesa imports payments, which imports this module
+            from .mpesa import submit_payment
+            submit_payment(order, phone)
+    return order
+
+
+def _increment(queryset, conditions):
+    # ``conditions`` maps Q objects picking out single rows to units to add
+    return queryset.filter(reduce(operator.or_, conditions)).update(available_units=Case(
+        *(When(condition, then=F('available_units') + quantity)
+          for condition, quantity in conditions.items()),
+        default=F('available_units'),
+        output_field=models.PositiveIntegerField(),
+    ))
+
+
+def release_stock(order_ids):
+    """Return the units reserved by ``order_ids`` to their outlets or menu items."""
+    quantities = {}
+    for outlet_id, item_id, total in (
+            OrderItem.objects.filter(order_id__in=order_ids, menu_item__isnull=False)
+            .values('order__outlet_id', 'menu_item_id').annotate(total=Sum('quantity'))
+            .values_list('order__outlet_id', 'menu_item_id', 'total')):
+        quantities[outlet_id, item_id] = total
+    if not quantities:
+        return
+
+    item_ids = {item_id for _, item_id in quantities}
+    rows = outlet_rows(item_ids)
+    local, shared = {}, {}
+    for (outlet_id, item_id), quantity in quantities.items():
+        if outlet_id in rows.get(item_id, ()):
+            local[Q(outlet_id=outlet_id, menu_item_id=item_id)] = quantity
+        else:
+            # Not (or no longer) stocked at the outlet the order came from
+            shared[item_id] = shared.get(item_id, 0) + quantity
+    if local:
+        _increment(OutletStock.objects, local)
+        transaction.on_commit(lambda: refresh_totals(rows))
+    if shared:
+        _increment(MenuItem.objects, {Q(id=item_id): quantity for item_id, quantity in shared.items()})
+    check_stock.delay(list(item_ids))
+
+
+def release_slots(order_ids):
+    """Free the pickup slot places held by ``order_ids``."""
+    counts = dict(
+        Order.objects.filter(id__in=order_ids, pickup_slot__isnull=False)
+        .values('pickup_slot_id').annotate(n=Count('id'))
+        .values_list('pickup_slot_id', 'n')
+    )
+    if counts:
+        PickupSlot.objects.filter(id__in=counts).update(reserved=Case(
+            *(When(id=slot_id, then=F('reserved') - n) for slot_id, n in counts.items()),
+            default=F('reserved'),
+            output_field=models.PositiveIntegerField(),
+        ))
+
+
+def release_reservations(order_ids):
+    """Undo everything place_order reserved (and counted) for ``order_ids``."""
+    release_stock(order_ids)
+    release_slots(order_ids)
+    remove_sales(order_ids)
+
+
+def cancel_order(order):
+    """Put an order's reserved units back on the shelf and delete it."""
+    with transaction.atomic():
+        # A failed order has already been released
+        if order.payment_status != Order.PAYMENT_FAILED:
+            release_reservations([order.id])
+        order.delete()
+
+
+def cancel_orders(order_ids):
+    """cancel_order for many orders at once, in one transaction."""
+    with transaction.atomic():
+        orders = Order.objects.filter(id__in=order_ids)
+        release_reservations(list(
+            orders.exclude(payment_status=Order.PAYMENT_FAILED).values_list('id', flat=True)))
+        return orders.delete()
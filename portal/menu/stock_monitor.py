@@ -0,0 +1,130 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import MenuItem, Order, OrderItem, StockAlert
+from .signals import stock_changed
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+ALERT_FIELDS = ['level', 'available_units', 'velocity', 'empty_at', 'message',
+                'is_resolved', 'resolved_at', 'updated_at']
+
+
+def sell_through(item_ids, now=None):
+    """Units sold per hour over STOCK_VELOCITY_WINDOW, for ``item_ids``."""
+    now = now or timezone.now()
+    window = settings.STOCK_VELOCITY_WINDOW
+    sold = (
+        OrderItem.objects.filter(
+            menu_item_id__in=item_ids,
+            order__created_at__gte=now - datetime.timedelta(seconds=window))
+        .exclude(order__payment_status=Order.PAYMENT_FAILED)
+        .values('menu_item_id').annotate(units=Sum('quantity'))
+        .values_list('menu_item_id', 'units')
+    )
+    return {item_id: units * 3600 / window for item_id, units in sold}
+
+
+def _describe(item, velocity, empty_at):
+    if not item.available_units:
+        return f'{item.name} is sold out.'
+    message = f'{item.name}: {item.available_units} left (alert at {item.low_stock_threshold}).'
+    if empty_at:
+        minutes = max(round((empty_at - timezone.now()).total_seconds() / 60), 1)
+        message += f' Selling {velocity:.1f}/hour, empty in about {minutes} min.'
+    return message
+
+
+@task
+def check_stock(item_ids, decreased=False):
+    """
+    Bring the StockAlerts for ``item_ids`` up to date.
+
+    Items at or below their low_stock_threshold get an open alert with the
+    current sell-through velocity and predicted time-to-empty; items above
+    it have theirs resolved. Only the given items are looked at.
+
+    Repeats are rate-limited by STOCK_ALERT_COOLDOWN: an open alert is
+    refreshed at most that often (unless the item sells out), and an item
+    that dips again soon after its alert was resolved reopens that alert
+    instead of adding another.
+    """
+    now = timezone.now()
+    cooldown = now - datetime.timedelta(seconds=settings.STOCK_ALERT_COOLDOWN)
+    items = MenuItem.objects.filter(id__in=item_ids).only(
+        'id', 'name', 'available_units', 'low_stock_threshold')
+    low = {item.id: item for item in items if item.available_units <= item.low_stock_threshold}
+    healthy = [item.id for item in items if item.id not in low]
+
+    # A decrease can't bring stock back above the threshold
+    if healthy and not decreased:
+        StockAlert.objects.filter(menu_item_id__in=healthy, is_resolved=False).update(
+            is_resolved=True, resolved_at=now, updated_at=now)
+    if not low:
+        return
+
+    existing = {}
+    for alert in StockAlert.objects.filter(menu_item_id__in=low).filter(
+            Q(is_resolved=False) | Q(resolved_at__gte=cooldown)).order_by('is_resolved', '-created_at'):
+        existing.setdefault(alert.menu_item_id, alert)
+
+    due = {}
+    for item_id, item in low.items():
+        alert = existing.get(item_id)
+        level = StockAlert.LEVEL_LOW if item.available_units else StockAlert.LEVEL_OUT
+        if (alert is None or alert.is_resolved or alert.level != level
+                or alert.updated_at < cooldown):
+            due[item_id] = (item, alert, level)
+    if not due:
+        return
+
+    velocity = sell_through(due, now)
+    new, changed = [], []
+    for item_id, (item, alert, level) in due.items():
+        rate = velocity.get(item_id, 0)
+        empty_at = (now + datetime.timedelta(hours=item.available_units / rate)
+                    if rate and item.available_units else None)
+        if alert is None:
+            alert = StockAlert(menu_item_id=item_id)
+            new.append(alert)
+        else:
+            changed.append(alert)
+        alert.level = level
+        alert.available_units = item.available_units
+        alert.velocity = rate
+        alert.empty_at = empty_at
+        alert.message = _describe(item, rate, empty_at)
+        alert.is_resolved = False
+        alert.resolved_at = None
+        alert.updated_at = now
+
+    with transaction.atomic():
+        if new:
+            StockAlert.objects.bulk_create(new)
+        if changed:
+            StockAlert.objects.bulk_update(changed, ALERT_FIELDS)
+
+
+@receiver(stock_changed)
+def _stock_changed(sender, item_ids, decreased=False, **kwargs):
+    # Runs after outlet totals were refreshed; never let it fail the request
+    try:
+        check_stock.delay(list(item_ids), decreased=decreased)
+    except Exception:
+        logger.exception('Could not queue a stock check for items %s', item_ids)
+
+
+@receiver(post_save, sender=MenuItem)
+def _menu_item_saved(sender, instance, raw=False, **kwargs):
+    # Covers edits made one item at a time, e.g. in the admin; queued in
+    # the same transaction as the save
+    if not raw:
+        check_stock.delay([instance.id])
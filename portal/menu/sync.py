@@ -0,0 +1,54 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .menu_cache import item_cards, shown_announcements
+from .models import MenuItem
+from .outlets import in_stock_ids
+
+
+def menu_changes(since=None, outlet=None, item_ids=(), announcement_ids=()):
+    """
+    What a copy of the menu page taken at ``since`` needs to catch up: the
+    in-stock items and shown announcements saved since then (all of them,
+    without ``since``), plus those in ``item_ids`` and ``announcement_ids``
+    whatever their age, each with its rendered card. ``in_stock`` and
+    ``announcement_ids`` list everything the page should show now, so
+    the client drops the rest and asks by id for any it doesn't have.
+
+    ``watermark`` is the ``since`` to send next time. It is read before
+    anything else, and rows are matched from MENU_SYNC_OVERLAP seconds
+    before ``since``, so a save that commits while this runs is sent
+    again rather than missed.
+    """
+    watermark = timezone.now()
+    if since is not None:
+        since -= datetime.timedelta(seconds=settings.MENU_SYNC_OVERLAP)
+
+    in_stock = in_stock_ids(outlet)
+    changed = Q() if since is None else Q(updated_at__gte=since) | Q(id__in=item_ids)
+    items = [item for item in MenuItem.objects.filter(changed).order_by('id')
+             .values('id', 'name', 'price', 'category') if item['id'] in in_stock]
+    cards = item_cards(item['id'] for item in items)
+
+    announcements = list(shown_announcements())
+    return {
+        'watermark': watermark.isoformat(),
+        'items': [
+            {**item, 'price': str(item['price']), 'html': cards[item['id']]}
+            for item in items if item['id'] in cards
+        ],
+        'in_stock': sorted(in_stock),
+        'announcements': [
+            {
+                'id': announcement.id,
+                'html': render_to_string('partials/announcement.html', {'announcement': announcement}),
+            }
+            for announcement in announcements
+            if since is None or announcement.updated_at >= since or announcement.id in announcement_ids
+        ],
+        'announcement_ids': [announcement.id for announcement in announcements],
+    }
@@ -0,0 +1,233 @@
+import datetime
+import logging
+import os
+import random
+import socket
+import traceback
+import uuid
+from collections import defaultdict
+from functools import partial
+from importlib import import_module
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# name -> function, filled in as modules using @task are imported
+TASKS = {}
+
+
+class Retry(Exception):
+    """Raise from a task to have it run again later, if it has attempts left."""
+
+
+def task(func=None, *, max_attempts=None, retry_for=(Exception,), on_dead=None):
+    """
+    Register ``func`` as a task and give it ``func.delay(*args, **kwargs)``,
+    which queues a call to it (arguments must be JSON serializable).
+
+    A call that raises one of ``retry_for`` is run again, after
+    TASK_RETRY_DELAY seconds doubling with each attempt, until it has been
+    tried ``max_attempts`` times (TASK_MAX_ATTEMPTS by default). Any other
+    exception, or the last failure, marks the task dead and calls
+    ``on_dead`` with the same arguments.
+    """
+    if func is None:
+        return partial(task, max_attempts=max_attempts, retry_for=retry_for, on_dead=on_dead)
+
+    func.task_name = f'{func.__module__}.{func.__name__}'
+    func.max_attempts = max_attempts
+    func.retry_for = (Retry, *retry_for)
+    func.on_dead = on_dead
+    func.delay = partial(enqueue, func)
+    TASKS[func.task_name] = func
+    return func
+
+
+def enqueue(func, *args, **kwargs):
+    """
+    Queue a call to the task ``func``. The row is written in the current
+    transaction, so a rolled back order takes its tasks with it.
+
+    With TASKS_EAGER the first attempt is made in this process instead,
+    once the transaction commits; if it should be retried, the rest are
+    queued for a worker as usual.
+    """
+    max_attempts = func.max_attempts or settings.TASK_MAX_ATTEMPTS
+    if settings.TASKS_EAGER:
+        transaction.on_commit(partial(_run_eager, func, list(args), kwargs, max_attempts))
+        return None
+    return Task.objects.create(name=func.task_name, args=list(args), kwargs=kwargs,
+                               max_attempts=max_attempts)
+
+
+def _run_eager(func, args, kwargs, max_attempts):
+    status, error = _call(func, args, kwargs, last_attempt=max_attempts <= 1)
+    if status == Task.STATUS_QUEUED:
+        logger.warning('Task %s failed (attempt 1 of %s), will retry: %s',
+                       func.task_name, max_attempts, error)
+        Task.objects.create(
+            name=func.task_name, args=args, kwargs=kwargs, max_attempts=max_attempts, attempts=1,
+            run_at=timezone.now() + datetime.timedelta(seconds=retry_delay(1)),
+            last_error=_describe(error))
+
+
+def get_task(name):
+    if name not in TASKS:
+        # Registered when its module is imported
+        module = name.rpartition('.')[0]
+        try:
+            import_module(module)
+        except ImportError:
+            pass
+    return TASKS.get(name)
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the ``attempts``-th failure, with some jitter."""
+    delay = min(settings.TASK_RETRY_DELAY * 2 ** (attempts - 1), settings.TASK_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _call(func, args, kwargs, last_attempt):
+    """Make one attempt at a task; returns the status it ends in and its error."""
+    try:
+        func(*args, **kwargs)
+    except func.retry_for as e:
+        if not last_attempt:
+            return Task.STATUS_QUEUED, e
+        error = e
+    except Exception as e:
+        error = e
+    else:
+        return Task.STATUS_DONE, None
+
+    logger.error('Task %s failed for good', func.task_name, exc_info=error)
+    if func.on_dead is not None:
+        try:
+            func.on_dead(*args, **kwargs)
+        except Exception:
+            logger.exception('on_dead of task %s failed', func.task_name)
+    return Task.STATUS_DEAD, error
+
+
+def claim(limit, worker):
+    """
+    Mark up to ``limit`` tasks that are due as running under ``worker``
+    and return them, oldest first. Tasks whose worker went away
+    (running past locked_until) are claimed again.
+
+    Each row is claimed by a conditional UPDATE, so when several workers
+    race for the same tasks each one goes to exactly one of them.
+    """
+    now = timezone.now()
+    due = (Q(status=Task.STATUS_QUEUED, run_at__lte=now)
+           | Q(status=Task.STATUS_RUNNING, locked_until__lt=now))
+    ids = list(Task.objects.filter(due).order_by('run_at', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    Task.objects.filter(due, id__in=ids).update(
+        status=Task.STATUS_RUNNING, worker=worker, started_at=now, attempts=F('attempts') + 1,
+        locked_until=now + datetime.timedelta(seconds=settings.TASK_TIMEOUT))
+    return list(Task.objects.filter(id__in=ids, worker=worker, status=Task.STATUS_RUNNING,
+                                    started_at=now).order_by('run_at', 'id'))
+
+
+def run(task_row):
+    """Run a claimed task and record the outcome: done, queued for a retry, or dead."""
+    func = get_task(task_row.name)
+    if func is None:
+        logger.error('No task called %s', task_row.name)
+        changes = {'status': Task.STATUS_DEAD, 'last_error': f'No task called {task_row.name}'}
+    else:
+        status, error = _call(func, task_row.args, task_row.kwargs,
+                              last_attempt=task_row.attempts >= task_row.max_attempts)
+        changes = {'status': status}
+        if error is not None:
+            changes['last_error'] = _describe(error)
+        if status == Task.STATUS_QUEUED:
+            logger.warning('Task %s #%s failed (attempt %s of %s), will retry: %s', task_row.name,
+                           task_row.id, task_row.attempts, task_row.max_attempts, error)
+            changes['run_at'] = timezone.now() + datetime.timedelta(
+                seconds=retry_delay(task_row.attempts))
+    if changes['status'] != Task.STATUS_QUEUED:
+        changes['finished_at'] = timezone.now()
+    # Unless its lock ran out and another worker has taken it over
+    Task.objects.filter(id=task_row.id, worker=task_row.worker, started_at=task_row.started_at).update(
+        locked_until=None, **changes)
+    return changes['status']
+
+
+def _describe(error):
+    return ''.join(traceback.format_exception(error))[-4000:]
+
+
+def new_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+def prune(older_than=None):
+    """Delete done tasks finished more than TASK_KEEP_DONE seconds ago. Dead ones are kept."""
+    older_than = older_than or timezone.now() - datetime.timedelta(seconds=settings.TASK_KEEP_DONE)
+    deleted, _ = Task.objects.filter(status=Task.STATUS_DONE, finished_at__lt=older_than).delete()
+    return deleted
+
+
+def requeue(queryset):
+    """Give dead tasks a fresh set of attempts (the admin's retry action)."""
+    return queryset.filter(status=Task.STATUS_DEAD).update(
+        status=Task.STATUS_QUEUED, attempts=0, run_at=timezone.now(), worker='',
+        started_at=None, finished_at=None)
+
+
+def render_metrics(now=None):
+    """
+    Queue depth and latency in Prometheus text format, read from the
+    tasks table so they cover every worker process.
+    """
+    now = now or timezone.now()
+    depth = defaultdict(dict)
+    oldest = {}
+    rows = (Task.objects.exclude(status=Task.STATUS_DONE).values('name', 'status')
+            .annotate(count=Count('id'), oldest=Min('run_at')))
+    for row in rows:
+        depth[row['name']][row['status']] = row['count']
+        if row['status'] == Task.STATUS_QUEUED and row['oldest'] <= now:
+            oldest[row['name']] = (now - row['oldest']).total_seconds()
+
+    window = now - datetime.timedelta(seconds=settings.TASK_METRICS_WINDOW)
+    waited = defaultdict(lambda: [0, 0.0, 0.0])
+    for name, run_at, started_at, finished_at in Task.objects.filter(
+            status=Task.STATUS_DONE, finished_at__gte=window).values_list(
+            'name', 'run_at', 'started_at', 'finished_at').iterator():
+        stats = waited[name]
+        stats[0] += 1
+        stats[1] += max((started_at - run_at).total_seconds(), 0)
+        stats[2] += (finished_at - started_at).total_seconds()
+
+    lines = [
+        '# HELP portal_task_queue_depth Tasks not yet done, by task and status.',
+        '# TYPE portal_task_queue_depth gauge',
+    ]
+    for name, counts in sorted(depth.items()):
+        for status in (Task.STATUS_QUEUED, Task.STATUS_RUNNING, Task.STATUS_DEAD):
+            lines.append(f'portal_task_queue_depth{{task="{name}",status="{status}"}} {counts.get(status, 0)}')
+    lines.append('# HELP portal_task_oldest_seconds How long the oldest due task has been waiting.')
+    lines.append('# TYPE portal_task_oldest_seconds gauge')
+    for name in sorted(depth):
+        lines.append(f'portal_task_oldest_seconds{{task="{name}"}} {oldest.get(name, 0)}')
+    lines.append(f'# HELP portal_task_wait_seconds Mean time from due to started, '
+                 f'over tasks done in the last {settings.TASK_METRICS_WINDOW}s.')
+    lines.append('# TYPE portal_task_wait_seconds gauge')
+    for name, (count, wait, _) in sorted(waited.items()):
+        lines.append(f'portal_task_wait_seconds{{task="{name}"}} {wait / count}')
+    lines.append('# HELP portal_task_run_seconds Mean run time over the same tasks.')
+    lines.append('# TYPE portal_task_run_seconds gauge')
+    for name, (count, _, seconds) in sorted(waited.items()):
+        lines.append(f'portal_task_run_seconds{{task="{name}"}} {seconds / count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,105 @@
+// Service worker: keeps the menu usable when the campus connection drops.
+// The menu page is fetched from the network when it answers in time and
+// from the last copy otherwise; main.js then brings the copy up to date
+// through the delta sync endpoint. Fingerprinted assets and menu images
+// never change under the same URL, so they are served from the cache.
+const CACHE_VERSION = '{{ cache_version }}';
+const SHELL_CACHE = `menu-shell-${CACHE_VERSION}`;
+const IMAGE_CACHE = 'menu-images';
+const PRECACHE = {{ precache|safe }};
+const MENU_URL = '{{ menu_url }}';
+const STATIC_URL = '{{ static_url }}';
+const MEDIA_URL = '{{ media_url }}';
+// Past this, show the saved menu rather than keep the student waiting
+const NETWORK_TIMEOUT = 3000;
+const MAX_IMAGES = 200;
+// ManifestStaticFilesStorage names files <name>.<12 hex digits>.<ext>
+const HASHED_NAME = /\.[0-9a-f]{12}\.[^./]+$/;
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.addAll(PRECACHE))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    const current = [SHELL_CACHE, IMAGE_CACHE];
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names
+                .filter(name => name.startsWith('menu-') && !current.includes(name))
+                .map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (request.mode === 'navigate' && url.pathname === MENU_URL) {
+        event.respondWith(networkFirst(request));
+    } else if (url.pathname.startsWith(MEDIA_URL)) {
+        event.respondWith(cacheFirst(request, IMAGE_CACHE, MAX_IMAGES));
+    } else if (url.pathname.startsWith(STATIC_URL)) {
+        event.respondWith(HASHED_NAME.test(url.pathname)
+            ? cacheFirst(request, SHELL_CACHE)
+            : staleWhileRevalidate(request, SHELL_CACHE));
+    }
+});
+
+function cacheable(response) {
+    // Pages with a flash message are sent no-store (menu_view)
+    return response.ok && !/no-store/.test(response.headers.get('Cache-Control') || '');
+}
+
+function networkFirst(request) {
+    const network = fetch(request).then(response => {
+        if (cacheable(response)) {
+            const copy = response.clone();
+            caches.open(SHELL_CACHE).then(cache => cache.put(MENU_URL, copy));
+        }
+        return response;
+    });
+    // If the timeout wins, the fetch still goes on to refresh the saved copy
+    network.catch(() => {});
+    const timeout = new Promise(resolve => setTimeout(resolve, NETWORK_TIMEOUT));
+    const saved = () => caches.match(MENU_URL, { cacheName: SHELL_CACHE });
+
+    return Promise.race([network, timeout.then(saved)])
+        .then(response => response || network)
+        .catch(() => saved().then(response => response || Promise.reject(new Error('offline'))));
+}
+
+function cacheFirst(request, cacheName, limit) {
+    return caches.open(cacheName).then(cache => cache.match(request).then(cached => {
+        if (cached) return cached;
+        return fetch(request).then(response => {
+            if (cacheable(response)) {
+                cache.put(request, response.clone()).then(() => limit && trim(cache, limit));
+            }
+            return response;
+        });
+    }));
+}
+
+function staleWhileRevalidate(request, cacheName) {
+    return caches.open(cacheName).then(cache => cache.match(request).then(cached => {
+        const network = fetch(request).then(response => {
+            if (cacheable(response)) cache.put(request, response.clone());
+            return response;
+        });
+        if (!cached) return network;
+        network.catch(() => {});
+        return cached;
+    }));
+}
+
+function trim(cache, limit) {
+    // Keys come back in insertion order: drop the oldest
+    return cache.keys().then(keys => Promise.all(
+        keys.slice(0, Math.max(keys.length - limit, 0)).map(key => cache.delete(key))));
+}
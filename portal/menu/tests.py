@@ -1,3 +1,1859 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import (
+    Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from django.test.utils import CaptureQueriesContext
+from django.template.backends.django import Template as DjangoTemplate
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils import timezone
+
+from . import tasks
+from .analytics import rebuild, record_sale, remove_sales
+from .archive import _PartitionWriter, archive_orders, find_archived_order
+from .benchutils import find_regressions, make_orders
+from .cart import price_cart
+from .cart_storage import get_cart_storage
+from .feed import OrderFeed, feed, prune_events
+from .images import variant_name
+from .kitchen import advance_orders
+from .menu_cache import bump_version, get_version
+from .metrics import registry
+from .models import (
+    Announcement, HeldPayment, HourlySales, MenuItem, Order, OrderArchive, OrderEvent, OrderItem, Outlet,
+    OutletStock, PickupSlot, SalesRollup, StockAlert, Task,
+)
+from .mpesa import (
+    MpesaClient, MpesaError, MpesaUnavailable, callback_url, initiate_mpesa_payment, request_payment,
+)
+from .mpesa_fake import FakeMpesaServer
+from .payments import PaymentResult, apply_payment_results, record_checkout
+from .ratelimit import take_token
+from .search import index as search_index
+from .staticfiles import _js_pieces, minify_css, minify_js
+from .stock import OutOfStock, SlotFull, cancel_order, place_order
+from .stock_monitor import check_stock
+
+
+def setUpModule():
+    # Keep the fragments rendered here out of the development menu cache,
+    # and start from an empty one as a fresh process would
+    if 'filebased' in settings.CACHES[settings.MENU_CACHE_ALIAS]['BACKEND']:
+        tmpdir = tempfile.mkdtemp()
+        unittest.addModuleCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        unittest.enterModuleContext(override_settings(CACHES={
+            **settings.CACHES,
+            settings.MENU_CACHE_ALIAS: {**settings.CACHES[settings.MENU_CACHE_ALIAS], 'LOCATION': tmpdir},
+        }))
+
+
+def make_items(count, **kwargs):
+    kwargs.setdefault('available_units', 50)
+    kwargs.setdefault('category', 'food')
+    return [
+        MenuItem.objects.create(name=f'Item {i}', price=Decimal('10.50') + i, **kwargs)
+        for i in range(count)
+    ]
+
+
+def _cart_storage(client):
+    request = RequestFactory().get('/')
+    request.COOKIES = {name: morsel.value for name, morsel in client.cookies.items()}
+    request.session = client.session
+    return get_cart_storage(request)
+
+
+def set_cart(client, cart):
+    """Store ``cart`` for ``client`` in whichever CART_STORAGE is configured."""
+    storage = _cart_storage(client)
+    storage.save(cart)
+    storage.request.session.save()
+    response = HttpResponse()
+    storage.update_response(response)
+    client.cookies.update(response.cookies)
+
+
+def get_cart(client):
+    return _cart_storage(client).load()
+
+
+class CartTestMixin:
+    def set_cart(self, cart):
+        set_cart(self.client, cart)
+
+    def count_queries(self, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, **kwargs)
+        return response, len(ctx.captured_queries)
+
+
+class PriceCartTests(TestCase):
+    def test_snapshot_totals(self):
+        rice, juice = make_items(2)
+        MenuItem.objects.filter(id=juice.id).update(available_units=0)
+        snapshot = price_cart({str(rice.id): 2, str(juice.id): 1, '999999': 3})
+
+        self.assertEqual([line.item_id for line in snapshot.lines], [rice.id, juice.id])
+        self.assertEqual(snapshot.missing, [999999])
+        self.assertEqual(snapshot.total, rice.price * 2 + juice.price)
+        self.assertEqual(snapshot.count, 3)
+        self.assertTrue(snapshot.lines[0].available)
+        self.assertFalse(snapshot.lines[1].available)
+        self.assertFalse(snapshot.all_in_stock)
+
+    def test_single_query(self):
+        items = make_items(10)
+        with self.assertNumQueries(1):
+            price_cart({str(item.id): 1 for item in items})
+        with self.assertNumQueries(0):
+            price_cart({})
+
+
+class CartQueryCountTests(CartTestMixin, TestCase):
+    def assertConstantQueries(self, method, url, **kwargs):
+        items = make_items(10)
+        counts = []
+        for size in (1, 10):
+            self.set_cart({str(item.id): 1 for item in items[:size]})
+            response, queries = self.count_queries(method, url, **kwargs)
+            self.assertLess(response.status_code, 400)
+            counts.append(queries)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_get_cart(self):
+        self.assertConstantQueries('get', reverse('get_cart'))
+
+    def test_checkout(self):
+        self.assertConstantQueries('get', reverse('checkout'))
+
+    def test_combined_cart(self):
+        self.assertConstantQueries('get', reverse('cart'))
+
+    def test_confirm_order(self):
+        self.assertConstantQueries('post', reverse('confirm_order'),
+                                   data={'name': 'Wanjiru', 'phone': '254700000000'})
+
+
+class PlaceOrderTests(TestCase):
+    def test_reserves_all_lines(self):
+        rice, juice = make_items(2, available_units=5)
+        order = place_order(price_cart({str(rice.id): 2, str(juice.id): 5}), 'Otieno')
+
+        rice.refresh_from_db()
+        juice.refresh_from_db()
+        self.assertEqual((rice.available_units, juice.available_units), (3, 0))
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.total_amount(), rice.price * 2 + juice.price * 5)
+
+    def test_short_line_rolls_back(self):
+        rice, juice = make_items(2, available_units=5)
+        snapshot = price_cart({str(rice.id): 2, str(juice.id): 6})
+
+        with self.assertRaises(OutOfStock) as ctx:
+            place_order(snapshot, 'Otieno')
+
+        self.assertEqual([line.item_id for line in ctx.exception.lines], [juice.id])
+        self.assertEqual(MenuItem.objects.get(id=rice.id).available_units, 5)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_cancel_restores_stock(self):
+        rice, = make_items(1, available_units=5)
+        order = place_order(price_cart({str(rice.id): 4}), 'Otieno')
+        cancel_order(order)
+
+        self.assertEqual(MenuItem.objects.get(id=rice.id).available_units, 5)
+        self.assertFalse(Order.objects.exists())
+
+    @override_settings(TASKS_EAGER=True)
+    @mock.patch('menu.mpesa.initiate_mpesa_payment', return_value={'ResponseCode': '1'})
+    def test_failed_payment_releases_stock(self, _):
+        rice, = make_items(1, available_units=5)
+        set_cart(self.client, {str(rice.id): 3})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('confirm_order'), {'name': 'Otieno', 'phone': '254700000000'})
+
+        self.assertEqual(MenuItem.objects.get(id=rice.id).available_units, 5)
+        self.assertEqual(Order.objects.get().payment_status, Order.PAYMENT_FAILED)
+
+
+def make_slot(minutes_ahead=60, capacity=2):
+    start = timezone.now() + datetime.timedelta(minutes=minutes_ahead)
+    return PickupSlot.objects.create(
+        start=start, end=start + datetime.timedelta(minutes=15), capacity=capacity)
+
+
+class PickupSlotTests(CartTestMixin, TestCase):
+    def setUp(self):
+        self.rice, = make_items(1, available_units=10)
+        self.snapshot = price_cart({str(self.rice.id): 1})
+
+    def test_capacity_is_never_exceeded(self):
+        slot = make_slot(capacity=2)
+        for _ in range(2):
+            place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id)
+        with self.assertRaises(SlotFull):
+            place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id)
+
+        slot.refresh_from_db()
+        self.assertEqual((slot.reserved, slot.remaining), (2, 0))
+        self.assertEqual(Order.objects.filter(pickup_slot=slot).count(), 2)
+        # The stock taken for the rejected order was rolled back too
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 8)
+
+    def test_slot_too_soon_is_rejected(self):
+        slot = make_slot(minutes_ahead=5)
+        with self.assertRaises(SlotFull):
+            place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id)
+
+    def test_failed_payment_and_cancel_free_the_slot(self):
+        slot = make_slot()
+        failed = place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id)
+        cancelled = place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id)
+
+        record_checkout(failed.id, {'ResponseCode': '1'})
+        cancel_order(cancelled)
+        self.assertEqual(PickupSlot.objects.get().reserved, 0)
+
+    def test_deleting_orders_gives_back_stock_and_slots(self):
+        slot = make_slot(capacity=5)
+        orders = [place_order(self.snapshot, 'Akinyi', pickup_slot=slot.id) for _ in range(3)]
+        self.client.force_login(User.objects.create_superuser('admin'))
+
+        response = self.client.post(reverse('delete_order', args=[orders[0].id]))
+        self.assertRedirects(response, reverse('order_list'), fetch_redirect_response=False)
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 8)
+        self.assertEqual(PickupSlot.objects.get().reserved, 2)
+
+        self.client.post(reverse('admin:menu_order_changelist'), {
+            'action': 'delete_selected', 'post': 'yes',
+            '_selected_action': [order.id for order in orders[1:]],
+        })
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 10)
+        self.assertEqual(PickupSlot.objects.get().reserved, 0)
+
+    def test_confirm_order_requires_a_slot(self):
+        slot = make_slot()
+        data = {'name': 'Akinyi', 'phone': '254700000000'}
+        self.set_cart({str(self.rice.id): 1})
+
+        self.client.post(reverse('confirm_order'), data)
+        self.assertFalse(Order.objects.exists())
+
+        self.client.post(reverse('confirm_order'), {**data, 'pickup_slot': slot.id})
+        self.assertEqual(Order.objects.get().pickup_slot, slot)
+        self.assertContains(self.client.get(reverse('menu')), '1 left')
+
+    def test_create_slots(self):
+        args = ['--date', '2030-01-07', '--open', '12:00', '--close', '14:00', '--minutes', '30']
+        call_command('create_slots', *args, stdout=io.StringIO())
+        call_command('create_slots', *args, '--days', '2', stdout=io.StringIO())
+        self.assertEqual(PickupSlot.objects.count(), 8)
+
+
+class RateLimitTests(CartTestMixin, TestCase):
+    def setUp(self):
+        caches['ratelimit'].clear()
+        self.addCleanup(caches['ratelimit'].clear)
+
+    @override_settings(RATE_LIMITS={'checkout': (2, 60)})
+    def test_budget_exhausted_returns_429(self):
+        self.client.get(reverse('checkout'))
+        for _ in range(2):
+            self.assertEqual(self.client.post(reverse('confirm_order')).status_code, 302)
+        response = self.client.post(reverse('confirm_order'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertFalse(response.json()['success'])
+
+        # The checkout form is sent back with a message instead
+        response = self.client.post(reverse('confirm_order'), follow=True)
+        self.assertRedirects(response, reverse('checkout'))
+        self.assertContains(response, 'Too many attempts')
+
+    @override_settings(RATE_LIMITS={'checkout': (5, 60)}, RATE_LIMIT_IP_MULTIPLIERS={'checkout': 60})
+    def test_checkout_ip_bucket_fits_the_campus(self):
+        def request(session_key):
+            request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+            request.session = mock.Mock(session_key=session_key)
+            return request
+
+        # 300 students behind the NAT checking out in the same minute
+        self.assertFalse(any(take_token(request(f's{i}'), 'checkout', now=0) for i in range(300)))
+        self.assertTrue(take_token(request('s300'), 'checkout', now=0))
+
+    @override_settings(RATE_LIMITS={'checkout': (2, 60)})
+    def test_checkout_needs_a_server_issued_session(self):
+        response = self.client.post(reverse('confirm_order'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse('confirm_order'), follow=True)
+        self.assertRedirects(response, reverse('checkout'))
+        self.assertContains(response, 'session has expired')
+
+        # The checkout page started a session; a new CSRF cookie per attempt
+        # doesn't get a new bucket
+        statuses = []
+        for i in range(3):
+            self.client.cookies['csrftoken'] = str(i) * 32
+            statuses.append(self.client.post(reverse('confirm_order'),
+                                             HTTP_ACCEPT='application/json').status_code)
+        self.assertEqual(statuses, [302, 302, 429])
+
+    @override_settings(RATE_LIMITS={'cart': (2, 60)}, RATE_LIMIT_IP_MULTIPLIER=2)
+    def test_buckets_refill_and_ip_is_shared(self):
+        def request(ip, session_key):
+            request = RequestFactory().get('/', REMOTE_ADDR=ip)
+            request.session = mock.Mock(session_key=session_key)
+            return request
+
+        first, second = request('10.0.0.1', 'abc'), request('10.0.0.1', 'def')
+        self.assertEqual([take_token(first, 'cart', now=0) for _ in range(3)], [0, 0, 30])
+        self.assertEqual([take_token(second, 'cart', now=0) for _ in range(2)], [0, 0])
+        # A third session behind the same address finds its bucket empty
+        self.assertEqual(take_token(request('10.0.0.1', 'ghi'), 'cart', now=0), 15)
+        self.assertEqual(take_token(request('10.0.0.2', 'jkl'), 'cart', now=0), 0)
+        self.assertEqual(take_token(first, 'cart', now=30), 0)
+
+    @mock.patch('menu.mpesa.submit_payment')
+    def test_resubmitted_checkout_places_one_order(self, submit_payment):
+        rice, = make_items(1, available_units=5)
+        self.set_cart({str(rice.id): 2})
+        key = self.client.get(reverse('checkout')).context['idempotency_key']
+        form = {'name': 'Wanjiru', 'phone': '254700000000', 'idempotency_key': key}
+
+        self.client.post(reverse('confirm_order'), form)
+        self.set_cart({str(rice.id): 2})
+        response = self.client.post(reverse('confirm_order'), form, follow=True)
+        self.assertContains(response, 'already placed')
+
+        self.assertEqual(Order.objects.filter(idempotency_key=key).count(), 1)
+        self.assertEqual(MenuItem.objects.get(id=rice.id).available_units, 3)
+        self.assertEqual(submit_payment.call_count, 1)
+        self.assertEqual(get_cart(self.client), {})
+
+    def test_duplicate_key_rolls_back_reservation(self):
+        rice, = make_items(1, available_units=5)
+        snapshot = price_cart({str(rice.id): 2})
+        place_order(snapshot, 'Wanjiru', idempotency_key='k1')
+        with self.assertRaises(IntegrityError):
+            place_order(snapshot, 'Wanjiru', idempotency_key='k1')
+        self.assertEqual(MenuItem.objects.get(id=rice.id).available_units, 3)
+
+
+@override_settings(TASKS_EAGER=True)
+class StockAlertTests(TestCase):
+    def setUp(self):
+        self.rice, = make_items(1, available_units=10, low_stock_threshold=3)
+
+    def order(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            return place_order(price_cart({str(self.rice.id): quantity}), 'Muthoni')
+
+    def test_low_stock_alert_with_time_to_empty(self):
+        self.order(4)
+        self.assertFalse(StockAlert.objects.exists())
+
+        self.order(4)
+        alert = StockAlert.objects.get()
+        self.assertEqual((alert.level, alert.available_units, alert.is_resolved), ('low', 2, False))
+        # 8 units in the last hour -> 8/hour, so 2 units last ~15 minutes
+        self.assertEqual(alert.velocity, 8)
+        self.assertAlmostEqual((alert.empty_at - alert.updated_at).total_seconds(), 15 * 60, delta=1)
+
+        self.order(2)
+        alert.refresh_from_db()
+        self.assertEqual((alert.level, alert.available_units), ('out', 0))
+        self.assertIn('sold out', alert.message)
+
+    def test_repeats_are_rate_limited(self):
+        self.order(8)
+        with self.assertNumQueries(2):
+            # Still low and refreshed recently: only the item and alert are read
+            check_stock([self.rice.id], decreased=True)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cancel_order(Order.objects.get())
+        self.assertTrue(StockAlert.objects.get().is_resolved)
+
+        # Dipping again straight away reopens the same alert
+        self.order(8)
+        self.assertEqual(StockAlert.objects.filter(is_resolved=False).count(), 1)
+        self.assertEqual(StockAlert.objects.count(), 1)
+
+    def test_healthy_sale_costs_one_query(self):
+        with self.assertNumQueries(1):
+            check_stock([self.rice.id], decreased=True)
+
+    def test_bulk_restock_resolves(self):
+        self.order(8)
+        self.client.force_login(User.objects.create_superuser('manager'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('menu_stock_api'), [{'id': self.rice.id, 'available_units': 30}],
+                             content_type='application/json')
+        self.assertTrue(StockAlert.objects.get().is_resolved)
+
+
+@override_settings(TASKS_EAGER=True)
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.rice, self.juice = make_items(2)
+
+    def order(self, cart):
+        with self.captureOnCommitCallbacks(execute=True):
+            return place_order(price_cart(cart), 'Chebet')
+
+    def rollups(self):
+        return (sorted(SalesRollup.objects.values_list('item_name', 'orders', 'units', 'revenue')),
+                list(HourlySales.objects.values_list('orders', 'units', 'revenue')))
+
+    def test_incremental_matches_rebuild(self):
+        rice, juice = str(self.rice.id), str(self.juice.id)
+        self.order({rice: 2, juice: 1})
+        self.order({rice: 1})
+        failed = self.order({juice: 4})
+        with self.captureOnCommitCallbacks(execute=True):
+            record_checkout(failed.id, {'ResponseCode': '1'})
+
+        self.assertEqual(self.rollups(), ([
+            (self.rice.name, 2, 3, self.rice.price * 3),
+            (self.juice.name, 1, 1, self.juice.price),
+        ], [
+            (2, 4, self.rice.price * 3 + self.juice.price),
+        ]))
+        incremental = self.rollups()
+        self.assertEqual(rebuild(), 2)
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_each_order_counted_once(self):
+        order = self.order({str(self.rice.id): 2})
+        # A retried or duplicated task changes nothing
+        record_sale(order.id)
+        self.assertEqual(SalesRollup.objects.get().units, 2)
+
+        remove_sales([order.id])
+        remove_sales([order.id])
+        self.assertEqual(SalesRollup.objects.get().units, 0)
+        record_sale(order.id)
+        self.assertEqual(SalesRollup.objects.get().units, 2)
+
+    def test_report_reads_only_rollups(self):
+        self.order({str(self.rice.id): 3})
+        self.client.force_login(User.objects.create_user('manager', is_staff=True))
+
+        with self.assertNumQueries(5):
+            # Session, user, then days, items and hours
+            response = self.client.get(reverse('sales_report'))
+        self.assertContains(response, self.rice.name)
+        self.assertEqual(response.context['report']['totals']['units'], 3)
+
+        response = self.client.get(reverse('sales_report_csv'))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'date,item,orders,units,revenue')
+        self.assertTrue(lines[1].endswith(f',{self.rice.name},1,3,{self.rice.price * 3}'))
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create_user('student'))
+        self.assertRedirects(self.client.get(reverse('sales_report')), reverse('menu'))
+        self.assertEqual(self.client.get(reverse('sales_report_csv')).status_code, 403)
+
+
+@override_settings(TASKS_EAGER=False)
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        self.rice, = make_items(1, available_units=10, low_stock_threshold=3)
+        # The stock check queued by creating the item
+        Task.objects.all().delete()
+
+    def run_due(self, worker='worker-1'):
+        return [tasks.run(task_row) for task_row in tasks.claim(10, worker)]
+
+    def test_side_effects_wait_for_a_worker(self):
+        place_order(price_cart({str(self.rice.id): 8}), 'Wanjiru')
+        self.assertFalse(SalesRollup.objects.exists())
+        self.assertFalse(StockAlert.objects.exists())
+        self.assertEqual(set(Task.objects.values_list('name', flat=True)),
+                         {'menu.analytics.record_sale', 'menu.stock_monitor.check_stock'})
+
+        self.assertEqual(self.run_due(), ['done', 'done'])
+        self.assertEqual(SalesRollup.objects.get().units, 8)
+        self.assertEqual(StockAlert.objects.get().available_units, 2)
+        self.assertEqual(self.run_due(), [])
+
+    @mock.patch('menu.mpesa.initiate_mpesa_payment', side_effect=MpesaError('refused'))
+    def test_kitchen_hears_of_a_failed_push_eager_or_not(self, initiate):
+        # The worker and the web process only share the database; so does the feed
+        def events(order):
+            return list(OrderEvent.objects.filter(data__id=order.id, event='order.updated')
+                        .values_list('data', flat=True))
+        failed = {'payment_status': Order.PAYMENT_FAILED, 'status': Order.STATUS_CANCELLED}
+        snapshot = price_cart({str(self.rice.id): 1})
+
+        order = place_order(snapshot, 'Wanjiru', phone='254700000000', pay=True)
+        self.assertEqual(events(order), [])
+        with self.assertLogs('menu.mpesa', 'ERROR'):
+            self.run_due()
+        self.assertEqual(events(order), [{'id': order.id, **failed}])
+
+        with override_settings(TASKS_EAGER=True), self.assertLogs('menu.mpesa', 'ERROR'), \
+                self.captureOnCommitCallbacks(execute=True):
+            order = place_order(snapshot, 'Wanjiru', phone='254700000000', pay=True)
+        self.assertEqual(events(order), [{'id': order.id, **failed}])
+        self.assertFalse(Task.objects.filter(name='menu.mpesa.request_payment', args__0=order.id).exists())
+
+    def test_rolled_back_order_leaves_no_tasks(self):
+        with self.assertRaises(OutOfStock):
+            place_order(price_cart({str(self.rice.id): 11}), 'Wanjiru')
+        self.assertFalse(Task.objects.exists())
+
+    def test_order_and_tasks_commit_together(self):
+        set_cart(self.client, {str(self.rice.id): 2})
+        with self.captureOnCommitCallbacks():
+            self.client.post(reverse('confirm_order'), {'name': 'Wanjiru', 'phone': '254700000000'})
+        # Written with the order, not by anything that runs after it commits
+        self.assertEqual(set(Task.objects.filter(args__0=Order.objects.get().id)
+                             .values_list('name', flat=True)),
+                         {'menu.mpesa.request_payment', 'menu.analytics.record_sale'})
+        self.assertTrue(Task.objects.filter(name='menu.stock_monitor.check_stock').exists())
+
+        # And when queueing fails, there is no order either
+        Order.objects.all().delete()
+        Task.objects.all().delete()
+        with mock.patch.object(check_stock, 'delay', side_effect=OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                place_order(price_cart({str(self.rice.id): 2}), 'Wanjiru', phone='254700000000', pay=True)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Task.objects.exists())
+
+    @mock.patch('menu.mpesa.initiate_mpesa_payment', side_effect=MpesaUnavailable('no answer'))
+    def test_unsent_payment_is_retried_then_failed(self, push):
+        order = place_order(price_cart({str(self.rice.id): 4}), 'Wanjiru')
+        Task.objects.all().delete()
+        request_payment.delay(order.id, '254700000000', 42)
+
+        self.assertEqual(self.run_due(), ['queued'])
+        task_row = Task.objects.get(name='menu.mpesa.request_payment')
+        self.assertEqual(task_row.attempts, 1)
+        self.assertIn('no answer', task_row.last_error)
+        delay = (task_row.run_at - timezone.now()).total_seconds()
+        self.assertTrue(3.5 < delay < 6.5, delay)
+        # Not due yet
+        self.assertEqual(tasks.claim(10, 'worker-1'), [])
+
+        Task.objects.update(run_at=timezone.now())
+        self.assertEqual(self.run_due(), ['queued'])
+        Task.objects.update(run_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.run_due(), ['dead'])
+
+        self.assertEqual(push.call_count, 3)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_FAILED)
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 10)
+
+        # Dead tasks stay until retried from the admin
+        self.assertEqual(tasks.prune(timezone.now() + datetime.timedelta(days=1)), 0)
+        self.assertEqual(tasks.requeue(Task.objects.all()), 1)
+        self.assertEqual(Task.objects.get(name='menu.mpesa.request_payment').status, Task.STATUS_QUEUED)
+
+    @override_settings(TASKS_EAGER=True)
+    @mock.patch('menu.mpesa.initiate_mpesa_payment', side_effect=MpesaUnavailable('no answer'))
+    def test_eager_failure_is_queued_for_retry(self, push):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = place_order(price_cart({str(self.rice.id): 4}), 'Wanjiru')
+            request_payment.delay(order.id, '254700000000', 42)
+
+        self.assertEqual(push.call_count, 1)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PENDING)
+        task_row = Task.objects.get(name='menu.mpesa.request_payment')
+        self.assertEqual((task_row.status, task_row.attempts, task_row.max_attempts),
+                         (Task.STATUS_QUEUED, 1, 3))
+
+    def test_expired_lock_is_taken_over(self):
+        Task.objects.create(name='menu.stock_monitor.check_stock', args=[[self.rice.id]], max_attempts=3)
+        stalled, = tasks.claim(10, 'worker-1')
+        self.assertEqual(tasks.claim(10, 'worker-2'), [])
+
+        Task.objects.update(locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        taken, = tasks.claim(10, 'worker-2')
+        self.assertEqual((taken.worker, taken.attempts), ('worker-2', 2))
+
+        # The first worker finishing late doesn't overwrite the new claim
+        tasks.run(stalled)
+        self.assertEqual(Task.objects.get().status, Task.STATUS_RUNNING)
+        self.assertEqual(tasks.run(taken), Task.STATUS_DONE)
+        self.assertEqual(Task.objects.get().status, Task.STATUS_DONE)
+
+    def test_unknown_task_is_dead(self):
+        Task.objects.create(name='menu.nowhere.missing')
+        self.assertEqual(self.run_due(), ['dead'])
+        self.assertIn('No task called', Task.objects.get().last_error)
+
+    def test_metrics(self):
+        now = timezone.now()
+        Task.objects.create(name='menu.analytics.record_sale', args=[1],
+                            run_at=now - datetime.timedelta(seconds=30))
+        Task.objects.create(name='menu.analytics.record_sale', args=[2], status=Task.STATUS_DONE,
+                            run_at=now - datetime.timedelta(seconds=10),
+                            started_at=now - datetime.timedelta(seconds=8),
+                            finished_at=now - datetime.timedelta(seconds=7))
+
+        text = tasks.render_metrics(now)
+        self.assertIn('portal_task_queue_depth{task="menu.analytics.record_sale",status="queued"} 1\n', text)
+        self.assertIn('portal_task_oldest_seconds{task="menu.analytics.record_sale"} 30.0\n', text)
+        self.assertIn('portal_task_wait_seconds{task="menu.analytics.record_sale"} 2.0\n', text)
+        self.assertIn('portal_task_run_seconds{task="menu.analytics.record_sale"} 1.0\n', text)
+
+
+@override_settings(TASKS_EAGER=False)
+class TaskWorkerTests(TransactionTestCase):
+    def test_burst_runs_everything_due(self):
+        rice, = make_items(1, available_units=10)
+        place_order(price_cart({str(rice.id): 2}), 'Wanjiru')
+        place_order(price_cart({str(rice.id): 3}), 'Kamau')
+
+        out = io.StringIO()
+        # One thread: the in-memory test database fails on lock contention
+        # instead of waiting for it
+        call_command('run_tasks', '--burst', '--threads', '1', stdout=out)
+        # A stock check for the new item, then a rollup and a stock check per order
+        self.assertIn('done=5', out.getvalue())
+        self.assertEqual(SalesRollup.objects.get().units, 5)
+        self.assertFalse(Task.objects.exclude(status=Task.STATUS_DONE).exists())
+
+
+class OrderArchiveTests(TestCase):
+    # Set ORDER_ARCHIVE_TEST_ORDERS=1000000 for the full-size run
+    ORDERS = int(os.environ.get('ORDER_ARCHIVE_TEST_ORDERS', 5000))
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.enterContext(override_settings(ORDER_ARCHIVE_DIR=tmpdir.name))
+        self.root = tmpdir.name
+        now = timezone.now()
+        self.first_id, self.last_id = make_orders(
+            self.ORDERS, now - datetime.timedelta(days=120), now - datetime.timedelta(days=1))
+        self.cutoff = now - datetime.timedelta(days=30)
+
+    def test_moves_old_orders_into_monthly_files(self):
+        old = Order.objects.filter(created_at__lt=self.cutoff).count()
+        months = set(Order.objects.filter(created_at__lt=self.cutoff).dates('created_at', 'month'))
+        report = archive_orders(self.cutoff, chunk_size=500, batch_size=1000)
+        self.assertEqual((report.orders, report.deleted), (old, old))
+
+        self.assertEqual(Order.objects.count(), self.ORDERS - old)
+        self.assertFalse(Order.objects.filter(created_at__lt=self.cutoff).exists())
+        self.assertEqual(OrderItem.objects.count(), (self.ORDERS - old) * 2)
+        archives = list(OrderArchive.objects.order_by('month'))
+        self.assertEqual({archive.month for archive in archives}, months)
+        self.assertEqual(sum(archive.orders for archive in archives), old)
+        lines = 0
+        for archive in archives:
+            with gzip.open(os.path.join(self.root, archive.path)) as f:
+                lines += sum(1 for _ in f)
+        self.assertEqual(lines, old)
+
+        # Running again finds nothing new to archive
+        self.assertEqual(archive_orders(self.cutoff).files, [])
+        self.assertEqual(OrderArchive.objects.count(), len(archives))
+
+    def test_unfinished_orders_stay(self):
+        rice, = make_items(1, available_units=5)
+        pending = place_order(price_cart({str(rice.id): 2}), 'Achieng')
+        paid = place_order(price_cart({str(rice.id): 1}), 'Achieng')
+        Order.objects.filter(id=paid.id).update(status=Order.STATUS_PAID,
+                                                payment_status=Order.PAYMENT_PAID)
+        Order.objects.filter(id__in=[pending.id, paid.id]).update(
+            created_at=self.cutoff - datetime.timedelta(days=1))
+
+        report = archive_orders(self.cutoff)
+        self.assertEqual(set(Order.objects.filter(created_at__lt=self.cutoff).values_list('id', flat=True)),
+                         {pending.id, paid.id})
+        self.assertEqual(OrderItem.objects.filter(order__in=[pending.id, paid.id]).count(), 2)
+        self.assertEqual(report.deleted, report.orders)
+        self.assertIsNone(find_archived_order(pending.id))
+
+    def test_order_finished_during_the_run_is_kept(self):
+        # Among the oldest orders, so below the last id written
+        late = Order.objects.get(id=self.first_id)
+        Order.objects.filter(id=late.id).update(status=Order.STATUS_READY)
+        register = _PartitionWriter.register
+
+        def collect_then_register(writer):
+            # Collected after the files were written, before the deletes
+            Order.objects.filter(id=late.id).update(status=Order.STATUS_COLLECTED)
+            register(writer)
+
+        with mock.patch.object(_PartitionWriter, 'register', collect_then_register):
+            report = archive_orders(self.cutoff, batch_size=1000)
+        self.assertEqual(report.deleted, report.orders)
+        self.assertTrue(Order.objects.filter(id=late.id).exists())
+        self.assertIsNone(find_archived_order(late.id))
+
+        # The next run archives it
+        archive_orders(self.cutoff)
+        self.assertFalse(Order.objects.filter(id=late.id).exists())
+        self.assertEqual(find_archived_order(late.id).id, late.id)
+
+    def test_staff_can_look_up_archived_orders(self):
+        call_command('archive_orders', older_than_days=30, stdout=io.StringIO())
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        order_id = (self.first_id + self.last_id) // 4
+
+        with self.assertNumQueries(4):
+            # Session, user, the orders table, then the archive block
+            response = self.client.get(reverse('order_detail', args=[order_id]))
+        self.assertTrue(response.context['archived'])
+        self.assertEqual(response.context['order'].id, order_id)
+        self.assertEqual(response.context['order'].total_amount(), Decimal('200.00'))
+        self.assertNotContains(response, reverse('delete_order', args=[order_id]))
+
+        self.assertRedirects(self.client.get(reverse('order_list'), {'order': order_id}),
+                             reverse('order_detail', args=[order_id]))
+        missing = self.last_id + 1
+        self.assertEqual(self.client.get(reverse('order_detail', args=[missing])).status_code, 404)
+
+
+class StockStressTests(TransactionTestCase):
+    orders = 300
+    workers = 16
+    stock = 200
+
+    def test_concurrent_orders_never_oversell(self):
+        item, = make_items(1, available_units=self.stock)
+        snapshot = price_cart({str(item.id): 1})
+
+        def buy(_):
+            try:
+                while True:
+                    try:
+                        place_order(snapshot, 'Stress')
+                        return True
+                    except OutOfStock:
+                        return False
+                    except OperationalError:
+                        # SQLite reports lock contention instead of waiting.
+                        continue
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(buy, range(self.orders)))
+
+        item.refresh_from_db()
+        self.assertEqual(results.count(True), self.stock)
+        self.assertEqual(item.available_units, 0)
+        self.assertEqual(OrderItem.objects.filter(menu_item=item).count(), self.stock)
+
+
+class MenuVersionStressTests(TransactionTestCase):
+    def test_concurrent_bumps_never_share_a_version(self):
+        start = get_version()
+
+        def bump(_):
+            try:
+                while True:
+                    try:
+                        return bump_version()
+                    except OperationalError:
+                        continue
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            versions = list(pool.map(bump, range(100)))
+        self.assertEqual(sorted(versions), list(range(start + 1, start + 101)))
+        self.assertEqual(get_version(), start + 100)
+
+
+class MpesaClientTests(TestCase):
+    def setUp(self):
+        self.server = FakeMpesaServer().start()
+        self.addCleanup(self.server.stop)
+
+    def make_client(self, **kwargs):
+        kwargs.setdefault('timeout', 5)
+        return MpesaClient(self.server.url, 'key', 'secret', '174379', 'passkey',
+                           'http://localhost/callback', **kwargs)
+
+    def test_token_is_reused(self):
+        client = self.make_client()
+        for _ in range(3):
+            self.assertEqual(client.stk_push('254700000000', 10)['ResponseCode'], '0')
+        self.assertEqual(self.server.token_requests, 1)
+        self.assertEqual(len(self.server.stk_requests), 3)
+
+    def test_expired_token_is_refreshed(self):
+        self.server.expires_in = 0
+        client = self.make_client()
+        client.stk_push('254700000000', 10)
+        client.stk_push('254700000000', 10)
+        self.assertEqual(self.server.token_requests, 2)
+
+    def test_revoked_token_is_retried_once(self):
+        client = self.make_client()
+        client.stk_push('254700000000', 10)
+        self.server.tokens.clear()
+        self.assertEqual(client.stk_push('254700000000', 10)['ResponseCode'], '0')
+        self.assertEqual(self.server.token_requests, 2)
+
+    def test_timeout_raises(self):
+        self.server.latency = 0.5
+        with self.assertRaises(MpesaError):
+            self.make_client(timeout=0.05).get_token()
+
+    def test_confirm_order_pushes_after_commit(self):
+        rice, = make_items(1, available_units=5)
+        set_cart(self.client, {str(rice.id): 2})
+
+        with override_settings(MPESA_BASE_URL=self.server.url, TASKS_EAGER=True):
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(
+                    reverse('confirm_order'), {'name': 'Akinyi', 'phone': '254700000000'})
+            # The response goes out before M-Pesa is contacted.
+            self.assertRedirects(response, reverse('menu'), fetch_redirect_response=False)
+            self.assertEqual(self.server.stk_requests, [])
+            for callback in callbacks:
+                callback()
+
+        self.assertEqual(len(self.server.stk_requests), 1)
+        self.assertEqual(self.server.stk_requests[0]['Amount'], int(rice.price * 2))
+        order = Order.objects.get()
+        self.assertTrue(order.checkout_request_id.startswith('ws_CO_fake_'))
+        self.assertEqual(order.payment_status, Order.PAYMENT_PENDING)
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='QAB1CD2EF3', amount=100.0):
+    callback = {
+        'MerchantRequestID': 'merchant-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20250418103100},
+            {'Name': 'PhoneNumber', 'Value': 254700000000},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+@override_settings(MPESA_CALLBACK_TOKEN='callback-secret', MPESA_CALLBACK_IPS=[])
+class PaymentReconciliationTests(TestCase):
+    def make_order(self, checkout_request_id, units=2):
+        item = MenuItem.objects.create(name='Rice & beans', price=Decimal('50.00'),
+                                       available_units=10, category='food')
+        order = place_order(price_cart({str(item.id): units}), 'Mutua')
+        Order.objects.filter(id=order.id).update(checkout_request_id=checkout_request_id)
+        return order, item
+
+    def post_callback(self, payload, token='callback-secret', **extra):
+        return self.client.post(f"{reverse('mpesa_callback')}?token={token}", json.dumps(payload),
+                                content_type='application/json', **extra)
+
+    def test_callback_marks_order_paid_once(self):
+        order, _ = self.make_order('ws_CO_1')
+
+        for _ in range(2):
+            response = self.post_callback(stk_callback('ws_CO_1'))
+            self.assertEqual(response.json()['ResultCode'], 0)
+
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PAID)
+        self.assertEqual(order.status, Order.STATUS_PAID)
+        self.assertEqual(order.mpesa_receipt, 'QAB1CD2EF3')
+        self.assertIsNotNone(order.paid_at)
+
+        # A late failure for the same request must not undo the payment.
+        self.post_callback(stk_callback('ws_CO_1', result_code=1032))
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PAID)
+
+    def test_cancelled_payment_releases_stock_once(self):
+        order, item = self.make_order('ws_CO_2', units=4)
+
+        self.post_callback(stk_callback('ws_CO_2', result_code=1032))
+        self.post_callback(stk_callback('ws_CO_2', result_code=1032))
+
+        order.refresh_from_db()
+        item.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_FAILED)
+        self.assertEqual(order.status, Order.STATUS_CANCELLED)
+        self.assertEqual(item.available_units, 10)
+
+    def test_wrong_amount_is_held_not_paid(self):
+        order, _ = self.make_order('ws_CO_3')
+        self.post_callback(stk_callback('ws_CO_3', amount=1.0))
+
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PENDING)
+        held = HeldPayment.objects.get()
+        self.assertEqual((held.reason, held.order_id, held.amount),
+                         (HeldPayment.REASON_AMOUNT, order.id, Decimal('1.00')))
+
+    def test_callback_before_checkout_is_recorded(self):
+        order, _ = self.make_order(None)
+        # Safaricom can call back before record_checkout has stored the id
+        for _ in range(2):
+            self.assertEqual(self.post_callback(stk_callback('ws_CO_early')).json()['ResultCode'], 0)
+        self.assertEqual(HeldPayment.objects.get().reason, HeldPayment.REASON_UNMATCHED)
+
+        record_checkout(order.id, {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_early'})
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PAID)
+        self.assertFalse(HeldPayment.objects.exists())
+
+    def test_invalid_callback(self):
+        self.assertEqual(self.post_callback({'Body': {}}).status_code, 400)
+
+    def test_callback_needs_our_token_and_address(self):
+        order, _ = self.make_order('ws_CO_4')
+        self.assertEqual(self.post_callback(stk_callback('ws_CO_4'), token='guess').status_code, 403)
+        with override_settings(MPESA_CALLBACK_TOKEN=''):
+            self.assertEqual(self.post_callback(stk_callback('ws_CO_4'), token='').status_code, 403)
+        with override_settings(MPESA_CALLBACK_IPS=['196.201.214.200']):
+            self.assertEqual(self.post_callback(stk_callback('ws_CO_4')).status_code, 403)
+            response = self.post_callback(stk_callback('ws_CO_4'), REMOTE_ADDR='196.201.214.200')
+            self.assertEqual(response.status_code, 200)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PAID)
+
+        self.assertEqual(callback_url(), 'https://yourdomain.com/api/payment-callback/?token=callback-secret')
+
+    def test_payment_without_amount_is_not_accepted(self):
+        order, _ = self.make_order('ws_CO_5')
+        payload = stk_callback('ws_CO_5')
+        payload['Body']['stkCallback']['CallbackMetadata']['Item'].pop(0)
+        self.assertEqual(self.post_callback(payload).status_code, 400)
+
+        # Nor from a statement without the column
+        report = apply_payment_results([PaymentResult.from_row({'CheckoutRequestID': 'ws_CO_5', 'ResultCode': 0})])
+        self.assertEqual(report.mismatched, ['ws_CO_5'])
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, Order.PAYMENT_PENDING)
+
+    def test_bulk_reconcile_in_constant_queries(self):
+        item, = make_items(1, available_units=1000)
+        snapshot = price_cart({str(item.id): 1})
+        orders = [place_order(snapshot, f'Student {i}') for i in range(300)]
+        for i, order in enumerate(orders):
+            order.checkout_request_id = f'ws_CO_bulk_{i}'
+        Order.objects.bulk_update(orders, ['checkout_request_id'])
+
+        results = [PaymentResult.from_callback(stk_callback(f'ws_CO_bulk_{i}', receipt=f'R{i}',
+                                                            amount=int(item.price)))
+                   for i in range(200)]
+        results += [PaymentResult.from_callback(stk_callback(f'ws_CO_bulk_{i}', result_code=1))
+                    for i in range(200, 300)]
+        results += [PaymentResult.from_callback(stk_callback('ws_CO_unknown'))]
+
+        with CaptureQueriesContext(connection) as ctx:
+            report = apply_payment_results(results)
+        # Independent of the number of orders: a handful per batch (the
+        # feed's event rows included) plus the sales rollup buckets of the
+        # failed orders.
+        self.assertLess(len(ctx.captured_queries), 18)
+
+        self.assertEqual((report.paid, report.failed, report.unmatched), (200, 100, ['ws_CO_unknown']))
+        self.assertEqual(Order.objects.filter(payment_status=Order.PAYMENT_PAID).count(), 200)
+        item.refresh_from_db()
+        self.assertEqual(item.available_units, 1000 - 200)
+
+        report = apply_payment_results(results)
+        self.assertEqual((report.paid, report.failed, report.duplicates), (0, 0, 300))
+
+    def test_reconcile_command_reads_statement_csv(self):
+        order, _ = self.make_order('ws_CO_csv')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('CheckoutRequestID,ResultCode,MpesaReceiptNumber,Amount\n')
+            f.write('ws_CO_csv,0,QXY123,100.00\n')
+        self.addCleanup(os.remove, f.name)
+
+        out = io.StringIO()
+        call_command('reconcile_payments', f.name, stdout=out)
+
+        self.assertIn('paid=1', out.getvalue())
+        order.refresh_from_db()
+        self.assertEqual(order.mpesa_receipt, 'QXY123')
+
+
+class MenuCacheTests(TestCase):
+    def setUp(self):
+        self.rice, self.juice = make_items(2)
+        MenuItem.objects.filter(id=self.juice.id).update(category='beverage')
+
+    def test_warm_menu_queries(self):
+        # Only the menu version, the stock overlay and the pickup slot
+        # counters are read.
+        self.client.get(reverse('menu'))
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('menu'))
+        self.assertContains(response, self.rice.name)
+        self.assertContains(response, self.juice.name)
+
+    def test_saves_invalidate(self):
+        self.client.get(reverse('menu'))
+        version = get_version()
+
+        self.rice.name = 'Pilau'
+        self.rice.save()
+        Announcement.objects.create(
+            title='Closed on Friday', message='Staff meeting',
+            created_by=User.objects.create_user('cook'))
+
+        self.assertGreater(get_version(), version)
+        response = self.client.get(reverse('menu'))
+        self.assertContains(response, 'Pilau')
+        self.assertContains(response, 'Closed on Friday')
+
+    def test_rolled_back_save_keeps_the_version(self):
+        version = get_version()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.rice.save()
+            raise RuntimeError
+        self.assertEqual(get_version(), version)
+        self.assertEqual(bump_version(), version + 1)
+
+    def test_stock_overlay_without_rerender(self):
+        self.client.get(reverse('menu'))
+        version = get_version()
+
+        place_order(price_cart({str(self.rice.id): 50}), 'Kamau')
+        response = self.client.get(reverse('menu'))
+        self.assertNotContains(response, f'data-id="{self.rice.id}"')
+        self.assertContains(response, f'data-id="{self.juice.id}"')
+
+        cancel_order(Order.objects.get())
+        response = self.client.get(reverse('menu'))
+        self.assertContains(response, f'data-id="{self.rice.id}"')
+        self.assertEqual(get_version(), version)
+
+
+class MenuSearchTests(TestCase):
+    def setUp(self):
+        self.chapati = MenuItem.objects.create(
+            name='Chapati Beans', price=Decimal('60'), category='food', available_units=10,
+            station='Grill', tags='Vegetarian, vegan')
+        self.chicken = MenuItem.objects.create(
+            name='Chicken Pilau', price=Decimal('150'), category='food', available_units=10,
+            station='Grill', tags='spicy', description='Served with kachumbari')
+        self.juice = MenuItem.objects.create(
+            name='Mango Juice', price=Decimal('50'), category='beverage', available_units=10,
+            station='Juice bar', tags='vegan')
+        search_index.rebuild()
+
+    def names(self, query, **kwargs):
+        return [document['name'] for document in search_index.search(query, **kwargs)['results']]
+
+    def test_prefix_and_typos(self):
+        self.assertEqual(self.names('chap'), ['Chapati Beans'])
+        self.assertEqual(self.names('chikcen'), ['Chicken Pilau'])
+        self.assertEqual(self.names('chiken pil'), ['Chicken Pilau'])
+        self.assertEqual(self.names('chi'), ['Chicken Pilau'])
+        self.assertEqual(self.names('kachumbari'), ['Chicken Pilau'])
+        # A word in the name outranks the same word in tags
+        self.assertEqual(self.names('vegan'), ['Chapati Beans', 'Mango Juice'])
+        self.assertEqual(self.names('mango vegan'), ['Mango Juice'])
+        self.assertEqual(self.names('mango spicy'), [])
+
+    def test_facets_and_filters(self):
+        result = search_index.search('', tags=['vegan'])
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['facets']['category'], {'food': 1, 'beverage': 1})
+        self.assertEqual(result['facets']['station'], {'Grill': 1, 'Juice bar': 1})
+        self.assertEqual(result['facets']['tags'], {'vegan': 2, 'vegetarian': 1})
+        self.assertEqual(self.names('', station='grill', category='food'),
+                         ['Chapati Beans', 'Chicken Pilau'])
+
+    def test_saves_and_deletes_update_the_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.juice.name = 'Passion Juice'
+            self.juice.save()
+        version = search_index.version
+        self.assertEqual(self.names('passion'), ['Passion Juice'])
+        self.assertEqual(self.names('mango'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chapati.delete()
+        self.assertEqual(self.names('chapati'), [])
+        self.assertNotIn('chapati', search_index.words)
+        # Applied in place, without a rebuild
+        self.assertEqual(search_index.version, version + 1)
+
+    def test_missed_changes_rebuild(self):
+        # Saves that never commit, or bulk updates, leave the index behind
+        MenuItem.objects.filter(id=self.juice.id).update(name='Lemonade')
+        self.juice.save(update_fields=['category'])
+        self.assertNotEqual(search_index.version, get_version())
+        response = self.client.get(reverse('menu_search'), {'q': 'lemon'})
+        self.assertEqual([item['id'] for item in response.json()['results']], [self.juice.id])
+
+    def test_endpoint_skips_sold_out_items(self):
+        MenuItem.objects.filter(id=self.chicken.id).update(available_units=0)
+        response = self.client.get(reverse('menu_search'), {'q': 'grill'})
+        data = response.json()
+        self.assertEqual(data['ids'], [self.chapati.id])
+        self.assertEqual(data['results'][0]['price'], '60.00')
+        self.assertEqual(data['facets']['tags'], {'vegetarian': 1, 'vegan': 1})
+
+    def test_admin_search_uses_index(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:menu_menuitem_changelist'), {'q': 'pilua'})
+        self.assertContains(response, 'Chicken Pilau')
+        self.assertNotContains(response, 'Chapati Beans')
+
+
+@override_settings(MENU_SYNC_OVERLAP=0)
+class MenuSyncTests(TestCase):
+    def setUp(self):
+        self.rice, self.juice, self.tea = make_items(3, available_units=5)
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        self.notice = Announcement.objects.create(title='Closed Friday', message='...', created_by=self.staff)
+
+    def sync(self, **params):
+        response = self.client.get(reverse('menu_sync'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_only_changes_since_the_page_are_sent(self):
+        watermark = self.client.get(reverse('menu')).context['menu_sync']['watermark']
+        self.assertEqual(self.sync(since=watermark)['items'], [])
+
+        self.rice.price = Decimal('99.00')
+        self.rice.save()
+        MenuItem.objects.filter(id=self.tea.id).update(available_units=0)
+        news = Announcement.objects.create(title='New stew', message='Try it', created_by=self.staff)
+        self.client.get(reverse('menu'))
+        with self.assertNumQueries(4):
+            data = self.sync(since=watermark)
+
+        self.assertEqual([item['id'] for item in data['items']], [self.rice.id])
+        self.assertEqual(data['items'][0]['price'], '99.00')
+        self.assertIn('Ksh 99.00', data['items'][0]['html'])
+        self.assertEqual(data['in_stock'], [self.rice.id, self.juice.id])
+        self.assertEqual([a['id'] for a in data['announcements']], [news.id])
+        self.assertIn('New stew', data['announcements'][0]['html'])
+        self.assertEqual(data['announcement_ids'], [news.id, self.notice.id])
+
+        # Nothing new since the last answer, but rows can be asked for by id
+        data = self.sync(since=data['watermark'], items=f'{self.juice.id},x', announcements=self.notice.id)
+        self.assertEqual([item['id'] for item in data['items']], [self.juice.id])
+        self.assertEqual([a['id'] for a in data['announcements']], [self.notice.id])
+
+    def test_without_a_watermark_everything_is_sent(self):
+        data = self.sync()
+        self.assertEqual([item['id'] for item in data['items']], [self.rice.id, self.juice.id, self.tea.id])
+        self.assertEqual(len(data['announcements']), 1)
+        self.assertEqual(self.client.get(reverse('menu_sync'), {'since': 'yesterday'}).status_code, 400)
+
+    def test_service_worker(self):
+        response = self.client.get('/sw.js')
+        self.assertEqual(response['Content-Type'], 'text/javascript')
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertContains(response, static('js/main.js'))
+        self.assertContains(response, "const MENU_URL = '/';")
+        self.assertContains(self.client.get(reverse('menu')), reverse('service_worker'))
+
+
+class OrderListTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        item, = make_items(1, available_units=1000)
+        self.snapshot = price_cart({str(item.id): 2})
+
+    def make_orders(self, count):
+        return [place_order(self.snapshot, f'Student {i}') for i in range(count)]
+
+    def test_totals_computed_in_database(self):
+        order, = self.make_orders(1)
+        annotated = Order.objects.with_totals().get(id=order.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(annotated.total_amount(), self.snapshot.total)
+        self.assertEqual(order.total_amount(), self.snapshot.total)
+
+    def test_pages_cover_every_order_once(self):
+        orders = self.make_orders(120)
+        seen = []
+        url = reverse('order_list')
+        while url:
+            response = self.client.get(url)
+            page = response.context['orders']
+            seen.extend(order.id for order in page)
+            url = f"{reverse('order_list')}?cursor={page.next_cursor}" if page.has_next else None
+        self.assertEqual(seen, sorted((order.id for order in orders), reverse=True))
+
+    def test_query_count_independent_of_page_and_size(self):
+        self.make_orders(5)
+        self.client.get(reverse('order_list'))
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('order_list'))
+
+        self.make_orders(150)
+        first = self.client.get(reverse('order_list')).context['orders']
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(reverse('order_list'), {'cursor': first.next_cursor})
+        self.assertEqual(len(small.captured_queries), len(deep.captured_queries))
+
+    def test_bad_cursor_starts_from_newest(self):
+        self.make_orders(3)
+        response = self.client.get(reverse('order_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(len(response.context['orders']), 3)
+
+    def test_admin_changelist_uses_annotated_totals(self):
+        self.make_orders(3)
+        self.client.force_login(User.objects.create_superuser('admin'))
+        response = self.client.get(reverse('admin:menu_order_changelist'))
+        self.assertEqual(response.status_code, 200)
+        for order in response.context['cl'].result_list:
+            self.assertEqual(order.items_total, self.snapshot.total)
+
+
+class OrderStatusTests(TestCase):
+    def setUp(self):
+        item, = make_items(1, available_units=1000)
+        self.snapshot = price_cart({str(item.id): 1})
+        self.client.force_login(User.objects.create_user('cook', is_staff=True))
+
+    def make_orders(self, count, status=Order.STATUS_PAID):
+        orders = [place_order(self.snapshot, f'Student {i}') for i in range(count)]
+        Order.objects.filter(id__in=[order.id for order in orders]).update(status=status)
+        return [order.id for order in orders]
+
+    def test_transitions_follow_the_workflow(self):
+        paid = self.make_orders(2)
+        pending = self.make_orders(1, status=Order.STATUS_PENDING_PAYMENT)
+
+        OrderEvent.objects.all().delete()
+        self.assertEqual(advance_orders(paid + pending, Order.STATUS_PREPARING), paid)
+        self.assertEqual([(event.event, event.data) for event in OrderEvent.objects.order_by('id')], [
+            ('order.updated', {'id': order_id, 'status': 'preparing'}) for order_id in paid])
+
+        # Can't skip ahead, or go back
+        self.assertEqual(advance_orders(paid, Order.STATUS_COLLECTED), [])
+        self.assertEqual(advance_orders(paid, Order.STATUS_PAID), [])
+        self.assertEqual(advance_orders(paid, Order.STATUS_READY), paid)
+        order = Order.objects.get(id=paid[0])
+        self.assertEqual(order.status, Order.STATUS_READY)
+        self.assertIsNotNone(order.preparing_at)
+        self.assertLessEqual(order.preparing_at, order.ready_at)
+        self.assertIsNone(order.collected_at)
+
+    def test_queue_reads_only_active_orders(self):
+        self.make_orders(3)
+        self.make_orders(2, status=Order.STATUS_READY)
+        self.client.get(reverse('kitchen_queue'))
+        with CaptureQueriesContext(connection) as small:
+            response = self.client.get(reverse('kitchen_queue'))
+        self.assertEqual([len(column['orders']) for column in response.context['columns']], [3, 0, 2])
+
+        self.make_orders(200, status=Order.STATUS_COLLECTED)
+        self.make_orders(20, status=Order.STATUS_CANCELLED)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('kitchen_queue'))
+        self.assertEqual([len(column['orders']) for column in response.context['columns']], [3, 0, 2])
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertIn('order_status_created_idx', Order.objects.active().explain())
+
+    def test_bulk_advance_from_the_queue(self):
+        paid = self.make_orders(3)
+        response = self.client.post(reverse('advance_orders'), {
+            'status': Order.STATUS_PREPARING, 'order': paid[:2] + [10 ** 6]})
+        self.assertRedirects(response, reverse('kitchen_queue'))
+        self.assertEqual(
+            list(Order.objects.filter(id__in=paid).order_by('id').values_list('status', flat=True)),
+            [Order.STATUS_PREPARING, Order.STATUS_PREPARING, Order.STATUS_PAID])
+        self.assertEqual([str(m) for m in response.wsgi_request._messages], [
+            '2 order(s) marked preparing.', '1 order(s) could not be marked preparing.'])
+
+        self.client.post(reverse('advance_orders'), {'status': 'bogus', 'order': paid})
+        self.assertEqual(Order.objects.filter(status=Order.STATUS_PAID).count(), 1)
+
+    def test_queue_is_for_kitchen_staff(self):
+        self.client.force_login(User.objects.create_user('student'))
+        self.assertRedirects(self.client.get(reverse('kitchen_queue')), reverse('menu'))
+        paid = self.make_orders(1)
+        self.client.post(reverse('advance_orders'), {'status': Order.STATUS_PREPARING, 'order': paid})
+        self.assertEqual(Order.objects.get(id=paid[0]).status, Order.STATUS_PAID)
+
+
+class OutletTests(TestCase):
+    def setUp(self):
+        self.north = Outlet.objects.create(name='North Cafeteria', slug='north')
+        self.south = Outlet.objects.create(name='South Kiosk', slug='south')
+        self.rice, self.juice = make_items(2, available_units=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            OutletStock.objects.create(outlet=self.north, menu_item=self.rice, available_units=5)
+            OutletStock.objects.create(outlet=self.south, menu_item=self.rice, available_units=2)
+
+    def units(self, outlet, item):
+        return OutletStock.objects.get(outlet=outlet, menu_item=item).available_units
+
+    def test_orders_take_stock_from_their_outlet(self):
+        # The shared counter becomes the total across outlets
+        self.rice.refresh_from_db()
+        self.assertEqual(self.rice.available_units, 7)
+
+        snapshot = price_cart({str(self.rice.id): 3, str(self.juice.id): 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            order = place_order(snapshot, 'Student', outlet=self.north)
+        self.assertEqual(order.outlet, self.north)
+        self.assertEqual((self.units(self.north, self.rice), self.units(self.south, self.rice)), (2, 2))
+        self.rice.refresh_from_db()
+        self.juice.refresh_from_db()
+        self.assertEqual((self.rice.available_units, self.juice.available_units), (4, 9))
+
+        with self.assertRaises(OutOfStock) as raised:
+            place_order(price_cart({str(self.rice.id): 3}), 'Student', outlet=self.south)
+        self.assertEqual([line.name for line in raised.exception.lines], [self.rice.name])
+        self.assertEqual(self.units(self.south, self.rice), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cancel_order(order)
+        self.assertEqual(self.units(self.north, self.rice), 5)
+        self.rice.refresh_from_db()
+        self.juice.refresh_from_db()
+        self.assertEqual((self.rice.available_units, self.juice.available_units), (7, 10))
+
+    def test_orders_without_an_outlet_go_to_the_least_busy_one(self):
+        snapshot = price_cart({str(self.rice.id): 1})
+        # Tied queues: the first outlet
+        first = place_order(snapshot, 'Student')
+        self.assertEqual(first.outlet, self.north)
+        Order.objects.filter(id=first.id).update(status=Order.STATUS_PAID)
+        self.assertEqual(place_order(snapshot, 'Student').outlet, self.south)
+        # Items stocked per outlet only go where there are enough of them
+        self.assertEqual(place_order(price_cart({str(self.rice.id): 2}), 'Student').outlet, self.north)
+        # Nor to closed outlets
+        self.north.is_active = False
+        self.north.save()
+        with self.assertRaises(OutOfStock):
+            place_order(price_cart({str(self.rice.id): 2}), 'Student')
+
+        # Items with no outlet rows can be made anywhere
+        order = place_order(price_cart({str(self.juice.id): 2}), 'Student')
+        self.assertEqual(order.outlet, self.south)
+        self.juice.refresh_from_db()
+        self.assertEqual(self.juice.available_units, 8)
+
+    def test_menu_and_cart_follow_the_chosen_outlet(self):
+        OutletStock.objects.filter(outlet=self.south).update(available_units=0)
+        self.assertContains(self.client.get(reverse('menu')), self.rice.name)
+
+        response = self.client.post(reverse('set_outlet'), {'outlet': 'south'})
+        self.assertEqual(response.cookies['outlet'].value, 'south')
+        response = self.client.get(reverse('menu'))
+        self.assertNotContains(response, self.rice.name)
+        self.assertContains(response, self.juice.name)
+
+        response = self.client.post(reverse('add_to_cart'), json.dumps({'item_id': self.rice.id}),
+                                    content_type='application/json')
+        self.assertFalse(response.json()['success'])
+        response = self.client.post(reverse('cart'), json.dumps({'ops': [
+            {'item_id': self.rice.id, 'quantity': 1}, {'item_id': self.juice.id, 'quantity': 2},
+        ]}), content_type='application/json')
+        self.assertEqual([line['id'] for line in response.json()['items']], [self.juice.id])
+
+        # Unknown or closed outlets mean any outlet
+        response = self.client.post(reverse('set_outlet'), {'outlet': ''})
+        self.assertEqual(response.cookies['outlet'].value, '')
+        self.assertContains(self.client.get(reverse('menu')), self.rice.name)
+
+    def test_kitchen_queue_per_outlet(self):
+        snapshot = price_cart({str(self.rice.id): 1})
+        north = place_order(snapshot, 'Student', outlet=self.north)
+        south = place_order(snapshot, 'Student', outlet=self.south)
+        Order.objects.update(status=Order.STATUS_PAID)
+        self.client.force_login(User.objects.create_user('cook', is_staff=True))
+
+        response = self.client.get(reverse('kitchen_queue'))
+        self.assertEqual({order.id for order in response.context['columns'][0]['orders']},
+                         {north.id, south.id})
+        response = self.client.get(reverse('kitchen_queue'), {'outlet': 'south'})
+        self.assertEqual(response.context['outlet'], self.south)
+        self.assertEqual([order.id for order in response.context['columns'][0]['orders']], [south.id])
+
+
+class OrderFeedTests(TestCase):
+    def test_one_publish_reaches_every_subscriber(self):
+        async def run():
+            order_feed = OrderFeed()
+            subscriptions = [order_feed.subscribe() for _ in range(300)]
+            await asyncio.to_thread(order_feed.publish, 'order.created', {'id': 7})
+            return await asyncio.gather(*(s.get() for s in subscriptions))
+
+        received = asyncio.run(run())
+        self.assertEqual(len(received), 300)
+        self.assertEqual(set(received), {'event: order.created\ndata: {"id": 7}\n\n'})
+
+    def test_slow_subscriber_keeps_latest_events(self):
+        async def run():
+            order_feed = OrderFeed(max_pending=2)
+            with order_feed.subscribe() as subscription:
+                for i in range(5):
+                    order_feed.publish('order.updated', {'id': i})
+                await asyncio.sleep(0)
+                first = await subscription.get()
+            return first, len(order_feed)
+
+        first, remaining = asyncio.run(run())
+        self.assertIn('"id": 3', first)
+        self.assertEqual(remaining, 0)
+
+    def test_placed_order_is_recorded_and_relayed(self):
+        item, = make_items(1)
+        order = place_order(price_cart({str(item.id): 3}), 'Njeri')
+        event = OrderEvent.objects.get()
+        self.assertEqual(event.event, 'order.created')
+        self.assertEqual(event.data['id'], order.id)
+        self.assertEqual(event.data['items'], [{'name': item.name, 'quantity': 3}])
+
+        with mock.patch.object(feed, 'publish') as publish:
+            after_id = feed.relay_events(since=event.created_at)
+            publish.assert_called_once_with('order.created', event.data)
+            self.assertEqual(feed.relay_events(after_id), after_id)
+            self.assertEqual(publish.call_count, 1)
+
+    def test_prune_keeps_recent_and_newest_events(self):
+        OrderEvent.objects.bulk_create(OrderEvent(event='order.updated', data={'id': i}) for i in range(3))
+        first, *_, newest = OrderEvent.objects.order_by('id')
+        OrderEvent.objects.filter(id=first.id).update(created_at=timezone.now() - datetime.timedelta(days=1))
+
+        self.assertEqual(prune_events(), 1)
+        self.assertEqual(prune_events(older_than=timezone.now() + datetime.timedelta(minutes=1)), 1)
+        self.assertEqual(list(OrderEvent.objects.values_list('id', flat=True)), [newest.id])
+
+
+class OrderStreamTests(TestCase):
+    async def test_requires_staff(self):
+        response = await self.async_client.get(reverse('order_stream'))
+        self.assertEqual(response.status_code, 403)
+
+    async def test_streams_published_events(self):
+        user = await User.objects.acreate(username='kitchen', is_staff=True)
+        await self.async_client.aforce_login(user)
+
+        response = await self.async_client.get(reverse('order_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b': connected\n\n')
+
+        feed.publish('order.created', {'id': 42})
+        chunk = await asyncio.wait_for(anext(stream), timeout=1)
+        self.assertEqual(chunk, b'event: order.created\ndata: {"id": 42}\n\n')
+        await stream.aclose()
+
+    @override_settings(ORDER_FEED_POLL_INTERVAL=0.05)
+    async def test_streams_events_recorded_by_other_processes(self):
+        user = await User.objects.acreate(username='kitchen', is_staff=True)
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get(reverse('order_stream'))
+        stream = aiter(response.streaming_content)
+        await anext(stream)
+
+        # As a task worker would: it shares only the database with this process
+        await OrderEvent.objects.acreate(event='order.updated', data={'id': 42, 'status': 'paid'})
+        chunk = await asyncio.wait_for(anext(stream), timeout=2)
+        self.assertEqual(chunk, b'event: order.updated\ndata: {"id": 42, "status": "paid"}\n\n')
+        await stream.aclose()
+
+
+class CombinedCartTests(CartTestMixin, TestCase):
+    def setUp(self):
+        self.rice, self.juice = make_items(2, available_units=5)
+
+    def post_ops(self, ops):
+        return self.client.post(reverse('cart'), json.dumps({'ops': ops}),
+                                content_type='application/json')
+
+    def test_batch_mutations_in_one_request(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_ops([
+                {'item_id': self.rice.id, 'quantity': 2},
+                {'item_id': str(self.juice.id), 'quantity': 1},
+                {'item_id': self.rice.id, 'quantity': 1},
+                {'item_id': self.juice.id, 'remove': True},
+                {'item_id': self.juice.id, 'quantity': 9},
+                {'item_id': 999999, 'quantity': 1},
+            ])
+        data = response.json()
+
+        self.assertEqual(get_cart(self.client), {str(self.rice.id): 3})
+        self.assertEqual(data['cart_count'], 3)
+        self.assertEqual(data['total'], float(self.rice.price * 3))
+        self.assertEqual([e['item_id'] for e in data['errors']], [str(self.juice.id), '999999'])
+        menu_queries = [q for q in ctx.captured_queries if 'menu_menuitem' in q['sql']]
+        self.assertEqual(len(menu_queries), 2)  # one lookup for the ops, one to price the cart
+
+    def test_unchanged_cart_is_not_modified(self):
+        self.set_cart({str(self.rice.id): 1})
+        first = self.client.get(reverse('cart'))
+        etag = first['ETag']
+
+        second = self.client.get(reverse('cart'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(second.status_code, 304)
+
+        self.post_ops([{'item_id': self.rice.id, 'quantity': 1}])
+        third = self.client.get(reverse('cart'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(third.json()['cart_count'], 2)
+
+    def test_resent_batch_is_applied_once(self):
+        body = json.dumps({'batch': 'b1', 'ops': [{'item_id': self.rice.id, 'quantity': 2}]})
+        for _ in range(2):
+            response = self.client.post(reverse('cart'), body, content_type='application/json')
+            self.assertEqual(response.json()['cart_count'], 2)
+        self.post_ops([{'item_id': self.rice.id, 'quantity': 1}])
+        self.assertEqual(get_cart(self.client), {str(self.rice.id): 3})
+
+    def test_invalid_batch(self):
+        response = self.post_ops('nope')
+        self.assertEqual(response.status_code, 400)
+
+    def test_menu_page_embeds_cart(self):
+        self.set_cart({str(self.rice.id): 2})
+        response = self.client.get(reverse('menu'))
+        self.assertContains(response, '<span id="cart-count">2</span>')
+        self.assertContains(response, 'id="cart-data"')
+        self.assertEqual(response.context['cart_state']()['cart_count'], 2)
+
+    def test_first_visit_gets_a_csrf_cookie(self):
+        # The menu has no form for a new visitor, yet main.js posts the cart
+        client = Client(enforce_csrf_checks=True)
+        token = client.get(reverse('menu')).cookies['csrftoken'].value
+        response = client.post(reverse('cart'),
+                               json.dumps({'ops': [{'item_id': self.rice.id, 'quantity': 1}]}),
+                               content_type='application/json', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cart_count'], 1)
+
+    def test_cart_count_rejects_post(self):
+        self.assertEqual(self.client.post(reverse('get_cart_count')).status_code, 405)
+
+
+class CartStorageTests(TestCase):
+    backends = [
+        'menu.cart_storage.SignedCookieCartStorage',
+        'menu.cart_storage.CacheCartStorage',
+        'menu.cart_storage.SessionCartStorage',
+    ]
+
+    def setUp(self):
+        self.rice, = make_items(1, available_units=10)
+
+    def test_backends_round_trip(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend), self.settings(CART_STORAGE=backend):
+                self.client = self.client_class()
+                self.client.post(reverse('add_to_cart'), json.dumps({'item_id': str(self.rice.id), 'quantity': 2}),
+                                 content_type='application/json')
+                self.client.post(reverse('cart'), json.dumps({'ops': [{'item_id': self.rice.id, 'quantity': 1}]}),
+                                 content_type='application/json')
+                self.assertEqual(self.client.get(reverse('get_cart_count')).json()['cart_count'], 3)
+
+                self.client.post(reverse('remove_from_cart'), json.dumps({'item_id': self.rice.id}),
+                                 content_type='application/json')
+                self.assertEqual(self.client.get(reverse('cart')).json()['cart_count'], 0)
+
+    def test_client_side_backends_do_not_write_sessions(self):
+        for backend in self.backends[:2]:
+            with self.subTest(backend=backend), self.settings(CART_STORAGE=backend):
+                self.client = self.client_class()
+                with CaptureQueriesContext(connection) as ctx:
+                    self.client.post(reverse('add_to_cart'), json.dumps({'item_id': self.rice.id}),
+                                     content_type='application/json')
+                self.assertFalse([q for q in ctx.captured_queries if 'django_session' in q['sql']])
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['cart'] = '{"1": 99}'
+        self.assertEqual(self.client.get(reverse('cart')).json()['cart_count'], 0)
+
+
+def jpeg_bytes(color='red', size=(800, 600)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class MenuImageTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name, MENU_IMAGE_WIDTHS=[320, 640])
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, name, data):
+        return MenuItem.objects.create(
+            name=name, price=Decimal('50'), category='food', available_units=5,
+            image=SimpleUploadedFile(f'{name}.jfif', data, content_type='image/jpeg'))
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.upload('Chapati', jpeg_bytes())
+        second = self.upload('Chapati 2', jpeg_bytes())
+        other = self.upload('Juice', jpeg_bytes('orange'))
+
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.image_hash, second.image_hash)
+        self.assertNotEqual(first.image_hash, other.image_hash)
+        self.assertEqual(len(default_storage.listdir('menu_images')[1]), 2)
+
+        for width in (320, 640):
+            with default_storage.open(variant_name(first.image_hash, width, 'webp')) as f:
+                self.assertEqual(Image.open(f).size, (width, width * 3 // 4))
+            self.assertTrue(default_storage.exists(variant_name(first.image_hash, width, 'jpg')))
+
+    def test_menu_uses_srcset(self):
+        item = self.upload('Chapati', jpeg_bytes())
+        response = self.client.get(reverse('menu'))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, f'{item.image_hash}-640.webp 640w')
+        self.assertContains(response, 'loading="lazy"')
+
+    def test_backfill_dedupes_existing_images(self):
+        data = jpeg_bytes()
+        items = make_items(3)
+        for item in items:
+            name = default_storage.save('menu_images/chapati.jfif', ContentFile(data))
+            MenuItem.objects.filter(id=item.id).update(image=name)
+
+        call_command('backfill_menu_images', workers=2, prune=True, stdout=io.StringIO())
+
+        names = set(MenuItem.objects.values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertEqual(default_storage.listdir('menu_images')[1], [os.path.basename(names.pop())])
+        digest = MenuItem.objects.values_list('image_hash', flat=True)[0]
+        self.assertTrue(default_storage.exists(variant_name(digest, 640, 'webp')))
+
+
+class BulkMenuUpdateTests(TestCase):
+    def setUp(self):
+        self.rice, self.juice = make_items(2, available_units=5)
+        self.client.force_login(User.objects.create_superuser('manager'))
+        self.url = reverse('menu_stock_api')
+
+    def test_updates_whole_menu_in_constant_queries(self):
+        items = make_items(300)
+        rows = [{'id': item.id, 'price': '20.00', 'available_units': 7} for item in items]
+        version = get_version()
+
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(self.url, rows, content_type='application/json')
+
+        report = response.json()
+        self.assertEqual((report['updated'], report['invalid'], report['applied']), (300, 0, True))
+        self.assertEqual(MenuItem.objects.filter(price=Decimal('20.00'), available_units=7).count(), 300)
+        self.assertGreater(get_version(), version)
+        # Session, user, one SELECT for the items, then one UPDATE and the
+        # stock check's task inside a savepoint.
+        self.assertLessEqual(len(ctx.captured_queries), 7)
+
+    def test_invalid_row_saves_nothing(self):
+        response = self.client.post(self.url, {'items': [
+            {'id': self.rice.id, 'available_units': 40},
+            {'name': self.juice.name, 'price': '-1'},
+            {'id': 999999, 'price': '5'},
+            {'id': self.rice.id, 'price': '5'},
+        ]}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        rows = response.json()['rows']
+        self.assertEqual(rows[0]['status'], 'updated')
+        self.assertEqual(rows[1]['errors'], {'price': 'Enter a price of 0 or more.'})
+        self.assertIn('id', rows[2]['errors'])
+        self.assertIn('id', rows[3]['errors'])
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 5)
+
+    def test_dry_run_and_permissions(self):
+        rows = [{'id': self.rice.id, 'available_units': 40}]
+        response = self.client.post(self.url + '?dry_run=1', rows, content_type='application/json')
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(MenuItem.objects.get(id=self.rice.id).available_units, 5)
+
+        self.client.force_login(User.objects.create_user('student'))
+        self.assertEqual(self.client.post(self.url, rows, content_type='application/json').status_code, 403)
+
+    def test_admin_csv_round_trip(self):
+        response = self.client.post(reverse('admin:menu_menuitem_changelist'), {
+            'action': 'export_stock_csv', '_selected_action': [self.rice.id, self.juice.id]})
+        exported = response.content.decode().replace(',5\r\n', ',12\r\n')
+        self.assertContains(self.client.get(reverse('admin:menu_menuitem_import_csv')), 'csv_file')
+
+        response = self.client.post(reverse('admin:menu_menuitem_import_csv'), {
+            'csv_file': SimpleUploadedFile('stock.csv', exported.encode('utf-8-sig'))})
+        self.assertRedirects(response, reverse('admin:menu_menuitem_changelist'))
+        self.assertEqual(
+            list(MenuItem.objects.values_list('available_units', flat=True)), [12, 12])
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1.0, METRICS_TOKEN='scrape-me')
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+        make_items(3)
+
+    def test_server_timing_and_metrics(self):
+        self.client.get(reverse('menu'))  # warm the menu cache
+        registry.reset()
+        response = self.client.get(reverse('menu'))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'sql', 'tpl', 'mpesa', 'total'})
+        self.assertIn('desc="3 queries"', timing['sql'])
+        self.assertNotEqual(timing['tpl'], 'dur=0.0')
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('portal_requests_total{view="menu"} 1\n', body)
+        self.assertIn('portal_sql_queries_total{view="menu"} 3\n', body)
+        self.assertIn('portal_request_seconds_count{view="menu"} 1\n', body)
+
+    def test_metrics_need_staff_or_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer nope')
+        self.assertEqual(response.status_code, 403)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_left_alone(self):
+        response = self.client.get(reverse('menu'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(registry.views, {})
+
+    def test_templates_are_timed_without_patching_django(self):
+        # Only through the middleware's TemplateResponse hook
+        self.assertEqual(DjangoTemplate.render.__module__, 'django.template.backends.django')
+        response = self.client.get(reverse('cart'))
+        self.assertIn('tpl;dur=0.0,', response['Server-Timing'])
+
+    def test_mpesa_calls_are_timed(self):
+        server = FakeMpesaServer().start()
+        self.addCleanup(server.stop)
+        with override_settings(MPESA_BASE_URL=server.url):
+            initiate_mpesa_payment('254700000000', 10)
+        self.assertEqual(registry.mpesa['ok'][0], 1)
+        self.assertIn('portal_mpesa_requests_total{outcome="ok"} 1', registry.render(1.0))
+
+
+class StaticAssetTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, root)
+        cls.enterClassContext(override_settings(STATIC_ROOT=root, STATIC_SERVE=True))
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_fingerprinted_assets_are_compressed_and_immutable(self):
+        url = static('css/style.css')
+        self.assertRegex(url, r'^/static/css/style\.[0-9a-f]{12}\.css$')
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        css = gzip.decompress(b''.join(response.streaming_content)).decode()
+        self.assertIn(':root{--primary-color:#134e32;', css)
+        self.assertNotIn('/* Menu search */', css)
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content).decode(), css)
+
+    def test_plain_names_revalidate(self):
+        url = '/static/js/main.js'
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+        self.assertNotIn(b'// Menu Search', b''.join(response.streaming_content))
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get('/static/js/missing.js').status_code, 404)
+        self.assertEqual(self.client.get('/static/../manage.py').status_code, 404)
+
+    def test_unknown_files_fall_back_to_plain_names(self):
+        self.assertEqual(static('images/default-food.jpg'), '/static/images/default-food.jpg')
+        with override_settings(STATIC_ROOT=tempfile.gettempdir() + '/no-manifest'):
+            self.assertEqual(static('css/style.css'), '/static/css/style.css')
+
+    def test_minify_css(self):
+        self.assertEqual(
+            minify_css('/* header */\nh1 ,h2 > a:hover {\n    color: red;\n    margin: 0 auto;\n}\n/*! keep */'),
+            'h1,h2>a:hover{color:red;margin:0 auto}/*! keep */')
+        self.assertEqual(minify_css('a::before {\n  content: " : { } ; /* x */ ";\n}'),
+                         'a::before{content:" : { } ; /* x */ "}')
+
+    def test_minify_js_leaves_literals_alone(self):
+        source = ("const a = `line 1\n    line 2 ${x ? `in ${y}` : '// no'} end`;  // note\n"
+                  "    /* block */ let r = /\\/\\/[/'\"]/g, d = a / 2 / 3;\n\n")
+        self.assertEqual(minify_js(source), "const a = `line 1\n    line 2 ${x ? `in ${y}` : '// no'} end`;\n"
+                                            "let r = /\\/\\/[/'\"]/g, d = a / 2 / 3;\n")
+
+    def test_built_main_js_keeps_its_literals(self):
+        with open(finders.find('js/main.js')) as f:
+            source = f.read()
+        built = b''.join(self.client.get('/static/js/main.js').streaming_content).decode()
+        self.assertLess(len(built), len(source))
+
+        def literals(text):
+            return [literal for _, literal in _js_pieces(text) if literal]
+        self.assertEqual(literals(built), literals(source))
+        # The card markup spans several lines of a template literal
+        card = source[source.index('innerHTML = `') + 12:]
+        self.assertIn(card[:card.index('`;', 1) + 1], built)
+
+
+class BenchmarkBaselineTests(SimpleTestCase):
+    def test_regressions_against_baseline(self):
+        baseline = {'menu_view': {'p95': 4.0, 'queries': 2}, 'get_cart': {'p95': 2.0, 'queries': 1}}
+        self.assertEqual(find_regressions(baseline, {
+            'menu_view': {'p95': 5.5, 'queries': 2},
+            'get_cart': {'p95': 1.5, 'queries': 1},
+            'order_list': {'p95': 90.0, 'queries': 4},
+        }), [])
+        problems = find_regressions(baseline, {
+            'menu_view': {'p95': 9.0, 'queries': 2},
+            'get_cart': {'p95': 2.0, 'queries': 3},
+        })
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(problems[0].startswith('menu_view: p95 9.00ms'))
+        self.assertTrue(problems[1].startswith('get_cart: 3 queries'))
+
+
+class MigrationTests(TestCase):
+    def test_models_match_migrations(self):
+        # Run the suite with DB_ENGINE=postgres as well as the default SQLite
+        # profile; the test database itself is built from these migrations.
+        call_command('makemigrations', 'menu', check=True, dry_run=True, stdout=io.StringIO())
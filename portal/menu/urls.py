@@ -15,20 +15,33 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
-from . import views
+from . import api, views
 from django.contrib.auth import views as auth_views
 
 
 urlpatterns = [
     path('', views.menu_view, name='menu'),
+    path('search/', views.menu_search, name='menu_search'),
+    path('sw.js', views.service_worker, name='service_worker'),
+    path('outlet/', views.set_outlet, name='set_outlet'),
     path('add-to-cart/', views.add_to_cart, name='add_to_cart'),
     path('order/<int:order_id>/', views.order_detail, name='order_detail'),
     path('get-cart-count/', views.get_cart_count, name='get_cart_count'),
     path('get-cart/', views.get_cart, name='get_cart'),
+    path('cart/', views.cart_view, name='cart'),
     path('remove-from-cart/', views.remove_from_cart, name= 'remove_from_cart'),
     path('confirm-order/', views.confirm_order, name='confirm_order'),
      path('checkout/', views.checkout_view, name='checkout'),
     path('orders/<int:order_id>/delete/', views.delete_order, name='delete_order'),
      path('accounts/logout/', auth_views.LogoutView.as_view(next_page='menu'), name='logout'),
       path('orders/', views.order_list, name='order_list'),
+    path('orders/stream/', views.order_stream, name='order_stream'),
+    path('kitchen/', views.kitchen_queue, name='kitchen_queue'),
+    path('kitchen/advance/', views.advance_orders_view, name='advance_orders'),
+    path('api/payment-callback/', views.mpesa_callback, name='mpesa_callback'),
+    path('api/menu/stock/', api.menu_stock, name='menu_stock_api'),
+    path('api/menu/sync/', views.menu_sync, name='menu_sync'),
+    path('reports/sales/', views.sales_report_view, name='sales_report'),
+    path('reports/sales.csv', views.sales_report_csv, name='sales_report_csv'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
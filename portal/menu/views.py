@@ -1,29 +1,107 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import redirect, get_object_or_404
+from django.template.response import TemplateResponse
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-from .models import MenuItem, Announcement, Order, OrderItem
+from django.conf import settings
+from django.http import (
+    Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from .models import MenuItem, Order, Outlet, PickupSlot
+from .analytics import iter_csv, sales_report
+from .archive import find_archived_order
+from .metrics import registry
+from .mpesa import callback_allowed
+from .outlets import get_outlet, sold_out_ids, with_outlet_units
+from .cart import CartError, add_item, cart_payload, price_cart
+from .feed import feed
+from .kitchen import advance_orders
+from .menu_cache import render_menu
+from .pagination import keyset_page
+from .ratelimit import rate_limit, start_session
+from .search import index as search_index
+from .payments import PaymentResult, apply_payment_results
+from .stock import OutOfStock, SlotFull, cancel_order, place_order
+from .sync import menu_changes
+from . import tasks
+import asyncio
+import datetime
+import hashlib
 import json
+import secrets
+from urllib.parse import urlencode
 from django.contrib import messages
+from django.core.cache import caches
+from django.db import IntegrityError
+from django.templatetags.static import static
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.http import require_POST
-import base64
-import datetime
-import requests
-from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
 
+# How many upcoming pickup times the menu and checkout list
+PICKUP_SLOTS_SHOWN = 8
+# What the service worker fetches up front to show the menu offline; one
+# missing file fails its install. Images are kept as they are first shown.
+OFFLINE_ASSETS = ['css/style.css', 'js/main.js']
+
+@ensure_csrf_cookie
 def menu_view(request):
-    food_items = MenuItem.objects.filter(category='food', available_units__gt=0)
-    beverage_items = MenuItem.objects.filter(category='beverage', available_units__gt=0)
-    announcements = Announcement.objects.filter(is_active=True).order_by('-created_at')[:5]
-    
-    context = {
-        'food_items': food_items,
-        'beverage_items': beverage_items,
-        'announcements': announcements,
+    # Taken before reading the menu: the page's delta sync starts here
+    watermark = timezone.now()
+    outlet = get_outlet(request)
+    context = render_menu(outlet)
+    context['outlet'] = outlet
+    # Remaining capacity is read straight off the slot counters
+    context['pickup_slots'] = PickupSlot.objects.upcoming()[:PICKUP_SLOTS_SHOWN]
+    context['menu_sync'] = {
+        'url': reverse('menu_sync'),
+        'watermark': watermark.isoformat(),
+        'service_worker': reverse('service_worker'),
     }
-    return render(request, 'menu.html', context)
+    # The service worker keeps a copy of the menu for when the connection
+    # drops; one with a flash message in it mustn't be shown again
+    has_messages = bool(len(messages.get_messages(request)))
+    response = TemplateResponse(request, 'menu.html', context)
+    if has_messages:
+        patch_cache_control(response, no_store=True)
+    return response
+
+def service_worker(request):
+    # Served from the root so that it controls the whole site
+    urls = [static(name) for name in OFFLINE_ASSETS]
+    response = TemplateResponse(request, 'sw.js', {
+        'cache_version': hashlib.sha256(json.dumps(urls).encode()).hexdigest()[:12],
+        'menu_url': reverse('menu'),
+        'static_url': static(''),
+        'media_url': settings.MEDIA_URL,
+        'precache': json.dumps([reverse('menu'), *urls]),
+    }, content_type='text/javascript')
+    patch_cache_control(response, no_cache=True)
+    return response
 
+@require_POST
+def set_outlet(request):
+    # Where the student will collect; the menu, cart and checkout follow it
+    response = redirect('menu')
+    slug = request.POST.get('outlet', '')
+    if Outlet.objects.filter(slug=slug, is_active=True).exists():
+        response.set_cookie(settings.OUTLET_COOKIE_NAME, slug, max_age=settings.OUTLET_COOKIE_AGE,
+                            samesite='Lax')
+    else:
+        # Any outlet: orders go to the least busy one that has the items
+        response.delete_cookie(settings.OUTLET_COOKIE_NAME, samesite='Lax')
+    return response
+
+def _cart_items(request, item_ids):
+    # Menu items with the stock the student's outlet can sell
+    outlet = get_outlet(request)
+    items = MenuItem.objects.filter(id__in=item_ids)
+    if outlet is not None:
+        items = with_outlet_units(items, outlet)
+    return items.in_bulk(), outlet
+
+@rate_limit('cart')
 @require_http_methods(["GET", "POST"])
 def add_to_cart(request):
     if request.method == 'POST':
@@ -32,44 +110,30 @@ def add_to_cart(request):
             item_id = data.get('item_id')
             quantity = int(data.get('quantity', 1))
             
-            try:
-                item = MenuItem.objects.get(id=item_id, available_units__gt=0)
-                
-                if quantity > item.available_units:
-                    return JsonResponse({
-                        'success': False,
-                        'error': f'Only {item.available_units} units available'
-                    })
-                
-                # Initialize cart if it doesn't exist
-                if 'cart' not in request.session:
-                    request.session['cart'] = {}
-                
-                # Update cart
-                cart = request.session['cart']
-                if item_id in cart:
-                    if (cart[item_id] + quantity) > item.available_units:
-                        return JsonResponse({
-                            'success': False,
-                            'error': 'Not Available'
-                        })
-                    cart[item_id] += quantity
-                else:
-                    cart[item_id] = quantity
-                
-                request.session.modified = True
-                
+            items, outlet = _cart_items(request, [item_id] if str(item_id).isdigit() else [])
+            item = items.get(int(item_id)) if items else None
+            if item is None:
                 return JsonResponse({
-                    'success': True,
-                    'cart_count': sum(cart.values()),
-                    'message': 'Item added to cart'
+                    'success': False,
+                    'error': 'Item not available'
                 })
-                
-            except MenuItem.DoesNotExist:
+
+            cart = request.cart.load()
+            try:
+                add_item(cart, item, quantity, item.outlet_units if outlet else None)
+            except CartError as e:
                 return JsonResponse({
                     'success': False,
-                    'error': 'Item not available'
+                    'error': str(e)
                 })
+
+            request.cart.save(cart)
+
+            return JsonResponse({
+                'success': True,
+                'cart_count': sum(cart.values()),
+                'message': 'Item added to cart'
+            })
                 
         except Exception as e:
             return JsonResponse({
@@ -82,45 +146,77 @@ def add_to_cart(request):
         'error': 'Invalid request method'
     }, status=405)
 
+@rate_limit('cart_read')
 @require_http_methods(["GET"])
 def get_cart(request):
-    cart = request.session.get('cart', {})
-    items = []
-    total = 0
-    
-    for item_id, quantity in cart.items():
+    return JsonResponse(cart_payload(request.cart.load(), get_outlet(request)))
+
+@rate_limit('cart')
+@require_http_methods(["GET", "POST"])
+def cart_view(request):
+    """
+    Combined cart endpoint.
+
+    GET returns the priced cart with an ETag so an unchanged cart costs a
+    304. POST applies a batch of mutations in one round trip:
+    ``{"ops": [{"item_id": 3, "quantity": 2}, {"item_id": 5, "remove": true}]}``.
+
+    A ``"batch"`` id makes the POST safe to repeat: the offline queue in
+    main.js resends a batch whose answer it never saw, and a batch that
+    was applied already is not applied again.
+    """
+    cart = request.cart.load()
+    outlet = get_outlet(request)
+    errors = []
+
+    if request.method == 'POST':
         try:
-            item = MenuItem.objects.get(id=item_id)
-            items.append({
-                'id': item.id,
-                'name': item.name,
-                'price': float(item.price),
-                'quantity': quantity,
-                'available': item.available_units > 0,
-                'subtotal': float(item.price) * quantity
-            })
-            total += float(item.price) * quantity
-        except MenuItem.DoesNotExist:
-            continue
-    
-    return JsonResponse({
-        'success': True,
-        'items': items,
-        'total': total,
-        'cart_count': sum(cart.values())
-    })
+            data = json.loads(request.body)
+            ops = data['ops']
+            item_ids = {str(op['item_id']) for op in ops}
+            batch = str(data.get('batch') or '')[:64]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return JsonResponse({'success': False, 'error': f'Invalid request: {e}'}, status=400)
+
+        if batch and not caches[settings.CART_CACHE_ALIAS].add(
+                f'cart-batch:{batch}', True, timeout=settings.CART_COOKIE_AGE):
+            ops = []
+        items, _ = _cart_items(request, [i for i in item_ids if i.isdigit()] if ops else [])
+        for op in ops:
+            key = str(op['item_id'])
+            if op.get('remove'):
+                cart.pop(key, None)
+                continue
+            item = items.get(int(key)) if key.isdigit() else None
+            try:
+                if item is None:
+                    raise CartError('Item not available')
+                add_item(cart, item, int(op.get('quantity', 1)), item.outlet_units if outlet else None)
+            except (CartError, TypeError, ValueError) as e:
+                errors.append({'item_id': key, 'error': str(e)})
+        request.cart.save(cart)
+
+    payload = cart_payload(cart, outlet)
+    if errors:
+        payload['errors'] = errors
+    response = JsonResponse(payload)
+    patch_cache_control(response, private=True, no_cache=True)
+    if request.method == 'GET':
+        set_response_etag(response)
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+    return response
 
+@rate_limit('cart')
 @require_http_methods(["POST"])
 def remove_from_cart(request):
     try:
         data = json.loads(request.body)
-        item_id = data.get('item_id')
+        item_id = str(data.get('item_id'))
         
-        cart = request.session.get('cart', {})
+        cart = request.cart.load()
         if item_id in cart:
             del cart[item_id]
-            request.session['cart'] = cart
-            request.session.modified = True
+            request.cart.save(cart)
             
             return JsonResponse({
                 'success': True,
@@ -139,60 +235,202 @@ def remove_from_cart(request):
             'error': str(e)
         }, status=400)
 
-@csrf_exempt
+@rate_limit('cart_read')
+@require_http_methods(["GET"])
 def get_cart_count(request):
-    cart = request.session.get('cart', {})
+    cart = request.cart.load()
     return JsonResponse({'cart_count': sum(cart.values())})
 
+SEARCH_RESULTS = 20
+SEARCH_MAX_RESULTS = 50
+
+@rate_limit('search')
+@require_http_methods(["GET"])
+def menu_search(request):
+    try:
+        limit = min(max(int(request.GET.get('limit', SEARCH_RESULTS)), 1), SEARCH_MAX_RESULTS)
+    except ValueError:
+        limit = SEARCH_RESULTS
+    search_index.ensure_current()
+    # Like the menu page, only offer what is in stock right now. Stock
+    # isn't kept in the index; sold-out items are few, so read those.
+    sold_out = sold_out_ids(get_outlet(request))
+    result = search_index.search(
+        request.GET.get('q', ''),
+        category=request.GET.get('category') or None,
+        station=request.GET.get('station') or None,
+        tags=[tag.strip().lower() for tag in request.GET.getlist('tag') if tag.strip()],
+        limit=limit,
+        exclude=sold_out,
+    )
+    return JsonResponse({'success': True, **result})
+
+def _id_list(value):
+    return [int(part) for part in value.split(',') if part.strip().isdigit()]
+
+@rate_limit('sync')
+@require_http_methods(["GET"])
+def menu_sync(request):
+    """
+    Delta sync for a menu page the browser already has: the items and
+    announcements saved since ``?since=`` (the ``watermark`` the page or
+    the last sync gave), and which of them to show now. ``?items=`` and
+    ``?announcements=`` ask for rows by id, for ones the page is missing.
+    """
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid since'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since, datetime.timezone.utc)
+    changes = menu_changes(
+        since or None, get_outlet(request),
+        item_ids=_id_list(request.GET.get('items', '')),
+        announcement_ids=_id_list(request.GET.get('announcements', '')),
+    )
+    response = JsonResponse({'success': True, **changes})
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 @csrf_exempt
 def get_cart_items(request):
-    cart = request.session.get('cart', {})
-    items = []
-    total = 0
-    
-    for item_id, quantity in cart.items():
-        try:
-            item = MenuItem.objects.get(id=item_id)
-            items.append({
-                'id': item.id,
-                'name': item.name,
-                'price': str(item.price),
-                'quantity': quantity,
-                'subtotal': item.price * quantity,
-                'available': item.available_units
-            })
-            total += item.price * quantity
-        except MenuItem.DoesNotExist:
-            continue
-    
+    cart = request.cart.load()
+    snapshot = price_cart(cart, get_outlet(request))
+    items = [{
+        'id': line.item_id,
+        'name': line.name,
+        'price': str(line.price),
+        'quantity': line.quantity,
+        'subtotal': line.subtotal,
+        'available': line.available_units
+    } for line in snapshot.lines]
+
     return JsonResponse({
         'items': items,
-        'total': total
+        'total': snapshot.total
     })
 
+ORDER_LIST_PAGE_SIZE = 50
+ORDER_STREAM_KEEPALIVE = 15  # seconds
+
 # Only logged-in staff/workers can view the list of all orders
 @login_required
 def order_list(request):
     # Show all orders for staff or workers
     if request.user.is_staff or request.user.groups.filter(name='Workers').exists():
-        orders = Order.objects.all().order_by('-created_at')
+        # "Find order" box; also finds archived orders
+        if request.GET.get('order', '').isdigit():
+            return redirect('order_detail', order_id=int(request.GET['order']))
+        orders = keyset_page(
+            Order.objects.with_totals().select_related('pickup_slot').prefetch_related('items'),
+            cursor=request.GET.get('cursor'),
+            page_size=ORDER_LIST_PAGE_SIZE,
+        )
     else:
         messages.error(request, "You don't have permission to view orders.")
         return redirect('home')  # or a safer page
-    return render(request, 'orders/list.html', {'orders': orders})
+    return TemplateResponse(request, 'orders/list.html', {'orders': orders})
+
+# Live feed of new orders and status changes for kitchen screens.
+# Needs an ASGI server (see food_portal/asgi.py) to stream.
+async def order_stream(request):
+    user = await request.auser()
+    if not user.is_authenticated or not (
+            user.is_staff or await user.groups.filter(name='Workers').aexists()):
+        return HttpResponseForbidden()
+
+    async def events():
+        with feed.subscribe() as subscription:
+            yield ': connected\n\n'
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.get(), ORDER_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# Kitchen queue: only the orders still in progress, read through
+# order_status_created_idx so it costs the same however long the history is
+KITCHEN_QUEUE_SIZE = 200
+KITCHEN_COLUMNS = [
+    # (status shown, status the column's button moves orders on to, button label)
+    (Order.STATUS_PAID, Order.STATUS_PREPARING, 'Start preparing'),
+    (Order.STATUS_PREPARING, Order.STATUS_READY, 'Mark ready'),
+    (Order.STATUS_READY, Order.STATUS_COLLECTED, 'Mark collected'),
+]
+
+@login_required
+def kitchen_queue(request):
+    if not (request.user.is_staff or request.user.groups.filter(name='Workers').exists()):
+        messages.error(request, "You don't have permission to view the kitchen queue.")
+        return redirect('menu')
+
+    # Each outlet's kitchen reads only its own orders, via order_outlet_status_idx
+    outlets = list(Outlet.objects.filter(is_active=True))
+    outlet = next((o for o in outlets if o.slug == request.GET.get('outlet')), None)
+    orders = Order.objects.active()
+    if outlet is not None:
+        orders = orders.filter(outlet=outlet)
+    orders = list(orders.select_related('pickup_slot', 'outlet')
+                  .prefetch_related('items')[:KITCHEN_QUEUE_SIZE])
+    labels = dict(Order.STATUS_CHOICES)
+    columns = [
+        {'status': status, 'label': labels[status], 'next': next_status, 'action': action,
+         'orders': [order for order in orders if order.status == status]}
+        for status, next_status, action in KITCHEN_COLUMNS
+    ]
+    return TemplateResponse(request, 'orders/kitchen.html',
+                            {'columns': columns, 'outlets': outlets, 'outlet': outlet})
+
+@login_required
+@require_POST
+def advance_orders_view(request):
+    if not (request.user.is_staff or request.user.groups.filter(name='Workers').exists()):
+        messages.error(request, "You don't have permission to update orders.")
+        return redirect('menu')
+
+    queue_url = reverse('kitchen_queue')
+    if request.POST.get('outlet'):
+        queue_url += '?' + urlencode({'outlet': request.POST['outlet']})
+    status = request.POST.get('status')
+    if status not in (next_status for _, next_status, _ in KITCHEN_COLUMNS):
+        messages.error(request, "Unknown order status.")
+        return redirect(queue_url)
+    order_ids = [int(order_id) for order_id in request.POST.getlist('order') if order_id.isdigit()]
+    moved = advance_orders(order_ids, status)
+
+    label = dict(Order.STATUS_CHOICES)[status].lower()
+    if moved:
+        messages.success(request, f"{len(moved)} order(s) marked {label}.")
+    if len(moved) < len(order_ids):
+        # Someone else moved them first, or they were ticked in the wrong column
+        messages.warning(request, f"{len(order_ids) - len(moved)} order(s) could not be marked {label}.")
+    return redirect(queue_url)
 
 # View specific order details
 @login_required
 def order_detail(request, order_id):
-    order = get_object_or_404(Order, id=order_id)
-
     # Only allow staff or workers to view any order
-    if request.user.is_staff or request.user.groups.filter(name='Workers').exists():
-        return render(request, 'orders/detail.html', {'order': order})
-    else:
+    if not (request.user.is_staff or request.user.groups.filter(name='Workers').exists()):
         messages.error(request, "You don't have permission to view this order.")
         return redirect('order_list')
 
+    order = Order.objects.filter(id=order_id).first()
+    if order is None:
+        # Old orders are moved out of the database by archive_orders
+        order = find_archived_order(order_id)
+        if order is None:
+            raise Http404("No such order.")
+        return TemplateResponse(request, 'orders/detail.html', {'order': order, 'archived': True})
+    return TemplateResponse(request, 'orders/detail.html', {'order': order})
+
 # Delete order (only for staff or workers)
 @login_required
 def delete_order(request, order_id):
@@ -200,116 +438,169 @@ def delete_order(request, order_id):
 
     if request.user.is_staff or request.user.groups.filter(name='Workers').exists():
         if request.method == 'POST':
-            order.delete()
+            # Gives back the order's stock and pickup slot place
+            cancel_order(order)
             return redirect('order_list')
-        return render(request, 'orders/confirm_delete.html', {'order': order})
+        return TemplateResponse(request, 'orders/confirm_delete.html', {'order': order})
     else:
         messages.error(request, "You don't have permission to delete this order.")
         return redirect('order_list')
 def checkout_view(request):
-    cart = request.session.get('cart', {})
-    items = []
-    total = 0
-
-    for item_id, quantity in cart.items():
-        try:
-            menu_item = MenuItem.objects.get(id=item_id)
-            subtotal = menu_item.price * quantity
-            items.append({
-                'id': item_id,
-                'name': menu_item.name,
-                'price': menu_item.price,
-                'quantity': quantity,
-                'subtotal': subtotal
-            })
-            total += subtotal
-        except MenuItem.DoesNotExist:
-            continue
+    cart = request.cart.load()
+    outlet = get_outlet(request)
+    snapshot = price_cart(cart, outlet)
+    items = [{
+        'id': line.item_id,
+        'name': line.name,
+        'price': line.price,
+        'quantity': line.quantity,
+        'subtotal': line.subtotal
+    } for line in snapshot.lines]
 
     context = {
         'items': items,
-        'total': total
+        'total': snapshot.total,
+        'pickup_slots': PickupSlot.objects.open()[:PICKUP_SLOTS_SHOWN],
+        'outlet': outlet,
+        # One key per rendered form; confirm_order places at most one order per key
+        'idempotency_key': secrets.token_urlsafe(24),
     }
-    return render(request, 'checkout.html', context)
+    # confirm_order's rate limit counts per session, so make sure there is one
+    start_session(request)
+    return TemplateResponse(request, 'checkout.html', context)
+@rate_limit('checkout', redirect_to='checkout')
 @require_POST
 def confirm_order(request):
     customer_name = request.POST.get('name')
     phone = request.POST.get('phone')
-    cart = request.session.get('cart', {})
+    idempotency_key = request.POST.get('idempotency_key', '')[:64] or None
+    # A double-click or resubmit of a form that already placed its order
+    if idempotency_key and Order.objects.filter(idempotency_key=idempotency_key).exists():
+        return _order_already_placed(request)
+    cart = request.cart.load()
 
     if not customer_name or not phone or not cart:
         messages.error(request, "All fields are required.")
         return redirect('checkout')
 
-    # Calculate total
-    total = 0
-    for item_id, quantity in cart.items():
-        try:
-            item = MenuItem.objects.get(id=item_id)
-            total += item.price * quantity
-        except MenuItem.DoesNotExist:
-            continue
-    total = int(total) # Convert to integer
-    # Call M-Pesa STK push
-    payment_response = initiate_mpesa_payment(phone, total)
-
-    if payment_response.get('ResponseCode') == '0':
-        # Create the order
-        order = Order.objects.create(customer_name=customer_name)
-        for item_id, quantity in cart.items():
-            try:
-                item = MenuItem.objects.get(id=item_id)
-                OrderItem.objects.create(
-                    order=order,
-                    item_name=item.name,
-                    item_price=item.price,
-                    quantity=quantity
-                )
-
-                item.available_units -= quantity
-                item.save()
-
-            except MenuItem.DoesNotExist:
-                continue
-
-        request.session['cart'] = {}
-        messages.success(request, "Order placed! Awaiting payment confirmation on your phone.")
+    # Price the whole cart once and reuse it for the order lines
+    outlet = get_outlet(request)
+    snapshot = price_cart(cart, outlet)
+    if not snapshot:
+        messages.error(request, "Your cart is empty.")
         return redirect('menu')
 
+    # Once pickup slots are set up every order needs one
+    try:
+        pickup_slot = int(request.POST['pickup_slot']) if request.POST.get('pickup_slot') else None
+    except ValueError:
+        pickup_slot = None
+    if pickup_slot is None and PickupSlot.objects.upcoming().exists():
+        messages.error(request, "Please choose a pickup time.")
+        return redirect('checkout')
+
+    # Reserve stock and the pickup slot before asking for payment so we never
+    # oversell; the STK push is queued with the order and sent by a task worker
+    try:
+        order = place_order(snapshot, customer_name, phone=phone, pickup_slot=pickup_slot,
+                            idempotency_key=idempotency_key, outlet=outlet, pay=True)
+    except (OutOfStock, SlotFull) as e:
+        messages.error(request, str(e))
+        return redirect('checkout')
+    except IntegrityError:
+        # The same form submitted twice at once; the other request placed the order
+        if idempotency_key and Order.objects.filter(idempotency_key=idempotency_key).exists():
+            return _order_already_placed(request)
+        raise
+
+    request.cart.clear()
+    if order.outlet_id:
+        messages.success(request, f"Order placed for collection at {order.outlet.name}! "
+                                  "Awaiting payment confirmation on your phone.")
     else:
-        messages.error(request, "Failed to initiate M-Pesa payment. Try again.")
+        messages.success(request, "Order placed! Awaiting payment confirmation on your phone.")
+    return redirect('menu')
+
+
+def _order_already_placed(request):
+    request.cart.clear()
+    messages.info(request, "Your order was already placed. Check your phone for the payment prompt.")
+    return redirect('menu')
+
+
+@csrf_exempt
+@require_POST
+def mpesa_callback(request):
+    # Safaricom posts the STK push outcome here (settings.MPESA_CALLBACK_URL)
+    if not callback_allowed(request):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Forbidden'}, status=403)
+    try:
+        result = PaymentResult.from_callback(json.loads(request.body))
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid callback'}, status=400)
+
+    apply_payment_results([result])
+    # Always acknowledge, including repeats, so Safaricom stops retrying
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+
+# Sales reports for staff; these only read the SalesRollup table
+REPORT_DEFAULT_DAYS = 7
+
+def _report_range(request):
+    end = request.GET.get('end')
+    start = request.GET.get('start')
+    try:
+        end = datetime.date.fromisoformat(end) if end else timezone.localdate()
+        start = (datetime.date.fromisoformat(start) if start
+                 else end - datetime.timedelta(days=REPORT_DEFAULT_DAYS - 1))
+    except ValueError:
+        return None
+    return (start, end) if start <= end else None
+
+@login_required
+def sales_report_view(request):
+    if not request.user.is_staff:
+        messages.error(request, "You don't have permission to view reports.")
         return redirect('menu')
 
-def initiate_mpesa_payment(phone, amount):
-    
-    token_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    r = requests.get(token_url, auth=(settings.MPESA_CONSUMER_KEY, settings.MPESA_CONSUMER_SECRET))
-    access_token = r.json().get('access_token')
+    date_range = _report_range(request)
+    if date_range is None:
+        messages.error(request, "Enter a valid date range.")
+        return redirect('sales_report')
 
-    
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-    password = base64.b64encode(
-        (settings.MPESA_SHORTCODE + settings.MPESA_PASSKEY + timestamp).encode()).decode()
+    report = sales_report(*date_range)
+    # Scale the peak-hours bars against the busiest hour
+    busiest = max((row['units'] for row in report['hours']), default=0)
+    for row in report['hours']:
+        row['share'] = round(row['units'] * 100 / busiest) if busiest else 0
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    return TemplateResponse(request, 'reports/sales.html', {
+        'report': report,
+        'start': date_range[0],
+        'end': date_range[1],
+    })
+
+@login_required
+def sales_report_csv(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    date_range = _report_range(request)
+    if date_range is None:
+        return JsonResponse({'success': False, 'error': 'Invalid date range'}, status=400)
+
+    response = StreamingHttpResponse(iter_csv(*date_range), content_type='text/csv')
+    response['Content-Disposition'] = (
+        f'attachment; filename="sales-{date_range[0]}-to-{date_range[1]}.csv"')
+    return response
 
-    payload = {
-        "BusinessShortCode": "174379",
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": amount,
-        "PartyA": "254708374149",
-        "PartyB":"174379" ,
-        "PhoneNumber": phone,
-        "CallBackURL": "https://example.com/api/mpesa/callback",
-        "AccountReference": "Order Payment",
-        "TransactionDesc": "Food order payment"
-    }
 
-    stk_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-    response = requests.post(stk_url, json=payload, headers=headers)
-    return response.json()
+def metrics_view(request):
+    # Prometheus scrapes with a bearer token; staff can look in a browser
+    token = settings.METRICS_TOKEN
+    authorized = bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+    if not (authorized or request.user.is_staff):
+        return HttpResponseForbidden()
+    # Queue figures come from the tasks table, so they cover every worker
+    body = registry.render(settings.INSTRUMENTATION_SAMPLE_RATE) + tasks.render_metrics()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')